@@ -5,8 +5,15 @@ import pathlib
 # Third-party libraries
 import xarray as xr
 
+# Local Scripts
+import artifact_cache
+import instrumentation
+import netcdf_encoding
+import paths
+import zarr_store
 
-def calculate_anomaly(variables, periods, months):
+
+def calculate_anomaly(variables, periods, months, engine="batched", stacked=False, source="netcdf", region=None):
     """
     Calculate the percentage difference from the long-term norm for a given month.
 
@@ -14,20 +21,33 @@ def calculate_anomaly(variables, periods, months):
         variables (list): List of variables to calculate the percentage difference for.
         periods (list): List of periods to process.
         months (list): List of months to process.
+        engine (str): "batched" computes all periods of a month in one vectorized
+            operation, "per_file" handles one period at a time.
+        stacked (bool): With the batched engine, write a single time-stacked NetCDF
+            instead of one file per period.
+        source (str): With the batched engine, "netcdf" reads the monthly mean files
+            and "zarr" computes the monthly means of a month's periods from the
+            Zarr stores in one pass.
+        region (str or tuple, optional): The region of the run, whose data directory is used.
+            See `regions.resolve`.
 
     Returns:
         None
     """
     # Directory path
-    variable_list = '-'.join(map(str, variables))
-    long_term_directory = pathlib.Path(f'./era5_data/{variable_list}/long-term_averages/')
-    monthly_directory = pathlib.Path(f'./era5_data/{variable_list}/monthly_means/')
-    output_directory = pathlib.Path(f'./era5_data/{variable_list}/monthly_anomalies/')
+    directory_path = paths.variable_directory(variables, region)
+    long_term_directory = pathlib.Path(f'{directory_path}/long-term_averages/')
+    monthly_directory = pathlib.Path(f'{directory_path}/monthly_means/')
+    output_directory = pathlib.Path(f'{directory_path}/monthly_anomalies/')
 
-    multi_anomaly(periods, long_term_directory, monthly_directory, output_directory)
+    if engine == "batched":
+        batch_anomaly(periods, long_term_directory, monthly_directory, output_directory, stacked, variables, source, region)
+    else:
+        multi_anomaly(periods, long_term_directory, monthly_directory, output_directory, variables)
 
 
-def multi_anomaly(periods, longterm_directory, monthly_directory, anomaly_directory):
+@instrumentation.stage("anomaly", fields=("periods",))
+def multi_anomaly(periods, longterm_directory, monthly_directory, anomaly_directory, variables=None):
     for period in periods:
         month = period[4:6]
 
@@ -45,10 +65,158 @@ def multi_anomaly(periods, longterm_directory, monthly_directory, anomaly_direct
         # Open the NetCDF files using xarray and calculate anomaly
         longterm_avg = xr.open_dataset(longterm_path)
         monthly_mean = xr.open_dataset(monthly_path)
-        longterm_avg_data = longterm_avg['ssrd']
-        monthly_mean_data = monthly_mean['ssrd'] 
+        names = list(variables) if variables else list(longterm_avg.data_vars)
+        longterm_avg_data = longterm_avg[names]
+        monthly_mean_data = monthly_mean[names]
         anomaly = ((monthly_mean_data - longterm_avg_data) / longterm_avg_data) * 100 # calculate the percentage difference
 
         # Create the output NetCDF file
-        anomaly.to_netcdf(output_file_path)
-        print(f"Percentage difference saved to {output_file_path}")
\ No newline at end of file
+        netcdf_encoding.write_netcdf(anomaly, output_file_path)
+        print(f"Percentage difference saved to {output_file_path}")
+
+
+@instrumentation.stage("anomaly", fields=("periods",))
+def batch_anomaly(periods, longterm_directory, monthly_directory, anomaly_directory, stacked=False, variables=None, source="netcdf", region=None):
+    """
+    Calculate the percentage anomalies of many periods at once.
+
+    Periods are grouped by month so each long-term average is loaded once. The
+    monthly means of a group are stacked along a "period" axis and compared to
+    the long-term average in a single vectorized operation. With the NetCDF
+    source, anomalies made from the same files and settings are reused, from
+    disk or from the artifact store.
+
+    Parameters:
+        periods (list): List of periods to process.
+        longterm_directory (pathlib.Path): Directory containing the long-term averages.
+        monthly_directory (pathlib.Path): Directory containing the monthly means.
+        anomaly_directory (pathlib.Path): Directory to save the anomalies.
+        stacked (bool): Write a single anomaly_stack.nc instead of one file per period.
+        variables (list, optional): Variables to compare. Defaults to every variable
+            of the long-term average; all of them are handled in the same pass.
+        source (str): "netcdf" stacks the monthly mean files, "zarr" computes the
+            monthly means from the Zarr stores of `variables`, which is then required.
+        region (str or tuple, optional): With the Zarr source, the region whose stores are read.
+
+    Returns:
+        None
+    """
+    os.makedirs(anomaly_directory, exist_ok=True)
+
+    # Group the periods by month so each long-term average is read only once
+    periods_by_month = {}
+    keys = {}
+    statuses = {}
+    for period in periods:
+        month = period[4:6]
+        if month == "":
+            output_file_path = os.path.join(anomaly_directory, f"anomaly_year_{period}.nc")
+        else:
+            output_file_path = os.path.join(anomaly_directory, f"anomaly_month{month}_{period}.nc")
+
+        if not stacked:
+            if source == "netcdf":
+                keys[period] = anomaly_key(longterm_directory, monthly_directory, period, variables)
+                status = artifact_cache.lookup(keys[period], output_file_path) if keys[period] is not None else None
+            else:
+                # The Zarr stores are directories, which are not fingerprinted
+                status = "current" if os.path.exists(output_file_path) else None
+            if status is not None:
+                statuses[period] = status
+                print(f"Percentage difference for the period {period} has already been calculated.")
+                continue
+        periods_by_month.setdefault(month, []).append((period, output_file_path))
+
+    if statuses and not periods_by_month:
+        instrumentation.mark("cached" if "cached" in statuses.values() else "skipped", "outputs current or cached")
+        return
+
+    anomalies = []
+    for month, month_periods in periods_by_month.items():
+        if month == "":
+            longterm_path = os.path.join(longterm_directory, "lt_average.nc")
+        else:
+            longterm_path = os.path.join(longterm_directory, f"lt_average_{month}.nc")
+
+        longterm_avg = xr.load_dataset(longterm_path)
+        names = list(variables) if variables else list(longterm_avg.data_vars)
+        longterm_avg_data = longterm_avg[names]
+        month_period_names = [period for period, _ in month_periods]
+        if source == "zarr":
+            monthly_mean_data = zarr_store.stack_period_means(variables, month_period_names, names, region)
+        else:
+            monthly_mean_data = stack_periods(monthly_directory, month_period_names, names)
+        anomaly = percentage_anomaly(monthly_mean_data, longterm_avg_data)
+
+        if stacked:
+            anomalies.append(anomaly)
+            continue
+
+        for period, output_file_path in month_periods:
+            netcdf_encoding.write_netcdf(anomaly.sel(period=period, drop=True), output_file_path)
+            if keys.get(period) is not None:
+                artifact_cache.store(keys[period], output_file_path, "anomaly")
+            print(f"Percentage difference saved to {output_file_path}")
+
+    if stacked and anomalies:
+        # Restore the order the periods were requested in
+        requested = [period for period in periods if period[4:6] in periods_by_month]
+        stacked_anomaly = xr.concat(anomalies, dim="period").sel(period=requested)
+        output_file_path = os.path.join(anomaly_directory, "anomaly_stack.nc")
+        netcdf_encoding.write_netcdf(stacked_anomaly, output_file_path)
+        print(f"Percentage differences for {len(requested)} periods saved to {output_file_path}")
+
+
+def anomaly_key(longterm_directory, monthly_directory, period, variables=None):
+    """
+    Identify the anomaly of a period by the files and settings it is computed from.
+
+    Parameters:
+        longterm_directory (pathlib.Path): Directory containing the long-term averages.
+        monthly_directory (pathlib.Path): Directory containing the monthly means.
+        period (str): The period.
+        variables (list, optional): Variables compared.
+
+    Returns:
+        str: The artifact key, or None if an input is missing.
+    """
+    month = period[4:6]
+    longterm_name = "lt_average.nc" if month == "" else f"lt_average_{month}.nc"
+    inputs = [os.path.join(longterm_directory, longterm_name), os.path.join(monthly_directory, f"mean_{period}.nc")]
+    if not all(os.path.exists(path) for path in inputs):
+        return None
+    return artifact_cache.artifact_key("anomaly", inputs, variables=variables, encoding=netcdf_encoding.settings())
+
+
+def stack_periods(monthly_directory, periods, variables):
+    """
+    Load the monthly means of several periods stacked along a "period" axis.
+
+    Parameters:
+        monthly_directory (pathlib.Path): Directory containing the monthly means.
+        periods (list): List of periods to load.
+        variables (list): Variables to load. Each file is read once for all of them.
+
+    Returns:
+        xarray.Dataset: The monthly means with a leading "period" dimension.
+    """
+    datasets = [xr.load_dataset(monthly_directory / f"mean_{period}.nc")[variables] for period in periods]
+    return xr.concat(datasets, dim="period").assign_coords(period=periods)
+
+
+def percentage_anomaly(monthly_mean_data, longterm_avg_data):
+    """
+    Calculate the percentage difference from the long-term average.
+
+    Cells where the long-term average is zero, such as solar radiation during
+    polar night, are set to NaN instead of dividing by zero.
+
+    Parameters:
+        monthly_mean_data (xarray.Dataset): Monthly means, optionally stacked by period.
+        longterm_avg_data (xarray.Dataset): The long-term average.
+
+    Returns:
+        xarray.Dataset: The percentage difference of every variable.
+    """
+    safe_longterm = longterm_avg_data.where(longterm_avg_data != 0)
+    return ((monthly_mean_data - safe_longterm) / safe_longterm) * 100
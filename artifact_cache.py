@@ -0,0 +1,366 @@
+# Standard libraries
+import os
+import json
+import shutil
+import hashlib
+
+# Location and size limit of the store, set by `configure`
+DIRECTORY_VARIABLE = "ERA5_CACHE_DIR"
+MAX_BYTES_VARIABLE = "ERA5_CACHE_MAX_BYTES"
+
+DEFAULT_DIRECTORY = os.path.join('.', 'era5_data', 'cache')
+DEFAULT_MAX_BYTES = 20 * 2 ** 30
+
+
+def configure(directory=None, max_bytes=None):
+    """
+    Set the location and size bound of the artifact store.
+
+    Parameters:
+        directory (str, optional): Directory of the store.
+        max_bytes (int, optional): Size the stored artifacts may take up. The least
+            recently used ones are evicted beyond it. 0 stores nothing, but outputs
+            are still checked against the parameters they were made with.
+
+    Returns:
+        None
+    """
+    if directory is not None:
+        os.environ[DIRECTORY_VARIABLE] = str(directory)
+    if max_bytes is not None:
+        os.environ[MAX_BYTES_VARIABLE] = str(int(max_bytes))
+
+
+def settings():
+    """
+    Return the configured store.
+
+    Returns:
+        tuple: (directory, max bytes).
+    """
+    directory = os.environ.get(DIRECTORY_VARIABLE, DEFAULT_DIRECTORY)
+    max_bytes = int(os.environ.get(MAX_BYTES_VARIABLE, DEFAULT_MAX_BYTES))
+    return directory, max_bytes
+
+
+def artifact_key(stage, inputs=(), **parameters):
+    """
+    Identify an artifact by what it is made from.
+
+    Any change to the contents of an input or to a parameter gives a new key,
+    so an output made with other settings is never served for this one.
+
+    Parameters:
+        stage (str): Stage making the artifact, e.g. "average".
+        inputs (list): Files the artifact is made from.
+        **parameters: Settings that change the artifact, e.g. resolution=0.018.
+            They must be JSON-serializable, or have a stable str().
+
+    Returns:
+        str: Hex digest of the stage, the input contents and the parameters.
+    """
+    payload = json.dumps({
+        "stage": stage,
+        "inputs": [file_fingerprint(path) for path in inputs],
+        "parameters": parameters
+    }, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def file_fingerprint(path):
+    """
+    Hash the contents of a file, reusing earlier results while it is unchanged.
+
+    The hashes are kept in the store keyed by path, size and modification time,
+    so large inputs are read once rather than on every lookup of every process.
+
+    Parameters:
+        path (str): Path to the file.
+
+    Returns:
+        str: Hex digest of the file contents.
+    """
+    memo_path = digest_path(path)
+    if os.path.exists(memo_path):
+        with open(memo_path) as file:
+            return file.read().strip()
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    write_atomic(memo_path, digest.hexdigest())
+    return digest.hexdigest()
+
+
+def remember_fingerprint(path, digest):
+    """
+    Record the hash of a file that is already known, e.g. from the download manifest.
+
+    Parameters:
+        path (str): Path to the file, as it is now.
+        digest (str): Hex SHA-256 digest of its contents.
+
+    Returns:
+        None
+    """
+    memo_path = digest_path(path)
+    if not os.path.exists(memo_path):
+        write_atomic(memo_path, digest)
+
+
+def digest_path(path):
+    """
+    Return where the hash of a file is memoized, keyed by its path, size and modification time.
+
+    Parameters:
+        path (str): Path to the file.
+
+    Returns:
+        str: Path inside the store.
+    """
+    stat = os.stat(path)
+    memo = hashlib.sha256(f"{os.path.abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}".encode("utf-8")).hexdigest()
+    return os.path.join(settings()[0], "digests", memo[:2], memo)
+
+
+def object_path(key, suffix):
+    """
+    Return where the artifact of a key is stored.
+
+    Parameters:
+        key (str): The artifact key.
+        suffix (str): File extension of the artifact, e.g. ".nc".
+
+    Returns:
+        str: Path inside the store.
+    """
+    return os.path.join(settings()[0], "objects", key[:2], f"{key}{suffix}")
+
+
+def record_path(key):
+    """
+    Return the path of the record listing the outputs made for a key.
+
+    Parameters:
+        key (str): The artifact key.
+
+    Returns:
+        str: Path inside the store.
+    """
+    return os.path.join(settings()[0], "records", key[:2], f"{key}.json")
+
+
+def is_current(key, output_path):
+    """
+    Check whether an output on disk was made for a key.
+
+    The output counts as current when it was written or restored for this key
+    and has not been modified since. Outputs made before the store existed, or
+    with other inputs or parameters, are not.
+
+    Parameters:
+        key (str): The artifact key.
+        output_path (str): The output.
+
+    Returns:
+        bool: True if the output can be used as is.
+    """
+    if not os.path.exists(output_path):
+        return False
+    stamp = file_stamp(output_path)
+    outputs = load_record(key).get("outputs", {})
+    return outputs.get(os.path.abspath(output_path)) == stamp
+
+
+def lookup(key, output_path):
+    """
+    Make an output available without recomputing it, if possible.
+
+    Parameters:
+        key (str): The artifact key.
+        output_path (str): The output.
+
+    Returns:
+        str: "current" if the output on disk was made for the key, "cached" if it
+            was restored from the store, or None if it must be computed.
+    """
+    if is_current(key, output_path):
+        return "current"
+    if fetch(key, output_path):
+        return "cached"
+    return None
+
+
+def fetch(key, output_path):
+    """
+    Copy the stored artifact of a key to an output path.
+
+    Parameters:
+        key (str): The artifact key.
+        output_path (str): Where to put the artifact.
+
+    Returns:
+        bool: True if the artifact was in the store.
+    """
+    stored_path = object_path(key, os.path.splitext(str(output_path))[1])
+    if not os.path.exists(stored_path):
+        return False
+    try:
+        os.makedirs(os.path.dirname(str(output_path)) or '.', exist_ok=True)
+        copy_atomic(stored_path, output_path)
+        os.utime(stored_path)  # the modification time orders the LRU eviction
+    except FileNotFoundError:  # evicted by another process meanwhile
+        return False
+    record_output(key, output_path)
+    return True
+
+
+def store(key, output_path, stage=None):
+    """
+    Record an output made for a key and keep a copy of it in the store.
+
+    Parameters:
+        key (str): The artifact key.
+        output_path (str): The output that was just written.
+        stage (str, optional): Stage that made it, kept in the record for inspection.
+
+    Returns:
+        None
+    """
+    record_output(key, output_path, stage)
+    directory, max_bytes = settings()
+    size = os.path.getsize(output_path)
+    if size > max_bytes:
+        return
+
+    copy_atomic(output_path, object_path(key, os.path.splitext(str(output_path))[1]))
+    evict(max_bytes)
+
+
+def evict(max_bytes=None):
+    """
+    Remove the least recently used artifacts until the store fits its size bound.
+
+    Records and input hashes are small and kept, so outputs on disk stay current
+    after their stored copy is evicted.
+
+    Parameters:
+        max_bytes (int, optional): Size bound. Defaults to the configured one.
+
+    Returns:
+        int: Number of bytes removed.
+    """
+    directory, configured_bytes = settings()
+    max_bytes = configured_bytes if max_bytes is None else max_bytes
+
+    entries = []
+    objects_directory = os.path.join(directory, "objects")
+    for root, _, filenames in os.walk(objects_directory):
+        for filename in filenames:
+            path = os.path.join(root, filename)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for _, size, path in sorted(entries):
+        if total - removed <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            removed += size
+        except FileNotFoundError:
+            continue
+    return removed
+
+
+def load_record(key):
+    """
+    Read the record of a key.
+
+    Parameters:
+        key (str): The artifact key.
+
+    Returns:
+        dict: The record. Empty if there is none.
+    """
+    path = record_path(key)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def record_output(key, output_path, stage=None):
+    """
+    Note that an output on disk holds the artifact of a key.
+
+    Parameters:
+        key (str): The artifact key.
+        output_path (str): The output.
+        stage (str, optional): Stage that made it.
+
+    Returns:
+        None
+    """
+    record = load_record(key)
+    if stage is not None:
+        record["stage"] = stage
+    record.setdefault("outputs", {})[os.path.abspath(output_path)] = file_stamp(output_path)
+    write_atomic(record_path(key), json.dumps(record, indent=2, sort_keys=True))
+
+
+def file_stamp(path):
+    """
+    Return the size and modification time of a file.
+
+    Parameters:
+        path (str): Path to the file.
+
+    Returns:
+        list: [size, modification time in ns].
+    """
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def copy_atomic(source_path, target_path):
+    """
+    Copy a file so that the target never exists half-written.
+
+    Parameters:
+        source_path (str): File to copy.
+        target_path (str): Destination.
+
+    Returns:
+        None
+    """
+    os.makedirs(os.path.dirname(str(target_path)) or '.', exist_ok=True)
+    temp_path = f"{target_path}.{os.getpid()}.tmp"
+    shutil.copyfile(source_path, temp_path)
+    os.replace(temp_path, target_path)
+
+
+def write_atomic(path, text):
+    """
+    Write a small text file atomically.
+
+    Parameters:
+        path (str): Destination.
+        text (str): Contents.
+
+    Returns:
+        None
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'w') as file:
+        file.write(text)
+    os.replace(temp_path, path)
@@ -0,0 +1,143 @@
+# Standard libraries
+import os
+import json
+import time
+import argparse
+import tempfile
+
+# Third-party libraries
+import numpy as np
+import xarray as xr
+
+# Local Scripts
+import netcdf_encoding
+
+# (name, compression, level, packing) of each encoding compared
+PROFILES = [
+    ("float64 uncompressed", "none", 0, "none"),
+    ("float32 uncompressed", "none", 0, "float32"),
+    ("float32 zlib-1", "zlib", 1, "float32"),
+    ("float32 zlib-4", "zlib", 4, "float32"),
+    ("float32 zlib-9", "zlib", 9, "float32"),
+    ("int16 zlib-4", "zlib", 4, "int16"),
+    ("float32 zstd-3", "zstd", 3, "float32"),
+    ("int16 zstd-3", "zstd", 3, "int16"),
+]
+
+
+def synthetic_mean(n_lat, n_lon, n_periods=1, seed=0):
+    """
+    Build a monthly-mean-like field: a smooth latitude gradient with weather-scale noise.
+
+    Parameters:
+        n_lat (int): Number of latitudes.
+        n_lon (int): Number of longitudes.
+        n_periods (int): Number of stacked periods. 1 gives a single map.
+        seed (int): Random seed.
+
+    Returns:
+        xarray.Dataset: A float64 "ssrd" variable on a 0..360 longitude grid.
+    """
+    rng = np.random.default_rng(seed)
+    latitude = np.linspace(90, -90, n_lat)
+    longitude = np.linspace(0, 360, n_lon, endpoint=False)
+    base = 2.5e7 * np.cos(np.deg2rad(latitude))[:, None] * np.ones(n_lon)
+    values = base + rng.normal(0, 1e6, (n_periods, n_lat, n_lon))
+    values = np.clip(values, 0, None)
+    if n_periods == 1:
+        return xr.Dataset({"ssrd": (("latitude", "longitude"), values[0])},
+                          coords={"latitude": latitude, "longitude": longitude})
+    return xr.Dataset({"ssrd": (("period", "latitude", "longitude"), values)},
+                      coords={"period": np.arange(n_periods), "latitude": latitude, "longitude": longitude})
+
+
+def measure(dataset, directory, name, compression, level, packing, repeats=3):
+    """
+    Write a dataset with one encoding and time reading it back.
+
+    Parameters:
+        dataset (xarray.Dataset): The data.
+        directory (str): Directory for the test file.
+        name (str): Name of the encoding.
+        compression (str): Compression passed to `netcdf_encoding.write_netcdf`.
+        level (int): Compression level.
+        packing (str): Packing passed to `netcdf_encoding.write_netcdf`.
+        repeats (int): Number of timed reads; the fastest is reported.
+
+    Returns:
+        dict: Size, write and read times and the largest absolute error, or the
+            error message when the encoding is not available.
+    """
+    path = os.path.join(directory, f"{name.replace(' ', '_')}.nc")
+    try:
+        start = time.perf_counter()
+        netcdf_encoding.write_netcdf(dataset, path, compression, level, packing)
+        write_seconds = time.perf_counter() - start
+    except Exception as error:  # e.g. a netCDF-C build without zstd
+        return {"encoding": name, "error": str(error)}
+
+    read_seconds = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        loaded = xr.load_dataset(path)
+        read_seconds.append(time.perf_counter() - start)
+
+    error = float(np.nanmax(np.abs(loaded["ssrd"].values.astype("float64") - dataset["ssrd"].values)))
+    size = os.path.getsize(path)
+    os.remove(path)
+    return {
+        "encoding": name,
+        "bytes": size,
+        "write_seconds": round(write_seconds, 4),
+        "read_seconds": round(min(read_seconds), 4),
+        "read_mb_per_second": round(dataset["ssrd"].nbytes / 2 ** 20 / max(min(read_seconds), 1e-9), 1),
+        "max_abs_error": error
+    }
+
+
+def main(argv=None):
+    """
+    Compare the size and read speed of the NetCDF output encodings.
+
+    Run from the repository root:
+
+        python -m benchmarks.encoding_tradeoff --grid 721 1440 --periods 12 --json results.json
+
+    Parameters:
+        argv (list, optional): Command-line arguments. Defaults to sys.argv.
+
+    Returns:
+        list: One result dict per encoding.
+    """
+    parser = argparse.ArgumentParser(description="Size and read-speed tradeoff of the NetCDF output encodings.")
+    parser.add_argument("--grid", nargs=2, type=int, default=[721, 1440], metavar=("LAT", "LON"),
+                        help="grid size, 721 x 1440 is the 0.25 degree ERA5 grid")
+    parser.add_argument("--periods", type=int, default=1, help="number of stacked periods (1 = one monthly map)")
+    parser.add_argument("--repeats", type=int, default=3, help="timed reads per encoding")
+    parser.add_argument("--json", help="also write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    dataset = synthetic_mean(args.grid[0], args.grid[1], args.periods)
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for profile in PROFILES:
+            results.append(measure(dataset, directory, *profile, repeats=args.repeats))
+
+    baseline = results[0].get("bytes")
+    print(f"{'encoding':<22}{'MB':>9}{'ratio':>8}{'write s':>10}{'read s':>9}{'read MB/s':>11}{'max error':>12}")
+    for result in results:
+        if "error" in result:
+            print(f"{result['encoding']:<22}  unavailable: {result['error']}")
+            continue
+        print(f"{result['encoding']:<22}{result['bytes'] / 2 ** 20:>9.2f}{baseline / result['bytes']:>8.2f}"
+              f"{result['write_seconds']:>10.3f}{result['read_seconds']:>9.3f}{result['read_mb_per_second']:>11.1f}"
+              f"{result['max_abs_error']:>12.3g}")
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump({"grid": args.grid, "periods": args.periods, "results": results}, file, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    main()
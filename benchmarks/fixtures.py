@@ -0,0 +1,203 @@
+# Standard libraries
+import os
+import shutil
+import calendar
+
+# Third-party libraries
+import numpy as np
+import pandas as pd
+import xarray as xr
+from osgeo import ogr, osr
+
+# Local Scripts
+import regions
+
+
+def synthetic_download(year, month, variables, n_lat, n_lon, seed=0):
+    """
+    Build a month of hourly data laid out like an ERA5 CDS NetCDF download.
+
+    The dimensions, coordinate names and order (valid_time, latitude from 90 to
+    -90, longitude from 0 to 360) match the real files, so every stage reads it
+    the same way. The values follow a plausible diurnal and latitudinal cycle.
+
+    Parameters:
+        year (str): The year.
+        month (str): The month, e.g. "01".
+        variables (list): Variables to generate. ssrd, t2m and tp get realistic
+            magnitudes, any other name gets noise around 1.
+        n_lat (int): Number of latitudes.
+        n_lon (int): Number of longitudes.
+        seed (int): Random seed.
+
+    Returns:
+        xarray.Dataset: The synthetic month.
+    """
+    n_days = calendar.monthrange(int(year), int(month))[1]
+    valid_time = pd.date_range(f"{year}-{month}-01", periods=n_days * 24, freq="h")
+    latitude = np.linspace(90, -90, n_lat)
+    longitude = np.linspace(0, 360, n_lon, endpoint=False)
+
+    rng = np.random.default_rng([seed, int(year), int(month)])
+    hours = valid_time.hour.values.astype("float32")[:, None, None]
+    cos_lat = np.cos(np.deg2rad(latitude)).astype("float32")[None, :, None]
+    # Local solar hour of every longitude, so the sun moves across the grid
+    solar_hour = (hours + longitude.astype("float32")[None, None, :] / 15) % 24
+    daylight = np.clip(np.cos((solar_hour - 12) / 24 * 2 * np.pi), 0, None)
+
+    data_vars = {}
+    shape = (len(valid_time), n_lat, n_lon)
+    for variable in variables:
+        if variable == "ssrd":
+            values = 3.6e6 * daylight * cos_lat * rng.uniform(0.4, 1.0, shape).astype("float32")
+        elif variable == "t2m":
+            values = 250 + 50 * cos_lat + 5 * daylight + rng.normal(0, 2, shape).astype("float32")
+        elif variable == "tp":
+            values = rng.exponential(2e-4, shape).astype("float32") * (rng.random(shape) < 0.3)
+        else:
+            values = rng.normal(1, 0.1, shape)
+        data_vars[variable] = (("valid_time", "latitude", "longitude"), values.astype("float32"))
+
+    return xr.Dataset(
+        data_vars,
+        coords={
+            "valid_time": valid_time,
+            "latitude": latitude,
+            "longitude": longitude,
+            "number": 0,
+            "expver": ("valid_time", np.full(len(valid_time), "0001"))
+        }
+    )
+
+
+def write_fixtures(directory, variables, year_months, n_lat, n_lon):
+    """
+    Write one synthetic download per month, reused by the fake CDS client.
+
+    Parameters:
+        directory (str): Fixture directory.
+        variables (list): Variables to generate.
+        year_months (list): (year, month) pairs.
+        n_lat (int): Number of latitudes.
+        n_lon (int): Number of longitudes.
+
+    Returns:
+        None
+    """
+    os.makedirs(directory, exist_ok=True)
+    for year, month in year_months:
+        path = fixture_path(directory, year, month)
+        if not os.path.exists(path):
+            synthetic_download(year, month, variables, n_lat, n_lon).to_netcdf(path)
+
+
+def fixture_path(directory, year, month):
+    """
+    Return the path of a month's fixture file.
+
+    Parameters:
+        directory (str): Fixture directory.
+        year (str): The year.
+        month (str): The month.
+
+    Returns:
+        str: Path of the fixture.
+    """
+    return os.path.join(directory, f"fixture_{year}{month}.nc")
+
+
+class FakeResult:
+    """
+    Stand-in for the result of `cdsapi.Client.retrieve`.
+    """
+
+    def __init__(self, directory, request):
+        self.directory = directory
+        self.request = request
+
+    def download(self, target):
+        """
+        Write the requested months to `target`, like a finished CDS transfer.
+
+        A request with an "area" gets only the cells of that area, as from the CDS.
+
+        Parameters:
+            target (str): Path to write to.
+
+        Returns:
+            str: The path written.
+        """
+        year = self.request["year"][0]
+        months = self.request["month"]
+        area = self.request.get("area")
+        if len(months) == 1 and area is None:
+            shutil.copyfile(fixture_path(self.directory, year, months[0]), target)
+            return target
+
+        # A coalesced request holds every month in one file
+        datasets = [regions.subset(xr.load_dataset(fixture_path(self.directory, year, month)), area) for month in months]
+        xr.concat(datasets, dim="valid_time").to_netcdf(target)
+        return target
+
+
+class FakeClient:
+    """
+    Offline stand-in for `cdsapi.Client` serving the synthetic fixtures.
+
+    Requests are answered from files written by `write_fixtures`, so the
+    download stage runs its real splitting, manifest and hashing code without
+    any network access.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.requests = []
+
+    def retrieve(self, dataset, request):
+        """
+        Accept a request the way the CDS client does.
+
+        Parameters:
+            dataset (str): The CDS dataset name.
+            request (dict): The request parameters.
+
+        Returns:
+            FakeResult: Result whose `download` writes the requested data.
+        """
+        self.requests.append((dataset, request))
+        return FakeResult(self.directory, request)
+
+
+def land_shapefile(shapefile_path):
+    """
+    Write a small land shapefile of a few rectangular continents.
+
+    The rendering stages mask and outline with this instead of the Natural Earth land polygons.
+
+    Parameters:
+        shapefile_path (str): Path of the .shp file to write.
+
+    Returns:
+        None
+    """
+    os.makedirs(os.path.dirname(shapefile_path), exist_ok=True)
+    driver = ogr.GetDriverByName("ESRI Shapefile")
+    if os.path.exists(shapefile_path):
+        driver.DeleteDataSource(shapefile_path)
+    source = driver.CreateDataSource(shapefile_path)
+    spatial_reference = osr.SpatialReference()
+    spatial_reference.ImportFromEPSG(4326)
+    layer = source.CreateLayer("land", spatial_reference, ogr.wkbPolygon)
+
+    boxes = [(-170, 15, -50, 75), (-80, -55, -35, 12), (-15, -35, 50, 70), (60, 5, 150, 75), (112, -40, 155, -10)]
+    for west, south, east, north in boxes:
+        ring = ogr.Geometry(ogr.wkbLinearRing)
+        for x, y in [(west, south), (east, south), (east, north), (west, north), (west, south)]:
+            ring.AddPoint_2D(x, y)
+        polygon = ogr.Geometry(ogr.wkbPolygon)
+        polygon.AddGeometry(ring)
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetGeometry(polygon)
+        layer.CreateFeature(feature)
+        feature = None
+    source = None
@@ -0,0 +1,271 @@
+# Standard libraries
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import calendar
+import resource
+import tempfile
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+# Local Scripts
+from benchmarks import fixtures
+
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Stages in the order they run, and the stages whose outputs each one reads
+STAGES = ["download", "average", "longterm", "anomaly", "anomaly_batched", "convert", "render_headless", "render_qgis"]
+REQUIRES = {
+    "download": [],
+    "average": ["download"],
+    "longterm": ["download"],
+    "anomaly": ["average", "longterm"],
+    "anomaly_batched": ["average", "longterm"],
+    "convert": ["average"],
+    "render_headless": ["average"],
+    "render_qgis": ["convert"]
+}
+
+
+def run_stage(stage, workdir, fixture_directory, variables, years, months):
+    """
+    Run one stage of the pipeline in the benchmark's working directory.
+
+    Called in a fresh process, so the peak RSS it reports belongs to this stage alone.
+
+    Parameters:
+        stage (str): The stage, one of STAGES.
+        workdir (str): Working directory holding ./era5_data and ./shpfiles.
+        fixture_directory (str): Directory of the synthetic downloads.
+        variables (list): List of variables.
+        years (list): List of years.
+        months (list): List of months.
+
+    Returns:
+        dict: Wall time, baseline and peak RSS in MB, and the error traceback if
+            the stage failed or the reason it was skipped.
+    """
+    # The stages write to relative ./era5_data paths, so import them by absolute path
+    if REPOSITORY_ROOT not in sys.path:
+        sys.path.insert(0, REPOSITORY_ROOT)
+    os.chdir(workdir)
+    if stage == "render_qgis":
+        try:
+            import qgis_transform
+        except ImportError as error:
+            return {"wall_seconds": 0.0, "baseline_rss_mb": peak_rss_mb(), "peak_rss_mb": peak_rss_mb(),
+                    "error": None, "skipped": f"QGIS is not available: {error}"}
+
+    import download
+    import process
+    import longterm_averaging
+    import anomaly_calc
+    import convert
+    import headless_render
+
+    # Every month of every year, named the way the download stage names them
+    periods = [download.month_period(year, month) for year in years for month in months]
+    baseline = peak_rss_mb()
+    start = time.perf_counter()
+    error = None
+    try:
+        if stage == "download":
+            download._client = fixtures.FakeClient(fixture_directory)
+            downloaded = download.batch_download(variables, years, months, retry_delay=0)
+            # batch_download reports failed months instead of raising
+            if len(downloaded) < len(periods):
+                raise RuntimeError(f"{len(periods) - len(downloaded)} of {len(periods)} months could not be downloaded.")
+        elif stage == "average":
+            process.average_netcdfs(variables, periods)
+        elif stage == "longterm":
+            longterm_averaging.create_longterm_average(variables, months)
+        elif stage == "anomaly":
+            anomaly_calc.calculate_anomaly(variables, periods, months, engine="per_file")
+        elif stage == "anomaly_batched":
+            anomaly_calc.calculate_anomaly(variables, periods, months, engine="batched")
+        elif stage == "convert":
+            convert.netcdf_to_geotiff(variables, periods, "monthly_means")
+        elif stage == "render_headless":
+            headless_render.render_maps(variables, periods, "monthly_means", backend="headless")
+        elif stage == "render_qgis":
+            headless_render.render_maps(variables, periods, "monthly_means", backend="qgis")
+        else:
+            raise ValueError(f"Unknown stage: {stage}")
+    except Exception:
+        error = traceback.format_exc()
+
+    return {
+        "wall_seconds": time.perf_counter() - start,
+        "baseline_rss_mb": baseline,
+        "peak_rss_mb": peak_rss_mb(),
+        "error": error,
+        "skipped": None
+    }
+
+
+def peak_rss_mb():
+    """
+    Return the peak resident set size of this process and its children.
+
+    Returns:
+        float: Peak RSS in MB.
+    """
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    scale = 1 if sys.platform == "darwin" else 1024  # ru_maxrss is in bytes on macOS, KB on Linux
+    return round(max(own, children) * scale / 2 ** 20, 1)
+
+
+def stages_to_run(selected):
+    """
+    Add the stages the selected ones depend on, in run order.
+
+    Parameters:
+        selected (list): Stages to measure.
+
+    Returns:
+        list: Stages to run.
+    """
+    needed = set()
+    pending = list(selected)
+    while pending:
+        stage = pending.pop()
+        if stage not in needed:
+            needed.add(stage)
+            pending.extend(REQUIRES[stage])
+    return [stage for stage in STAGES if stage in needed]
+
+
+def year_months(n_months, first_year=2016):
+    """
+    Work out the years and months of a case with `n_months` months.
+
+    Up to 12 months fall in one year; more are rounded up to whole years, so the
+    long-term averages span several years.
+
+    Parameters:
+        n_months (int): Number of months.
+        first_year (int): First year.
+
+    Returns:
+        tuple: (years, months) lists as passed to the stages.
+    """
+    if n_months <= 12:
+        return [str(first_year)], [f"{month:02d}" for month in range(1, n_months + 1)]
+    n_years = -(-n_months // 12)
+    return [str(first_year + index) for index in range(n_years)], [f"{month:02d}" for month in range(1, 13)]
+
+
+def run_case(selected, variables, grid, n_months, scratch_directory):
+    """
+    Measure the selected stages on one grid size and month count.
+
+    Parameters:
+        selected (list): Stages to measure.
+        variables (list): List of variables.
+        grid (tuple): (latitudes, longitudes).
+        n_months (int): Number of months.
+        scratch_directory (str): Directory for the fixtures and outputs.
+
+    Returns:
+        list: One result dict per selected stage.
+    """
+    years, months = year_months(n_months)
+    n_lat, n_lon = grid
+    case_name = f"{n_lat}x{n_lon}_{n_months}m"
+    workdir = os.path.join(scratch_directory, case_name)
+    fixture_directory = os.path.join(scratch_directory, "fixtures", f"{n_lat}x{n_lon}")
+
+    print(f"Preparing {case_name}...")
+    fixtures.write_fixtures(fixture_directory, variables, [(year, month) for year in years for month in months], n_lat, n_lon)
+    fixtures.land_shapefile(os.path.join(workdir, "shpfiles", "world_map", "ne_10m_land.shp"))
+
+    hours = sum(24 * calendar.monthrange(int(year), int(month))[1] for year in years for month in months)
+    values = hours * n_lat * n_lon * len(variables)  # hourly values in the downloads
+
+    results = []
+    # Spawned so every stage starts from a clean interpreter and its own RSS high-water mark
+    context = multiprocessing.get_context("spawn")
+    for stage in stages_to_run(selected):
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            outcome = executor.submit(run_stage, stage, workdir, fixture_directory, variables, years, months).result()
+        if stage not in selected:
+            continue
+        if outcome["skipped"] is not None:
+            print(f"\t{stage:<16}skipped: {outcome['skipped']}")
+            results.append({"stage": stage, "grid": [n_lat, n_lon], "status": "skipped", "reason": outcome["skipped"]})
+            continue
+
+        wall_seconds = max(outcome["wall_seconds"], 1e-9)
+        result = {
+            "stage": stage,
+            "grid": [n_lat, n_lon],
+            "months": len(years) * len(months),
+            "variables": variables,
+            "status": "ok" if outcome["error"] is None else "failed",
+            "wall_seconds": round(wall_seconds, 3),
+            "months_per_second": round(len(years) * len(months) / wall_seconds, 3),
+            "mvalues_per_second": round(values / 1e6 / wall_seconds, 2),
+            "baseline_rss_mb": outcome["baseline_rss_mb"],
+            "peak_rss_mb": outcome["peak_rss_mb"]
+        }
+        if outcome["error"] is not None:
+            result["error"] = outcome["error"].strip().splitlines()[-1]
+        print(f"\t{stage:<16}{result['status']:<8}{result['wall_seconds']:>9.2f}s{result['peak_rss_mb']:>9.1f} MB")
+        results.append(result)
+    return results
+
+
+def main(argv=None):
+    """
+    Benchmark the pipeline stages offline on synthetic ERA5 data.
+
+    Run from the repository root, for example:
+
+        python -m benchmarks.stages --grids 91x180 181x360 --months 1 3 --json stages.json
+
+    Parameters:
+        argv (list, optional): Command-line arguments. Defaults to sys.argv.
+
+    Returns:
+        list: One result dict per stage and case.
+    """
+    parser = argparse.ArgumentParser(description="Offline benchmark of the pipeline stages on synthetic ERA5 data.")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES[:-1],
+                        help="stages to measure (render_qgis needs QGIS)")
+    parser.add_argument("--grids", nargs="+", default=["91x180", "181x360"],
+                        help="grid sizes as LATxLON, 721x1440 is the full 0.25 degree grid")
+    parser.add_argument("--months", nargs="+", type=int, default=[1, 3], help="month counts to run")
+    parser.add_argument("--variables", nargs="+", default=["ssrd"], help="variables in the synthetic downloads")
+    parser.add_argument("--scratch", help="directory for fixtures and outputs (default: a temporary directory)")
+    parser.add_argument("--json", help="also write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    grids = [tuple(int(size) for size in grid.lower().split("x")) for grid in args.grids]
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        scratch_directory = os.path.abspath(args.scratch or temporary_directory)
+        results = []
+        for grid in grids:
+            for n_months in args.months:
+                results.extend(run_case(args.stages, args.variables, grid, n_months, scratch_directory))
+
+    report = {
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count()
+        },
+        "results": results
+    }
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(report, file, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -6,60 +6,107 @@ import pathlib
 import xarray as xr
 import rioxarray
 
+# Local Scripts
+import artifact_cache
+import instrumentation
+import parallel
+import paths
+import regions
 
-def netcdf_to_geotiff(variables, periods, input_dir):
+
+def netcdf_to_geotiff(variables, periods, input_dir, workers=1, region=None):
     """
     Convert NetCDF file to GeoTIFF format.
 
+    Every file is opened once, however many variables it holds. Each variable
+    gets its own GeoTIFF, named after the period alone when there is only one
+    variable, which is what the rendering stages read. GeoTIFFs made from the
+    same data and region are reused, from disk or from the artifact store.
+
     Parameters:
         variables (list): List of variables to be converted from NetCDF to GeoTIFF.
         periods (list): List of periods to process.
         input_dir (str): Input directory.
+        workers (int): Number of worker processes. Every period is converted independently.
+        region (str or tuple, optional): Only convert the cells of this region. See `regions.resolve`.
 
     Returns:
         None
     """
     # Open NetCDF files and average them
-    variable_list = '-'.join(map(str, variables))
-    directory_path = pathlib.Path(f'./era5_data/{variable_list}')
+    directory_path = paths.variable_directory(variables, region)
     input_directory = pathlib.Path(f'{directory_path}/{input_dir}/')
     output_directory = pathlib.Path(f'{directory_path}/{input_dir}/geotiffs/')
 
+    tasks = []
     for period in periods:
-        month = period[4:6]
-        # Month Check
-        if month == "" or input_dir == "monthly_means":
-            input_path_suffix = f"{period}"
-        else:
-            input_path_suffix = f"month{month}_{period}"
+        input_path_name = paths.period_input_name(period, input_dir)
+        input_path = pathlib.Path(f"{input_directory / input_path_name}.nc")
 
-        # Anomaly Check
-        if input_dir == "monthly_anomalies":
-            input_path_name = f"anomaly_{input_path_suffix}"
-        elif input_dir == "monthly_means":
-            input_path_name = f"mean_{input_path_suffix}"
+        os.makedirs(output_directory, exist_ok=True)
+        outputs = [
+            (variable, output_directory / f"{paths.variable_stem(input_path_name, variable, variables)}.tif")
+            for variable in variables
+        ]
 
-        input_path = input_directory / input_path_name
+        # Check if the output files are current or cached. A missing input is left to the task to report
+        if input_path.exists():
+            outputs = [
+                (variable, output_path) for variable, output_path in outputs
+                if artifact_cache.lookup(convert_key(input_path, variable, region), output_path) is None
+            ]
+        if not outputs:
+            print(f"Data for the period {period} has already been converted.")
+            instrumentation.skipped("convert", "output current", variables=variables, period=period)
+            continue
+
+        tasks.append((input_path, outputs, region))
 
-        data = xr.open_dataset(str(input_path) + ".nc")
+    parallel.run_tasks(convert_file, tasks, workers, "GeoTIFF conversion", raise_on_error=True)
 
-        # Shift the longitude values
-        data.coords['longitude'] = (data.coords['longitude'] + 180) % 360 - 180
-        data = data.sortby(data.longitude)
 
-        # Select the variable to export
-        variable = data["ssrd"]
+@instrumentation.stage("convert", fields=("input_path",))
+def convert_file(input_path, outputs, region=None):
+    """
+    Convert a single NetCDF file to one or more GeoTIFFs.
+
+    Parameters:
+        input_path (pathlib.Path): Path to the NetCDF file.
+        outputs (list): (variable, output path) pairs.
+        region (str or tuple, optional): Only write the cells of this region.
+
+    Returns:
+        None
+    """
+    data = regions.subset(xr.open_dataset(input_path), region)
 
+    # Shift the longitude values
+    data.coords['longitude'] = (data.coords['longitude'] + 180) % 360 - 180
+    data = data.sortby(data.longitude)
+
+    for name, output_path in outputs:
         # Set spatial reference
-        variable = variable.rio.write_crs("EPSG:4326")  # Replace with your CRS if known
+        variable = data[name].rio.write_crs("EPSG:4326")  # Replace with your CRS if known
 
-        os.makedirs(output_directory, exist_ok=True)
-        output_path = output_directory / f"{input_path_name}.tif"
-        # Check if output file exists
-        if output_path.exists():
-            print(f"Data for the period {period} has already been converted.")
-            continue
+        # Declare NoData when the raster is created, so no later copy is needed to set it
+        variable = variable.rio.write_nodata(-9999, encoded=True)
 
         # Export to GeoTIFF
         variable.rio.to_raster(output_path)
-        print("GeoTIFF file created successfully!")
\ No newline at end of file
+        artifact_cache.store(convert_key(input_path, name, region), output_path, "convert")
+        print(f"GeoTIFF file {output_path.name} created successfully!")
+
+
+def convert_key(input_path, variable, region=None):
+    """
+    Identify the GeoTIFF of one variable of a NetCDF file.
+
+    Parameters:
+        input_path (pathlib.Path): Path to the NetCDF file.
+        variable (str): The variable.
+        region (str or tuple, optional): The region converted.
+
+    Returns:
+        str: The artifact key. See `artifact_cache.artifact_key`.
+    """
+    return artifact_cache.artifact_key("convert", [input_path], variable=variable, region=regions.resolve(region), nodata=-9999)
@@ -1,36 +1,126 @@
 import os
+import re
 import pathlib
 import cdsapi
+import xarray as xr
 import sys
 import contextlib
+import time
+import json
+import hashlib
+import threading
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-def batch_download(variables, years, months):
+import artifact_cache
+import instrumentation
+import paths
+import regions
+
+TIMES = [
+    "00:00", "01:00", "02:00", "03:00", "04:00", "05:00",
+    "06:00", "07:00", "08:00", "09:00", "10:00", "11:00",
+    "12:00", "13:00", "14:00", "15:00", "16:00", "17:00",
+    "18:00", "19:00", "20:00", "21:00", "22:00", "23:00"
+]
+
+MANIFEST_FILENAME = "manifest.json"
+
+DATASET = "reanalysis-era5-single-levels"
+
+# Guards manifest reads and writes when months are downloaded concurrently
+_manifest_lock = threading.Lock()
+
+# One CDS client is shared by every request of the session
+_client = None
+_client_lock = threading.Lock()
+
+
+def batch_download(variables, years, months, max_in_flight=4, max_retries=3, retry_delay=60, months_per_request=1, region=None):
     """
     Downloads data for specified variables, years, and months in batches.
 
+    Up to `max_in_flight` requests are submitted to the CDS at once, so that
+    time spent queued on the CDS side overlaps. A request that fails is
+    retried on its own; it never aborts the rest of the batch.
+
+    With `months_per_request` greater than one, consecutive months of the same
+    year are coalesced into a single CDS request (12 asks for a whole year) and
+    the result is split back into the usual monthly download files.
+
     Parameters:
         variables (list of str): List of variables to download data for.
         years (list of str): List of years to download data for.
         months (list of str): List of months to download data for.
+        max_in_flight (int): Maximum number of CDS requests running at once.
+        max_retries (int): Number of times a failed request is retried.
+        retry_delay (float): Seconds to wait before retrying a failed request.
+        months_per_request (int): Number of months to fetch per CDS request.
+        region (str or tuple, optional): Only request this area. See `regions.resolve`.
 
     Returns:
-        list: List of periods for which data was downloaded.
+        list: List of periods for which data was downloaded, in year/month order.
     """
-    periods = []
-    for year in years:
-        for month in months:
-            days = monthdays(month, year)
-            times = [
-                "00:00", "01:00", "02:00", "03:00", "04:00", "05:00",
-                "06:00", "07:00", "08:00", "09:00", "10:00", "11:00",
-                "12:00", "13:00", "14:00", "15:00", "16:00", "17:00",
-                "18:00", "19:00", "20:00", "21:00", "22:00", "23:00"
-            ]
-            period = api_request(variables, year, month, days, times)
-            periods.append(period)
+    chunk_size = max(1, months_per_request)
+    chunks = [
+        (year, tuple(months[i:i + chunk_size]))
+        for year in years
+        for i in range(0, len(months), chunk_size)
+    ]
+    results = {}
+
+    print(f"Submitting {len(chunks)} download requests ({max_in_flight} in flight)...")
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        futures = {
+            executor.submit(download_months, variables, year, chunk, max_retries, retry_delay, region): (year, chunk)
+            for year, chunk in chunks
+        }
+        for future in as_completed(futures):
+            year, chunk = futures[future]
+            try:
+                for month, period in zip(chunk, future.result()):
+                    results[(year, month)] = period
+            except Exception as error:
+                print(f"Download for {year}-{'/'.join(chunk)} failed after {max_retries} retries: {error}")
+
+    # Return the periods in the order they were requested, not completion order
+    jobs = [(year, month) for year in years for month in months]
+    periods = [results[job] for job in jobs if job in results]
+    failed = len(jobs) - len(periods)
+    if failed:
+        print(f"{failed} of {len(jobs)} months could not be downloaded.")
     return periods
 
 
+def download_months(variables, year, months, max_retries=3, retry_delay=60, region=None):
+    """
+    Downloads one request worth of months, retrying only that request if it fails.
+
+    Parameters:
+        variables (list of str): List of variables to download data for.
+        year (str): The year to download data for.
+        months (list of str): The months to download, fetched in one request.
+        max_retries (int): Number of times the request is retried after a failure.
+        retry_delay (float): Seconds to wait before each retry.
+        region (str or tuple, optional): Only request this area. See `regions.resolve`.
+
+    Returns:
+        list: The periods that were downloaded, one per month.
+    """
+    attempt = 0
+    while True:
+        try:
+            if len(months) == 1:
+                return [api_request(variables, year, months[0], monthdays(months[0], year), TIMES, region=region)]
+            return api_request_chunk(variables, year, months, region=region)
+        except Exception as error:
+            if attempt >= max_retries:
+                raise
+            attempt += 1
+            print(f"Download for {year}-{'/'.join(months)} failed ({error}). Retry {attempt} of {max_retries} in {retry_delay}s...")
+            time.sleep(retry_delay)
+
+
 def monthdays(month, year):
     """
     Returns a list of days for a given month and year.
@@ -99,27 +189,41 @@ def download_period(years, months, days, times):
     return minmaxperiod
 
 
-def api_request(variables, year, month, days, times):
+def get_client():
     """
-    Downloads ERA5 reanalysis data for specified years, months, and variables.
+    Returns the CDS client shared by the session, creating it on first use.
 
-    Parameters:
-        years (list of str): List of years to download data for.
-        months (list of str): List of months to download data for.
-        variables (list of str): List of variables to download data for.
-    
     Returns:
-        None
+        cdsapi.Client: The shared CDS client.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            # Silence the output of loading the CDSAPI
+            with open(os.devnull, 'w') as fnull, contextlib.redirect_stdout(fnull), contextlib.redirect_stderr(fnull):
+                _client = cdsapi.Client()
+    return _client
 
-    The function checks if the data for the specified period already exists
-    and skips the download if it does. Otherwise, it retrieves the data from
-    the CDS API and saves it in the specified directory.
+
+def build_request(variables, year, months, days, times, region=None):
+    """
+    Builds the CDS request parameters for ERA5 single-level data.
+
+    Parameters:
+        variables (list of str): List of variables to request.
+        year (str): The year to request.
+        months (list of str): The months to request.
+        days (list of str): The days to request.
+        times (list of str): The times to request.
+        region (str or tuple, optional): Area to request. Defaults to the whole globe.
+
+    Returns:
+        dict: The CDS request parameters.
     """
-    dataset = "reanalysis-era5-single-levels"
     request = {
         "product_type": ["reanalysis"],
         "year": [year],
-        "month": [month],
+        "month": list(months),
         "day": days,
         "time": times,
         "data_format": "netcdf",
@@ -127,27 +231,326 @@ def api_request(variables, year, month, days, times):
         "variable": variables
     }
 
+    # The CDS cuts the area out before the transfer, so only the region's cells are sent
+    area = regions.cds_area(region)
+    if area is not None:
+        request["area"] = area
+    return request
+
+
+def month_period(year, month, days=None, times=TIMES):
+    """
+    Returns the period string used to name the download of a month.
+
+    Parameters:
+        year (str): The year of the period.
+        month (str): The month of the period.
+        days (list of str, optional): Days of the period. Defaults to the whole month.
+        times (list of str): Times of the period.
+
+    Returns:
+        str: The period, e.g. "20160101_to_20160131".
+    """
+    if days is None:
+        days = monthdays(month, year)
     period = download_period([year], [month], days, times)
+    return f'{period[0]}{period[1]}{period[2]}_to_{period[3]}{period[4]}{period[5]}'
 
-    period = f'{period[0]}{period[1]}{period[2]}_to_{period[3]}{period[4]}{period[5]}'
-    filename = f'download_{period}'
 
-    # Silence the output of loading the CDSAPI
-    with open(os.devnull, 'w') as fnull, contextlib.redirect_stdout(fnull), contextlib.redirect_stderr(fnull):
-        client = cdsapi.Client()
+@instrumentation.stage("download", fields=("year", "month"))
+def api_request(variables, year, month, days, times, client=None, region=None):
+    """
+    Downloads ERA5 reanalysis data for specified years, months, and variables.
 
-    variable_list = '-'.join(map(str, variables))
-    output_dir = os.path.join('.', 'era5_data', f'{variable_list}', 'downloads')
+    Parameters:
+        variables (list of str): List of variables to download data for.
+        year (str): The year to download data for.
+        month (str): The month to download data for.
+        days (list of str): List of days to download data for.
+        times (list of str): List of times to download data for.
+        client (cdsapi.Client, optional): Client to use. Defaults to the shared session client.
+        region (str or tuple, optional): Only request this area. See `regions.resolve`.
+
+    Returns:
+        str: The period that was downloaded.
+
+    The function checks if the data for the specified period already exists
+    and skips the download if it does. Otherwise, it retrieves the data from
+    the CDS API and saves it in the specified directory.
+    """
+    request = build_request(variables, year, [month], days, times, region)
+
+    period = month_period(year, month, days, times)
+    filename = f'download_{period}'
+
+    output_dir = os.path.join(paths.variable_directory(variables, region), 'downloads')
     output_filename = f'{filename}.nc'
     output_location = os.path.join(f'{output_dir}', f'{output_filename}')
 
-    file_path = pathlib.Path(f'{output_location}')
-    if file_path.exists():
+    fingerprint = request_fingerprint(DATASET, request)
+    if is_download_complete(output_dir, output_filename, fingerprint):
         print(f"Data for the period {period} has already been downloaded.")
+        instrumentation.mark("skipped", "already downloaded")
     else:
+        if pathlib.Path(output_location).exists():
+            print(f"Found an unverified file for the period {period}. Downloading it again.")
         os.makedirs(output_dir, exist_ok=True)
-        print(f'Downloading data from: {period[0]}-{period[1]}-{period[2]} to {period[3]}-{period[4]}-{period[5]}.')
-        client.retrieve(dataset, request).download(output_location)
+        print(f'Downloading data for the period {period}.')
+
+        # Download to a temporary name so an interrupted transfer never looks finished
+        client = client or get_client()
+        partial_location = f'{output_location}.part'
+        client.retrieve(DATASET, request).download(partial_location)
+        os.replace(partial_location, output_location)
+        record_download(output_dir, output_filename, fingerprint)
         print(f"Data for the period {period} has been downloaded.")
 
-    return period
\ No newline at end of file
+    return period
+
+
+@instrumentation.stage("download", fields=("year", "months"))
+def api_request_chunk(variables, year, months, client=None, region=None):
+    """
+    Downloads several months of a year in one CDS request and splits them by month.
+
+    Each month is written to the same `download_YYYYMMDD_to_YYYYMMDD.nc` file
+    and recorded in the manifest under the same fingerprint as a single-month
+    request, so the result is indistinguishable from downloading month by month.
+
+    Parameters:
+        variables (list of str): List of variables to download data for.
+        year (str): The year to download data for.
+        months (list of str): The months to download data for.
+        client (cdsapi.Client, optional): Client to use. Defaults to the shared session client.
+        region (str or tuple, optional): Only request this area. See `regions.resolve`.
+
+    Returns:
+        list: The periods that were downloaded, one per month.
+    """
+    output_dir = os.path.join(paths.variable_directory(variables, region), 'downloads')
+
+    # Work out which months still need to be fetched
+    targets = {}
+    for month in months:
+        days = monthdays(month, year)
+        period = month_period(year, month, days)
+        fingerprint = request_fingerprint(DATASET, build_request(variables, year, [month], days, TIMES, region))
+        targets[month] = (period, f'download_{period}.nc', fingerprint)
+
+    missing = [month for month in months if not is_download_complete(output_dir, targets[month][1], targets[month][2])]
+    if not missing:
+        print(f"Data for {year}-{'/'.join(months)} has already been downloaded.")
+        instrumentation.mark("skipped", "already downloaded")
+        return [targets[month][0] for month in months]
+
+    os.makedirs(output_dir, exist_ok=True)
+    print(f"Downloading data for {year}-{'/'.join(missing)} in one request.")
+
+    # Every day up to the 31st is requested; the CDS drops dates that do not exist
+    all_days = monthdays("01", year)
+    request = build_request(variables, year, missing, all_days, TIMES, region)
+    chunk_location = os.path.join(output_dir, f'chunk_{year}_{missing[0]}-{missing[-1]}.nc.part')
+    client = client or get_client()
+    client.retrieve(DATASET, request).download(chunk_location)
+
+    # Split the combined file back into monthly files
+    with xr.open_dataset(chunk_location) as data:
+        for month in missing:
+            period, output_filename, fingerprint = targets[month]
+            output_location = os.path.join(output_dir, output_filename)
+            in_month = (data["valid_time"].dt.month == int(month)).values
+            partial_location = f'{output_location}.part'
+            data.isel(valid_time=in_month).to_netcdf(partial_location)
+            os.replace(partial_location, output_location)
+            record_download(output_dir, output_filename, fingerprint)
+            print(f"Data for the period {period} has been downloaded.")
+    os.remove(chunk_location)
+
+    return [targets[month][0] for month in months]
+
+
+def request_fingerprint(dataset, request):
+    """
+    Returns a stable hash identifying a CDS request.
+
+    Parameters:
+        dataset (str): The CDS dataset name.
+        request (dict): The CDS request parameters.
+
+    Returns:
+        str: Hex digest of the dataset and request.
+    """
+    payload = json.dumps({"dataset": dataset, "request": request}, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def file_sha256(path, block_size=1 << 20):
+    """
+    Computes the SHA-256 hash of a file without loading it into memory.
+
+    Parameters:
+        path (str): Path to the file.
+        block_size (int): Number of bytes read at a time.
+
+    Returns:
+        str: Hex digest of the file contents.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_manifest(output_dir):
+    """
+    Loads the download manifest of a directory.
+
+    Parameters:
+        output_dir (str): The downloads directory.
+
+    Returns:
+        dict: Manifest entries keyed by filename. Empty if there is no manifest.
+    """
+    manifest_path = os.path.join(output_dir, MANIFEST_FILENAME)
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path) as file:
+        return json.load(file)
+
+
+def save_manifest(output_dir, manifest):
+    """
+    Writes the download manifest of a directory atomically.
+
+    Parameters:
+        output_dir (str): The downloads directory.
+        manifest (dict): Manifest entries keyed by filename.
+
+    Returns:
+        None
+    """
+    manifest_path = os.path.join(output_dir, MANIFEST_FILENAME)
+    temp_path = f'{manifest_path}.tmp'
+    with open(temp_path, 'w') as file:
+        json.dump(manifest, file, indent=2, sort_keys=True)
+    os.replace(temp_path, manifest_path)
+
+
+def record_download(output_dir, filename, fingerprint):
+    """
+    Records a finished download in the manifest.
+
+    Parameters:
+        output_dir (str): The downloads directory.
+        filename (str): Name of the downloaded file.
+        fingerprint (str): Fingerprint of the request that produced the file.
+
+    Returns:
+        dict: The manifest entry that was written.
+    """
+    path = os.path.join(output_dir, filename)
+    entry = {
+        "size": os.path.getsize(path),
+        "sha256": file_sha256(path),
+        "request": fingerprint,
+        "downloaded_at": datetime.now(timezone.utc).isoformat(timespec="seconds")
+    }
+    with _manifest_lock:
+        manifest = load_manifest(output_dir)
+        manifest[filename] = entry
+        save_manifest(output_dir, manifest)
+    artifact_cache.remember_fingerprint(path, entry["sha256"])
+    return entry
+
+
+def is_download_complete(output_dir, filename, fingerprint=None, verify_hash=False):
+    """
+    Checks whether a file is a complete download according to the manifest.
+
+    A file counts as complete only if it has a manifest entry, its size matches
+    the recorded size and, when given, the request fingerprint matches too. The
+    recorded hash of a complete file is shared with `artifact_cache`, so the
+    stages reading it never hash it again.
+    Files without an entry, such as downloads made before the manifest existed,
+    are adopted when they pass `adopt_download`; anything else is not trusted.
+
+    Parameters:
+        output_dir (str): The downloads directory.
+        filename (str): Name of the downloaded file.
+        fingerprint (str, optional): Expected request fingerprint.
+        verify_hash (bool): Whether to also re-hash the file contents.
+
+    Returns:
+        bool: True if the file can be skipped.
+    """
+    path = os.path.join(output_dir, filename)
+    with _manifest_lock:
+        entry = load_manifest(output_dir).get(filename)
+
+    if not os.path.exists(path):
+        return False
+    if entry is None:
+        return fingerprint is not None and adopt_download(output_dir, filename, fingerprint)
+    if os.path.getsize(path) != entry["size"]:
+        return False
+    if fingerprint is not None and entry["request"] != fingerprint:
+        return False
+    if verify_hash and file_sha256(path) != entry["sha256"]:
+        return False
+    # Later stages fingerprint their inputs, so they can reuse the recorded hash
+    artifact_cache.remember_fingerprint(path, entry["sha256"])
+    return True
+
+
+def adopt_download(output_dir, filename, fingerprint):
+    """
+    Records a download that has no manifest entry if it is complete.
+
+    Interrupted transfers only ever leave `.part` files, so a file under its
+    final name is accepted when it opens cleanly and holds every hour of its
+    period. It is then recorded under the given request fingerprint instead
+    of being downloaded again.
+
+    Parameters:
+        output_dir (str): The downloads directory.
+        filename (str): Name of the downloaded file, e.g. "download_20160101_to_20160131.nc".
+        fingerprint (str): Fingerprint of the request the file stands for.
+
+    Returns:
+        bool: True if the file was adopted.
+    """
+    expected = period_hours(filename)
+    if expected is None:
+        return False
+    try:
+        with xr.open_dataset(os.path.join(output_dir, filename)) as data:
+            hours = data.sizes.get("valid_time")
+    except Exception:  # truncated or not a NetCDF file
+        return False
+    if hours != expected:
+        return False
+
+    record_download(output_dir, filename, fingerprint)
+    print(f"Found a complete download without a manifest entry: {filename}. It has been recorded.")
+    return True
+
+
+def period_hours(filename):
+    """
+    Returns the number of hourly steps in the period of a file.
+
+    Also used for monthly means written before their hour count was recorded.
+
+    Parameters:
+        filename (str): Name of a file holding a period, e.g. "download_20160101_to_20160131.nc".
+
+    Returns:
+        int: Number of hours, or None if the name holds no period.
+    """
+    match = re.search(r"(\d{8})_to_(\d{8})", filename)
+    if match is None:
+        return None
+    start = datetime.strptime(match.group(1), "%Y%m%d")
+    end = datetime.strptime(match.group(2), "%Y%m%d")
+    return ((end - start).days + 1) * len(TIMES)
@@ -0,0 +1,302 @@
+# Standard libraries
+import os
+import pathlib
+
+# Third-party libraries
+import numpy as np
+from osgeo import gdal
+
+# Local Scripts
+import artifact_cache
+import instrumentation
+import parallel
+import paths
+import raster_pipeline
+import regions
+import symbology
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is optional, GDAL's PNG driver is used without it
+    Image = None
+
+SHAPEFILE_PATH = pathlib.Path("./shpfiles/world_map/ne_10m_land.shp")
+OUTPUT_SIZE = raster_pipeline.RENDER_SIZE
+BACKGROUND_COLOR = (255, 255, 255)
+OUTLINE_COLOR = (35, 35, 35)  # QGIS default outline of a simple fill symbol
+
+
+def render_maps(variables, periods, input_dir, backend="qgis", pipeline="files", keep=(), workers=1, memory_limit=None, value_range=None, resample="full", region=None):
+    """
+    Render the PNG maps of the given periods with the selected backend.
+
+    Parameters:
+        variables (list): List of variables.
+        periods (list): List of periods.
+        input_dir (str): Input directory.
+        backend (str): "qgis" renders through QGIS, "headless" renders with
+            NumPy and GDAL only and never starts QGIS.
+        pipeline (str): With the QGIS backend, "files" or "fused". The headless
+            backend always works from the NetCDF files in memory.
+        keep (tuple of str): Intermediate rasters to write to disk: "null", "res" and/or "mask".
+        workers (int): Number of worker processes rendering periods in parallel.
+        memory_limit (int, optional): With the QGIS backend, address-space limit of each worker, in bytes.
+        value_range (tuple, dict or str, optional): (minimum, maximum) of the color ramp
+            of every map, ranges keyed by variable, or "batch" to share the range of all
+            periods per variable.
+        resample (str): "full" writes the 0.018 degree raster, "canvas" resamples
+            straight onto the output image (in-memory pipelines) and "vrt" keeps
+            the resampled and masked rasters as lazily evaluated VRTs (QGIS "files" pipeline).
+        region (str or tuple, optional): The region of the run. The maps only cover
+            its area. See `regions.resolve`.
+
+    Returns:
+        None
+    """
+    if backend == "qgis":
+        import qgis_transform  # only importable where QGIS is installed
+        qgis_transform.init_qgis(variables, periods, input_dir, pipeline, keep, workers, memory_limit, value_range, resample, region)
+    elif backend == "headless":
+        render_periods(variables, periods, input_dir, keep=keep, workers=workers, value_range=value_range, resample=resample, region=region)
+    else:
+        raise ValueError(f"Unknown rendering backend: {backend}")
+
+
+def render_periods(variables, periods, input_dir, resolution=0.018, keep=(), workers=1, value_range=None, resample="full", region=None):
+    """
+    Render the PNG maps of the given periods without QGIS.
+
+    Every variable of a period gets its own map, and each NetCDF file is
+    opened once for all of its variables.
+
+    Parameters:
+        variables (list): List of variables.
+        periods (list): List of periods.
+        input_dir (str): Input directory.
+        resolution (float): The target resolution for resampling.
+        keep (tuple of str): Intermediate rasters to write to disk: "null", "res" and/or "mask".
+        workers (int): Number of worker processes rendering periods in parallel.
+        value_range (tuple, dict or str, optional): (minimum, maximum) of the color ramp
+            of every map, ranges keyed by variable, or "batch" to share the range of
+            all periods per variable. By default each map uses its own range.
+        resample (str): "full" resamples the whole grid to `resolution`, "canvas"
+            resamples straight onto the pixels of the output image.
+        region (str or tuple, optional): The region of the run. The maps only cover its area.
+
+    Returns:
+        None
+    """
+    print("Rendering maps without QGIS...")
+    directory_path = paths.variable_directory(variables, region)
+    geotiff_directory = pathlib.Path(f'{directory_path}/{input_dir}/geotiffs/')
+    png_directory = pathlib.Path(f'{directory_path}/{input_dir}/png/')
+
+    netcdf_paths = []
+    for period in periods:
+        input_path_name = paths.period_input_name(period, input_dir)
+        netcdf_paths.append((pathlib.Path(f'{directory_path}/{input_dir}/{input_path_name}.nc'), input_path_name))
+
+    if value_range == "batch":
+        value_range = batch_value_range([netcdf_path for netcdf_path, _ in netcdf_paths], variables)
+        print(f"Using the color ramp ranges {value_range} for every map.")
+
+    tasks = [
+        (netcdf_path, variables, geotiff_directory, png_directory, input_path_name, resolution, keep, value_range, resample, region)
+        for netcdf_path, input_path_name in netcdf_paths
+    ]
+    parallel.run_tasks(render_netcdf, tasks, workers, "Headless rendering", raise_on_error=True)
+
+
+def batch_value_range(netcdf_paths, variables):
+    """
+    Color ramp range of each variable covering every file of a batch.
+
+    Parameters:
+        netcdf_paths (list): Paths to the NetCDF files.
+        variables (list): List of variables.
+
+    Returns:
+        dict: (minimum, maximum) keyed by variable.
+    """
+    ranges = {variable: [] for variable in variables}
+    for netcdf_path in netcdf_paths:
+        arrays, geotransform = raster_pipeline.load_period_arrays(netcdf_path, variables)
+        for variable, values in arrays.items():
+            ranges[variable].append(raster_pipeline.value_range(values, geotransform, SHAPEFILE_PATH))
+    return {variable: raster_pipeline.combine_ranges(variable_ranges) for variable, variable_ranges in ranges.items()}
+
+
+@instrumentation.stage("render.headless", fields=("input_path_name",))
+def render_netcdf(netcdf_path, variables, geotiff_directory, png_directory, input_path_name, resolution, keep=(), value_range=None, resample="full", region=None):
+    """
+    Turn a NetCDF file into one PNG map per variable using in-memory rasters only.
+
+    Parameters:
+        netcdf_path (pathlib.Path): Path to the NetCDF file.
+        variables (list): List of variables.
+        geotiff_directory (pathlib.Path): Directory for intermediate rasters that are kept.
+        png_directory (pathlib.Path): Directory to save the output images.
+        input_path_name (str): Input path name.
+        resolution (float): The target resolution for resampling.
+        keep (tuple of str): Intermediate rasters to write to disk: "null", "res" and/or "mask".
+        value_range (tuple or dict, optional): (minimum, maximum) of the color ramp, or
+            ranges keyed by variable. Computed from the native-resolution data when not given.
+        resample (str): "full" or "canvas". See `render_periods`.
+        region (str or tuple, optional): Only draw this region. See `regions.resolve`.
+
+    Returns:
+        None
+    """
+    print(f"Rendering the maps for {input_path_name}")
+    stems = {variable: paths.variable_stem(input_path_name, variable, variables) for variable in variables}
+    bounds = regions.output_bounds(region)
+    inputs = [netcdf_path] + raster_pipeline.shapefile_files(SHAPEFILE_PATH)
+    keys = {
+        variable: artifact_cache.artifact_key(
+            "image.headless", inputs, variable=variable, resolution=resolution, resample=resample, bounds=bounds,
+            ramp=symbology.ramp_signature(input_path_name, raster_pipeline.range_for(value_range, variable), variable),
+            size=OUTPUT_SIZE
+        )
+        for variable in variables
+    }
+    # Maps made from this file with these settings are reused or restored from the cache
+    statuses = {
+        variable: artifact_cache.lookup(keys[variable], os.path.join(png_directory, f"{stems[variable]}_NULL_res.png"))
+        for variable in variables
+    }
+    pending = [variable for variable in variables if statuses[variable] is None]
+    if not pending:
+        print(f"\t\tData for the period has already been imaged.")
+        instrumentation.mark("cached" if "cached" in statuses.values() else "skipped", "outputs current or cached")
+        return
+
+    # Decode the file once for every variable still to be imaged
+    arrays, geotransform = raster_pipeline.load_period_arrays(netcdf_path, pending)
+    os.makedirs(png_directory, exist_ok=True)
+
+    for variable in pending:
+        stem = stems[variable]
+        output_png_path = os.path.join(png_directory, f"{stem}_NULL_res.png")
+        null_path = raster_pipeline.output_path(geotiff_directory, f"{stem}_NULL.tif", "null" in keep)
+        res_path = raster_pipeline.output_path(geotiff_directory, f"{stem}_NULL_res.tif", "res" in keep)
+        masked_path = raster_pipeline.output_path(geotiff_directory, f"{stem}_NULL_res_mask.tif", "mask" in keep)
+
+        values = arrays[variable]
+        variable_range = raster_pipeline.range_for(value_range, variable)
+        if variable_range is None:
+            variable_range = raster_pipeline.value_range(values, geotransform, SHAPEFILE_PATH)
+        masked_dataset = raster_pipeline.masked_raster(
+            values, geotransform, SHAPEFILE_PATH, resolution, (null_path, res_path, masked_path), resample, OUTPUT_SIZE,
+            bounds
+        )
+
+        render_dataset(masked_dataset, input_path_name, output_png_path, variable_range, variable)
+        artifact_cache.store(keys[variable], output_png_path, "image.headless")
+        masked_dataset = None
+        raster_pipeline.release([null_path, res_path, masked_path])
+        print(f"\t\tData for the period has been imaged ({variable}).")
+
+
+def render_dataset(dataset, input_path_name, output_png_path, value_range=None, variable=None, shapefile_path=SHAPEFILE_PATH, size=OUTPUT_SIZE):
+    """
+    Apply the color ramp to a masked raster and export it with the land outline as PNG.
+
+    This reproduces `qgis_transform.render_png`: the map extent is the raster
+    extent grown to the aspect ratio of the image, the raster is drawn with
+    nearest-neighbour sampling over a white background and the shapefile is
+    drawn on top as an outline with a transparent fill.
+
+    Parameters:
+        dataset (gdal.Dataset): The masked raster.
+        input_path_name (str): Input path name.
+        output_png_path (str): Path to save the output PNG file.
+        value_range (tuple, optional): (minimum, maximum) of the color ramp. Computed
+            from the raster when not given.
+        variable (str, optional): Variable shown, which selects the ramp colors.
+        shapefile_path (pathlib.Path): Path to the shapefile drawn on top.
+        size (tuple): (width, height) of the image in pixels.
+
+    Returns:
+        None
+    """
+    print("\t\tApplying symbology and exporting PNG...")
+    if value_range is None:
+        values = dataset.GetRasterBand(1).ReadAsArray()
+        value_range = raster_pipeline.value_range(values, dataset.GetGeoTransform())
+    if value_range is None:
+        print("\t\tThe raster has no valid values to render.")
+        return
+    cutoffs = symbology.color_ramp_cutoffs(input_path_name, *value_range)
+
+    width, height = size
+    extent = raster_pipeline.map_extent(raster_pipeline.dataset_bounds(dataset), size)
+    canvas = gdal.Warp(
+        "",
+        dataset,
+        format="MEM",
+        outputBounds=extent,
+        width=width,
+        height=height,
+        resampleAlg="near",
+        srcNodata=raster_pipeline.NODATA,
+        dstNodata=raster_pipeline.NODATA
+    )
+    canvas_values = canvas.GetRasterBand(1).ReadAsArray()
+    canvas_geotransform = canvas.GetGeoTransform()
+    canvas = None
+
+    # Draw the colored raster over the background
+    rgba = symbology.apply_color_ramp(canvas_values, cutoffs, raster_pipeline.NODATA, symbology.ramp_colors(variable))
+    image = np.empty((height, width, 3), dtype=np.uint8)
+    image[...] = BACKGROUND_COLOR
+    drawn = rgba[..., 3] > 0
+    image[drawn] = rgba[drawn, :3]
+
+    # Draw the land outline on top
+    land, _ = raster_pipeline.land_mask(shapefile_path, canvas_geotransform, (height, width))
+    image[outline(land)] = OUTLINE_COLOR
+
+    save_png(image, output_png_path)
+    print(f"\t\tPNG exported successfully to {output_png_path}")
+
+
+def outline(mask):
+    """
+    Return the boundary cells of a mask.
+
+    Parameters:
+        mask (numpy.ndarray): Boolean array.
+
+    Returns:
+        numpy.ndarray: Boolean array that is True on cells of the mask with a
+            neighbour outside it.
+    """
+    interior = mask.copy()
+    interior[1:, :] &= mask[:-1, :]
+    interior[:-1, :] &= mask[1:, :]
+    interior[:, 1:] &= mask[:, :-1]
+    interior[:, :-1] &= mask[:, 1:]
+    return mask & ~interior
+
+
+def save_png(image, output_png_path):
+    """
+    Save an RGB array as PNG, with Pillow if it is installed and GDAL otherwise.
+
+    Parameters:
+        image (numpy.ndarray): RGB uint8 array of shape (rows, columns, 3).
+        output_png_path (str): Path to save the output PNG file.
+
+    Returns:
+        None
+    """
+    if Image is not None:
+        Image.fromarray(image, "RGB").save(output_png_path)
+        return
+
+    height, width, bands = image.shape
+    memory = gdal.GetDriverByName("MEM").Create("", width, height, bands, gdal.GDT_Byte)
+    for band in range(bands):
+        memory.GetRasterBand(band + 1).WriteArray(image[..., band])
+    gdal.GetDriverByName("PNG").CreateCopy(output_png_path, memory)
+    memory = None
@@ -0,0 +1,296 @@
+# Standard libraries
+import os
+import sys
+import json
+import time
+import uuid
+import inspect
+import resource
+import functools
+import threading
+from datetime import datetime, timezone
+
+# Where events are appended and the run they are tagged with
+EVENTS_VARIABLE = "ERA5_EVENTS_PATH"
+RUN_VARIABLE = "ERA5_RUN_ID"
+
+# Events of the stages running on each thread, innermost last
+_active = threading.local()
+
+
+def configure(events_path, run_id=None):
+    """
+    Send the events of this process and its workers to a JSON-lines file.
+
+    Parameters:
+        events_path (str): File the events are appended to.
+        run_id (str, optional): Identifies the run in the file. A new one is
+            generated by default, so runs sharing a file can be told apart.
+
+    Returns:
+        str: The run id.
+    """
+    run_id = run_id or uuid.uuid4().hex[:12]
+    os.environ[EVENTS_VARIABLE] = str(events_path)
+    os.environ[RUN_VARIABLE] = run_id
+    return run_id
+
+
+def stage(name, fields=()):
+    """
+    Decorate a stage function so every call emits a structured event.
+
+    The event records the wall and CPU time of the call, the bytes the process
+    read and wrote meanwhile, its peak memory, and whether the call did the
+    work, skipped it (see `mark`) or failed. The "variables" and "period"
+    arguments are recorded when the function has them.
+
+    CPU time and bytes are counted for the whole process, so calls running
+    concurrently on threads (the downloads) share their numbers, peak memory
+    included. The peak is reset when an outermost stage call starts, where
+    Linux allows it, so it belongs to that call and the stages nested in it.
+    Elsewhere it is the high-water mark of the process, as "peak_rss_scope"
+    records.
+
+    Parameters:
+        name (str): Stage name, e.g. "average".
+        fields (tuple of str): Other arguments to record, e.g. ("year", "month").
+
+    Returns:
+        callable: The decorator.
+    """
+    def decorator(function):
+        signature = inspect.signature(function)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            events_path = os.environ.get(EVENTS_VARIABLE)
+            if not events_path:
+                return function(*args, **kwargs)
+
+            bound = signature.bind(*args, **kwargs)
+            event = {
+                "run": os.environ.get(RUN_VARIABLE),
+                "stage": name,
+                "function": f"{function.__module__}.{function.__name__}",
+                "start": datetime.now(timezone.utc).isoformat(),
+                "pid": os.getpid(),
+                "status": "ok"
+            }
+            for field in ("variables", "period") + tuple(fields):
+                if field in bound.arguments:
+                    event[field] = bound.arguments[field]
+
+            stack = getattr(_active, "stack", None)
+            if stack is None:
+                stack = _active.stack = []
+            if not stack:
+                event["peak_rss_scope"] = "stage" if reset_peak_rss() else "process"
+            else:
+                event["peak_rss_scope"] = stack[0]["peak_rss_scope"]
+            stack.append(event)
+            read_before, written_before = io_counters()
+            wall_start = time.perf_counter()
+            cpu_start = time.process_time()
+            try:
+                return function(*args, **kwargs)
+            except Exception as error:
+                event["status"] = "error"
+                event["error"] = f"{type(error).__name__}: {error}"
+                raise
+            finally:
+                event["wall_seconds"] = round(time.perf_counter() - wall_start, 4)
+                event["cpu_seconds"] = round(time.process_time() - cpu_start, 4)
+                read_after, written_after = io_counters()
+                if read_before is not None and read_after is not None:
+                    event["bytes_read"] = read_after - read_before
+                    event["bytes_written"] = written_after - written_before
+                event["peak_rss_mb"] = peak_rss_mb()
+                stack.pop()
+                emit(events_path, event)
+
+        return wrapper
+    return decorator
+
+
+def mark(status, reason=None):
+    """
+    Set the status of the innermost running stage on this thread, e.g. "skipped" or "cached".
+
+    Does nothing outside an instrumented stage.
+
+    Parameters:
+        status (str): The status.
+        reason (str, optional): Why, recorded with the event.
+
+    Returns:
+        None
+    """
+    stack = getattr(_active, "stack", None)
+    if stack:
+        stack[-1]["status"] = status
+        if reason is not None:
+            stack[-1]["reason"] = reason
+
+
+def skipped(name, reason, **fields):
+    """
+    Emit the event of a stage call skipped before it started, e.g. when a loop finds its output.
+
+    Parameters:
+        name (str): Stage name.
+        reason (str): Why it was skipped.
+        **fields: Values to record, such as variables and period.
+
+    Returns:
+        None
+    """
+    events_path = os.environ.get(EVENTS_VARIABLE)
+    if not events_path:
+        return
+    event = {
+        "run": os.environ.get(RUN_VARIABLE),
+        "stage": name,
+        "start": datetime.now(timezone.utc).isoformat(),
+        "pid": os.getpid(),
+        "status": "skipped",
+        "reason": reason,
+        "wall_seconds": 0.0,
+        "cpu_seconds": 0.0
+    }
+    event.update(fields)
+    emit(events_path, event)
+
+
+def io_counters():
+    """
+    Return the bytes this process has read and written so far.
+
+    Counts every read and write call, whether served from disk or the page
+    cache, as reported by /proc/self/io.
+
+    Returns:
+        tuple: (bytes read, bytes written), or (None, None) where /proc is unavailable.
+    """
+    try:
+        with open("/proc/self/io") as file:
+            counters = dict(line.split(": ") for line in file.read().splitlines())
+        return int(counters["rchar"]), int(counters["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def reset_peak_rss():
+    """
+    Reset the peak resident set size of this process to its current size.
+
+    Returns:
+        bool: True if it was reset, which needs Linux's /proc/self/clear_refs.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb():
+    """
+    Return the peak resident set size of this process since it started or
+    since `reset_peak_rss` was last called.
+
+    Returns:
+        float: Peak RSS in MB.
+    """
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 2 ** 10, 1)  # in kB
+    except (OSError, ValueError):
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    scale = 1 if sys.platform == "darwin" else 1024  # ru_maxrss is in bytes on macOS, KB on Linux
+    return round(peak * scale / 2 ** 20, 1)
+
+
+def emit(events_path, event):
+    """
+    Append one event to the JSON-lines file.
+
+    Each event is written with a single append, so lines from concurrent
+    processes do not interleave.
+
+    Parameters:
+        events_path (str): The JSON-lines file.
+        event (dict): The event.
+
+    Returns:
+        None
+    """
+    line = json.dumps(event, default=str) + "\n"
+    directory = os.path.dirname(events_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(events_path, "a") as file:
+        file.write(line)
+
+
+def load_events(events_path, run_id=None):
+    """
+    Read the events of a JSON-lines file.
+
+    Parameters:
+        events_path (str): The JSON-lines file.
+        run_id (str, optional): Only return the events of this run.
+
+    Returns:
+        list: The events.
+    """
+    if not os.path.exists(events_path):
+        return []
+    with open(events_path) as file:
+        events = [json.loads(line) for line in file if line.strip()]
+    if run_id is not None:
+        events = [event for event in events if event.get("run") == run_id]
+    return events
+
+
+def summary_table(events):
+    """
+    Print where a run spent its time, one row per stage.
+
+    Stages nest (a QGIS transform contains its resampling), so the totals of
+    an outer stage include those of the stages it calls.
+
+    Parameters:
+        events (list): Events as returned by `load_events`.
+
+    Returns:
+        None
+    """
+    if not events:
+        print("No stage events were recorded.")
+        return
+
+    rows = {}
+    for event in events:
+        row = rows.setdefault(event["stage"], {"calls": 0, "skipped": 0, "errors": 0, "wall": 0.0, "cpu": 0.0,
+                                               "read": 0, "written": 0, "peak": 0.0})
+        row["calls"] += 1
+        row["skipped"] += event["status"] in ("skipped", "cached")
+        row["errors"] += event["status"] == "error"
+        row["wall"] += event.get("wall_seconds", 0.0)
+        row["cpu"] += event.get("cpu_seconds", 0.0)
+        row["read"] += event.get("bytes_read") or 0
+        row["written"] += event.get("bytes_written") or 0
+        row["peak"] = max(row["peak"], event.get("peak_rss_mb", 0.0))
+
+    print(f"{'stage':<22}{'calls':>7}{'skipped':>9}{'errors':>8}{'wall s':>11}{'cpu s':>11}"
+          f"{'read MB':>11}{'written MB':>12}{'peak MB':>10}")
+    for stage_name, row in sorted(rows.items(), key=lambda item: -item[1]["wall"]):
+        print(f"{stage_name:<22}{row['calls']:>7}{row['skipped']:>9}{row['errors']:>8}{row['wall']:>11.1f}"
+              f"{row['cpu']:>11.1f}{row['read'] / 2 ** 20:>11.1f}{row['written'] / 2 ** 20:>12.1f}{row['peak']:>10.1f}")
+    if any(event.get("peak_rss_scope") == "process" for event in events):
+        print("Peak MB is the high-water mark of the process for some calls, as it could not be reset per stage here.")
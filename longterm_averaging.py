@@ -1,25 +1,46 @@
 # Standard libraries
 import os
+import glob
 import pathlib
 
 # Third-party libraries
 import xarray as xr
 
-def create_longterm_average(variables, months):
+# Local Scripts
+import artifact_cache
+import download
+import instrumentation
+import netcdf_encoding
+import paths
+import process
+import regions
+import zarr_store
+
+def create_longterm_average(variables, months, mode="recompute", with_variance=False, source="netcdf", region=None):
     """
     Calculate the monthly mean for specified variables in NetCDF files.
 
     Parameters:
         variables (list): List of variables to average.
         months (list): List of months to process.
+        mode (str): "recompute" averages every download from scratch, "incremental"
+            only folds new downloads into a persisted running-sum store and
+            "monthly_means" time-weights the existing monthly means.
+        with_variance (bool): In incremental mode, also track sums of squares and
+            write the long-term variance.
+        source (str): In recompute mode, "netcdf" combines the downloaded files and
+            "zarr" reads every year of the month from the Zarr stores in one slice.
+        region (str or tuple, optional): The region of the run, whose data directory is used.
+            See `regions.resolve`.
 
     Returns:
         None
     """
     # Set the IO directories and filenames
-    variable_list = '-'.join(map(str, variables)) # join the variables into a string
-    input_directory = pathlib.Path(f'./era5_data/{variable_list}/downloads/') # define the input directory
-    output_directory = pathlib.Path(f'./era5_data/{variable_list}/long-term_averages/') # define the output directory
+    directory_path = paths.variable_directory(variables, region) # the data directory of the variables and region
+    input_directory = pathlib.Path(f'{directory_path}/downloads/') # define the input directory
+    monthly_directory = pathlib.Path(f'{directory_path}/monthly_means/') # define the monthly means directory
+    output_directory = pathlib.Path(f'{directory_path}/long-term_averages/') # define the output directory
     output_filename_prefix = "lt_average" # define the output filename prefix
 
     # Loop through all files in the directory
@@ -27,50 +48,456 @@ def create_longterm_average(variables, months):
     # multi_average("", input_directory, output_directory, output_filename_prefix)
     for month in months:
         print(f"\tCalculating the long-term average for the month {month}...")
-        multi_average(month, input_directory, output_directory, output_filename_prefix)
+        if mode == "incremental":
+            incremental_average(month, variables, input_directory, output_directory, output_filename_prefix, with_variance)
+        elif mode == "monthly_means":
+            average_monthly_means(month, variables, monthly_directory, output_directory, output_filename_prefix)
+        elif source == "zarr":
+            store_average(month, variables, output_directory, output_filename_prefix, region)
+        else:
+            multi_average(month, input_directory, output_directory, output_filename_prefix, variables)
 
 
-def multi_average(month, input_directory, output_directory, output_filename_prefix):
+@instrumentation.stage("longterm", fields=("month",))
+def multi_average(month, input_directory, output_directory, output_filename_prefix, variables=None):
     """
     Calculate the monthly mean for specified variables in NetCDF files.
 
+    The output is keyed by the contents of every matching download, so a new
+    or re-fetched year, or another NetCDF encoding, recomputes it.
+
     Parameters:
         month (str): Month to process.
         input_directory (str): Directory containing the NetCDF files.
         output_directory (str): Directory to save the output NetCDF file.
         output_filename_prefix (str): Prefix for the output NetCDF file.
+        variables (list, optional): Variables to average. Defaults to every variable in the files.
 
     Returns:
         None
     """
 
-    # Define the file pattern and output file path based on the month
+    # Define the output file path based on the month
     if month == "":
-        file_pattern = os.path.join(input_directory, "*_to_*")
         output_filepath = os.path.join(output_directory, f"{output_filename_prefix}")
     else:
-        file_pattern = os.path.join(input_directory, f"download_????{month}??_to_*")
         output_filepath = os.path.join(output_directory, f"{output_filename_prefix}_{month}")
 
-    dataset = xr.open_mfdataset(file_pattern + ".nc", combine="by_coords") # open all NetCDF files to be averaged
+    in_paths = download_paths(input_directory, month)
+    if not in_paths:
+        print(f"\t\tNo downloads found for the month {month}.")
+        return
+    if variables is None:
+        with xr.open_dataset(in_paths[0]) as first:
+            variables = list(first.data_vars)
+
+    key = longterm_key(in_paths, variables, "recompute")
+    if lookup_outputs(key, output_filepath, variables, month):
+        return
+
+    dataset = xr.open_mfdataset(in_paths, combine="by_coords") # open all NetCDF files to be averaged
+    dataset = dataset[variables] # every variable is reduced in the same pass over the files
     monthly_mean = dataset.mean(dim="valid_time", skipna=True) # calculate monthly mean along the time dimension
 
     # Save the resulting dataset to a new NetCDF file
-    if pathlib.Path(output_filepath + ".nc").exists() and pathlib.Path(output_filepath + ".tif").exists():
-        print(f"\t\tData for the month {month} has already been averaged in the long-term.")
-        return
+    os.makedirs(output_directory, exist_ok=True)
+    netcdf_encoding.write_netcdf(monthly_mean, output_filepath + ".nc")
+    print(f"\t\tData for the month {month} has been averaged in the long-term.")
+
+    export_geotiff(monthly_mean, output_filepath, month)
+    store_outputs(key, output_filepath, variables)
+
+
+def download_paths(input_directory, month):
+    """
+    Downloads averaged by `multi_average` for a month.
+
+    Parameters:
+        input_directory (str): Directory containing the NetCDF files.
+        month (str): Month to match, or "" for every download.
+
+    Returns:
+        list: Sorted paths of the matching NetCDF files.
+    """
+    if month == "":
+        file_pattern = os.path.join(input_directory, "*_to_*.nc")
     else:
-        os.makedirs(output_directory, exist_ok=True)
-        monthly_mean.to_netcdf(output_filepath + ".nc")
-        print(f"\t\tData for the month {month} has been averaged in the long-term.")
+        file_pattern = os.path.join(input_directory, f"download_????{month}??_to_*.nc")
+    return sorted(glob.glob(file_pattern))
+
+
+@instrumentation.stage("longterm", fields=("month",))
+def store_average(month, variables, output_directory, output_filename_prefix, region=None):
+    """
+    Calculate the long-term mean of a month from the Zarr stores.
 
+    Every year of the month is selected from the stores at once, instead of
+    opening and combining one NetCDF file per year.
+
+    Parameters:
+        month (str): Month to process. An empty string averages everything.
+        variables (list): List of variables to average.
+        output_directory (str): Directory to save the output NetCDF file.
+        output_filename_prefix (str): Prefix for the output NetCDF file.
+        region (str or tuple, optional): The region of the run, whose stores are read.
+
+    Returns:
+        None
+    """
+    if month == "":
+        output_filepath = os.path.join(output_directory, f"{output_filename_prefix}")
+    else:
+        output_filepath = os.path.join(output_directory, f"{output_filename_prefix}_{month}")
+
+    # The stores are directories, so they are identified by the periods appended to them
+    stored = {variable: zarr_store.stored_periods(zarr_store.store_path(variables, variable, region)) for variable in variables}
+    key = longterm_key([], variables, "recompute", source="zarr", region=region, periods=stored)
+    if lookup_outputs(key, output_filepath, variables, month):
+        return
+
+    dataset = zarr_store.select_month(zarr_store.open_store(variables, region=region), month) # lazily slice the month out of every year
+    longterm_mean = dataset.mean(dim="valid_time", skipna=True).compute() # calculate the mean along the time dimension
+
+    os.makedirs(output_directory, exist_ok=True)
+    netcdf_encoding.write_netcdf(longterm_mean, output_filepath + ".nc")
+    print(f"\t\tData for the month {month} has been averaged in the long-term.")
+    export_geotiff(longterm_mean, output_filepath, month)
+    store_outputs(key, output_filepath, variables)
+
+
+def longterm_key(in_paths, variables, mode, source="netcdf", region=None, **parameters):
+    """
+    Identify a long-term average by the files and settings it is computed from.
+
+    Parameters:
+        in_paths (list): Downloads or monthly means averaged.
+        variables (list): Variables of the output.
+        mode (str): "recompute", "incremental" or "monthly_means".
+        source (str): "netcdf" or "zarr".
+        region (str or tuple, optional): The region averaged.
+        **parameters: Other settings, e.g. the periods of the Zarr stores read.
+
+    Returns:
+        str: The artifact key. See `artifact_cache.artifact_key`.
+    """
+    return artifact_cache.artifact_key(
+        "longterm", in_paths, variables=list(variables), mode=mode, source=source,
+        region=regions.resolve(region), encoding=netcdf_encoding.settings(), **parameters
+    )
+
+
+def lookup_outputs(key, output_filepath, variables, month):
+    """
+    Make the NetCDF file and GeoTIFFs of a long-term average available without recomputing them.
+
+    Parameters:
+        key (str): The artifact key.
+        output_filepath (str): Output path without extension.
+        variables (list): Variables of the output.
+        month (str): Month the average belongs to.
+
+    Returns:
+        bool: True if every output is current or was restored from the store.
+    """
+    output_paths = [output_filepath + ".nc"] + geotiff_paths(output_filepath, variables)
+    statuses = [artifact_cache.lookup(key, path) for path in output_paths]
+    if None in statuses:
+        return False
+
+    status = "current" if all(status == "current" for status in statuses) else "cached"
+    print(f"\t\tData for the month {month} has already been averaged in the long-term.")
+    instrumentation.mark("skipped" if status == "current" else "cached", f"output {status}")
+    return True
+
+
+def store_outputs(key, output_filepath, variables):
+    """
+    Record the NetCDF file and GeoTIFFs of a long-term average in the artifact store.
+
+    Parameters:
+        key (str): The artifact key.
+        output_filepath (str): Output path without extension.
+        variables (list): Variables of the output.
+
+    Returns:
+        None
+    """
+    for path in [output_filepath + ".nc"] + geotiff_paths(output_filepath, variables):
+        artifact_cache.store(key, path, "longterm")
+
+
+def export_geotiff(longterm_mean, output_filepath, month):
+    """
+    Export a long-term mean to GeoTIFF next to its NetCDF file.
+
+    Each variable gets its own GeoTIFF. With a single variable it is named after
+    the NetCDF file, otherwise the variable name is appended.
+
+    Parameters:
+        longterm_mean (xarray.Dataset): The long-term mean.
+        output_filepath (str): Output path without extension.
+        month (str): Month the mean belongs to.
+
+    Returns:
+        None
+    """
     # Conduct necessary conversions to NetCDF file to export to GeoTIFF
-    monthly_mean.coords['longitude'] = (monthly_mean.coords['longitude'] + 180) % 360 - 180 # shift the longitude values
-    monthly_mean = monthly_mean.sortby(monthly_mean.longitude) # sort the longitude values
-    variable = monthly_mean["ssrd"] # select variable to export to GeoTIFF
-    variable = variable.rio.write_crs("EPSG:4326")  # set spacial reference to WGS84
+    longterm_mean.coords['longitude'] = (longterm_mean.coords['longitude'] + 180) % 360 - 180 # shift the longitude values
+    longterm_mean = longterm_mean.sortby(longterm_mean.longitude) # sort the longitude values
 
     # Export to GeoTIFF
+    os.makedirs(os.path.dirname(output_filepath), exist_ok=True)
+    variables = list(longterm_mean.data_vars)
+    for name, geotiff_path in zip(variables, geotiff_paths(output_filepath, variables)):
+        variable = longterm_mean[name] # select variable to export to GeoTIFF
+        variable = variable.rio.write_crs("EPSG:4326")  # set spacial reference to WGS84
+        variable.rio.to_raster(geotiff_path)
+    print(f"\t\tData for the month {month} has been converted to GeoTIFF format!")
+
+
+def geotiff_paths(output_filepath, variables):
+    """
+    GeoTIFF paths of a long-term output, one per variable.
+
+    Parameters:
+        output_filepath (str): Output path without extension.
+        variables (list): Variables of the output.
+
+    Returns:
+        list: One path per variable.
+    """
+    return [f"{paths.variable_stem(output_filepath, variable, variables)}.tif" for variable in variables]
+
+
+@instrumentation.stage("longterm", fields=("month",))
+def incremental_average(month, variables, input_directory, output_directory, output_filename_prefix, with_variance=False):
+    """
+    Update the long-term average of a month from a persisted running-sum store.
+
+    The store keeps, per variable, the sum and count (and optionally the sum of
+    squares) of every hourly value seen so far, plus the periods already folded
+    in. Only downloads that are not in the store yet are read, so adding a new
+    year costs one file per month instead of the whole archive.
+
+    Parameters:
+        month (str): Month to process. An empty string covers every month.
+        variables (list): List of variables to average.
+        input_directory (pathlib.Path): Directory containing the downloaded NetCDF files.
+        output_directory (pathlib.Path): Directory to save the output files.
+        output_filename_prefix (str): Prefix for the output NetCDF file.
+        with_variance (bool): Whether to write the variance. Sums of squares are tracked
+            from the first run that asks for it and kept up to date by every later run.
+
+    Returns:
+        None
+    """
+    if month == "":
+        file_pattern = "download_*_to_*.nc"
+        output_filepath = os.path.join(output_directory, f"{output_filename_prefix}")
+        accumulator_path = pathlib.Path(output_directory) / "accumulators" / "accumulator.nc"
+        variance_filepath = os.path.join(output_directory, "lt_variance")
+    else:
+        file_pattern = f"download_????{month}??_to_*.nc"
+        output_filepath = os.path.join(output_directory, f"{output_filename_prefix}_{month}")
+        accumulator_path = pathlib.Path(output_directory) / "accumulators" / f"accumulator_{month}.nc"
+        variance_filepath = os.path.join(output_directory, f"lt_variance_{month}")
+
+    totals, periods = load_accumulator(accumulator_path)
+    has_sumsq = any(name.endswith("_sumsq") for name in totals)
+    if with_variance and periods and not has_sumsq:
+        # Sums of squares added now would only cover the new periods
+        print(f"\t\tThe long-term store for the month {month} has no sums of squares. Skipping the variance.")
+        with_variance = False
+    # Once a store has sums of squares they are kept up to date, even by runs
+    # that do not write the variance, so they always cover the same periods as the sums
+    track_sumsq = with_variance or has_sumsq
+    new_files = [
+        in_path for in_path in sorted(pathlib.Path(input_directory).glob(file_pattern))
+        if in_path.stem.split("download_")[1] not in periods
+    ]
+
+    # The store's periods stand for the downloads folded into it
+    key = longterm_key([], variables, "incremental", with_variance=with_variance,
+                       periods=sorted(periods + [in_path.stem.split("download_")[1] for in_path in new_files]))
+    if not new_files and periods and lookup_outputs(key, output_filepath, variables, month):
+        return
+    if not new_files and not periods:
+        print(f"\t\tNo downloads found for the month {month}.")
+        return
+
+    for in_path in new_files:
+        accumulate_file(totals, in_path, variables, track_sumsq)
+        periods.append(in_path.stem.split("download_")[1])
+        print(f"\t\tAdded the period {periods[-1]} to the long-term store.")
+    save_accumulator(accumulator_path, totals, periods)
+
+    longterm_mean, longterm_variance = finalize_accumulator(totals, variables, with_variance)
+    os.makedirs(output_directory, exist_ok=True)
+    netcdf_encoding.write_netcdf(longterm_mean, output_filepath + ".nc")
+    if longterm_variance is not None:
+        netcdf_encoding.write_netcdf(longterm_variance, variance_filepath + ".nc")
+    print(f"\t\tData for the month {month} has been averaged in the long-term.")
+
+    export_geotiff(longterm_mean, output_filepath, month)
+    store_outputs(key, output_filepath, variables)
+
+
+def load_accumulator(accumulator_path):
+    """
+    Load a running-sum store.
+
+    Parameters:
+        accumulator_path (pathlib.Path): Path to the store.
+
+    Returns:
+        tuple: (totals, periods), where totals maps "<variable>_sum", "<variable>_count"
+            and "<variable>_sumsq" to arrays and periods lists the periods folded in.
+            Both are empty if the store does not exist yet.
+    """
+    if not accumulator_path.exists():
+        return {}, []
+
+    store = xr.load_dataset(accumulator_path)
+    periods = [period for period in store.attrs.get("periods", "").split(",") if period]
+    return {name: store[name] for name in store.data_vars}, periods
+
+
+def save_accumulator(accumulator_path, totals, periods):
+    """
+    Write a running-sum store atomically.
+
+    Parameters:
+        accumulator_path (pathlib.Path): Path to the store.
+        totals (dict): Running sums, counts and sums of squares.
+        periods (list): Periods folded into the store.
+
+    Returns:
+        None
+    """
+    os.makedirs(accumulator_path.parent, exist_ok=True)
+    store = xr.Dataset(totals)
+    store.attrs["periods"] = ",".join(periods)
+    temp_path = accumulator_path.with_suffix(".tmp")
+    netcdf_encoding.write_netcdf(store, temp_path, packing="none")  # the running sums must stay exact
+    os.replace(temp_path, accumulator_path)
+
+
+def accumulate_file(totals, in_path, variables, with_variance=False, chunk_size=24):
+    """
+    Fold the hourly values of one download into the running sums.
+
+    Parameters:
+        totals (dict): Running sums, counts and sums of squares. Updated in place.
+        in_path (pathlib.Path): Path to the downloaded NetCDF file.
+        variables (list): List of variables to accumulate.
+        with_variance (bool): Whether to also accumulate sums of squares.
+        chunk_size (int): Number of time steps read at a time.
+
+    Returns:
+        None
+    """
+    with xr.open_dataset(in_path) as data:
+        for chunk in process.iter_time_chunks(data, variables, chunk_size):
+            for variable in variables:
+                values = chunk[variable].astype("float64")
+                parts = {
+                    f"{variable}_sum": values.sum(dim="valid_time", skipna=True),
+                    f"{variable}_count": values.notnull().sum(dim="valid_time"),
+                }
+                if with_variance:
+                    parts[f"{variable}_sumsq"] = (values ** 2).sum(dim="valid_time", skipna=True)
+
+                for name, part in parts.items():
+                    totals[name] = totals[name] + part if name in totals else part
+
+
+def finalize_accumulator(totals, variables, with_variance=False):
+    """
+    Derive the long-term mean (and variance) from the running sums.
+
+    Parameters:
+        totals (dict): Running sums, counts and sums of squares.
+        variables (list): List of variables to derive.
+        with_variance (bool): Whether to also derive the variance.
+
+    Returns:
+        tuple: (mean, variance) datasets. variance is None unless requested
+            and sums of squares are available.
+    """
+    means = {}
+    variances = {}
+    for variable in variables:
+        count = totals[f"{variable}_count"]
+        count = count.where(count > 0)
+        mean = totals[f"{variable}_sum"] / count
+        means[variable] = mean.astype("float32")
+        if with_variance and f"{variable}_sumsq" in totals:
+            variance = totals[f"{variable}_sumsq"] / count - mean ** 2
+            variances[variable] = variance.clip(min=0).astype("float32")
+
+    variance = xr.Dataset(variances) if variances else None
+    return xr.Dataset(means), variance
+
+
+@instrumentation.stage("longterm", fields=("month",))
+def average_monthly_means(month, variables, monthly_directory, output_directory, output_filename_prefix):
+    """
+    Calculate the long-term average of a month from the existing monthly means.
+
+    Each monthly mean is weighted by the number of hours it covers, which gives
+    the same result as averaging the hourly downloads while reading files that
+    are several hundred times smaller.
+
+    Parameters:
+        month (str): Month to process. An empty string covers every month.
+        variables (list): List of variables to average.
+        monthly_directory (pathlib.Path): Directory containing the mean_*.nc files.
+        output_directory (pathlib.Path): Directory to save the output files.
+        output_filename_prefix (str): Prefix for the output NetCDF file.
+
+    Returns:
+        None
+    """
+    if month == "":
+        file_pattern = "mean_*_to_*.nc"
+        output_filepath = os.path.join(output_directory, f"{output_filename_prefix}")
+    else:
+        file_pattern = f"mean_????{month}??_to_*.nc"
+        output_filepath = os.path.join(output_directory, f"{output_filename_prefix}_{month}")
+
+    mean_paths = sorted(pathlib.Path(monthly_directory).glob(file_pattern))
+    if not mean_paths:
+        print(f"\t\tNo monthly means found for the month {month}.")
+        return
+
+    key = longterm_key(mean_paths, variables, "monthly_means")
+    if lookup_outputs(key, output_filepath, variables, month):
+        return
+
+    weighted_sums = {}
+    weights = {}
+    for mean_path in mean_paths:
+        with xr.open_dataset(mean_path) as monthly_mean:
+            hours = monthly_mean.attrs.get("hour_count") or download.period_hours(mean_path.stem)
+            for variable in variables:
+                values = monthly_mean[variable].astype("float64")
+                weighted = (values * hours).fillna(0)
+                weight = values.notnull() * hours
+                if variable in weighted_sums:
+                    weighted_sums[variable] = weighted_sums[variable] + weighted
+                    weights[variable] = weights[variable] + weight
+                else:
+                    weighted_sums[variable] = weighted
+                    weights[variable] = weight
+
+    longterm_mean = xr.Dataset({
+        variable: (weighted_sums[variable] / weights[variable].where(weights[variable] > 0)).astype("float32")
+        for variable in variables
+    })
+
     os.makedirs(output_directory, exist_ok=True)
-    variable.rio.to_raster(output_filepath + ".tif")
-    print(f"\t\tData for the month {month} has been converted to GeoTIFF format!")
\ No newline at end of file
+    netcdf_encoding.write_netcdf(longterm_mean, output_filepath + ".nc")
+    print(f"\t\tData for the month {month} has been averaged in the long-term from {len(mean_paths)} monthly means.")
+
+    export_geotiff(longterm_mean, output_filepath, month)
+    store_outputs(key, output_filepath, variables)
@@ -0,0 +1,173 @@
+# Standard libraries
+import os
+
+# Third-party libraries
+import numpy as np
+
+# The output encoding is read from the environment so worker processes,
+# forked or spawned, write with the same settings as the parent.
+COMPRESSION_VARIABLE = "ERA5_NC_COMPRESSION"  # "zlib", "zstd" or "none"
+LEVEL_VARIABLE = "ERA5_NC_LEVEL"  # 1-9 for zlib, 1-22 for zstd
+PACKING_VARIABLE = "ERA5_NC_PACKING"  # "float32", "int16" or "none"
+
+DEFAULT_COMPRESSION = "zlib"
+DEFAULT_LEVEL = 4
+DEFAULT_PACKING = "float32"
+
+# Dimensions read whole by every downstream stage: a map is always read in one piece
+SPATIAL_DIMS = ("latitude", "longitude")
+
+INT16_FILL = -32768  # reserved for missing values, the packed data uses -32767..32767
+
+
+def configure(compression=None, level=None, packing=None):
+    """
+    Set the encoding used by every NetCDF writer of the pipeline.
+
+    Parameters:
+        compression (str, optional): "zlib", "zstd" (needs a netCDF-C build with
+            zstd support) or "none".
+        level (int, optional): Compression level.
+        packing (str, optional): "float32" stores floats as float32, "int16" packs
+            them into scaled 16-bit integers (lossy, half the size) and "none"
+            keeps the data type of the data.
+
+    Returns:
+        None
+    """
+    if compression is not None:
+        os.environ[COMPRESSION_VARIABLE] = compression
+    if level is not None:
+        os.environ[LEVEL_VARIABLE] = str(level)
+    if packing is not None:
+        os.environ[PACKING_VARIABLE] = packing
+
+
+def settings():
+    """
+    Return the configured encoding settings.
+
+    Returns:
+        tuple: (compression, level, packing).
+    """
+    compression = os.environ.get(COMPRESSION_VARIABLE, DEFAULT_COMPRESSION)
+    level = int(os.environ.get(LEVEL_VARIABLE, DEFAULT_LEVEL))
+    packing = os.environ.get(PACKING_VARIABLE, DEFAULT_PACKING)
+    return compression, level, packing
+
+
+def write_netcdf(dataset, path, compression=None, level=None, packing=None):
+    """
+    Write a dataset to NetCDF with the configured compression, packing and chunking.
+
+    Parameters:
+        dataset (xarray.Dataset or xarray.DataArray): The data to write.
+        path (str or pathlib.Path): Output path.
+        compression (str, optional): Overrides the configured compression.
+        level (int, optional): Overrides the configured compression level.
+        packing (str, optional): Overrides the configured packing, e.g. "none"
+            for running sums that must stay exact.
+
+    Returns:
+        None
+    """
+    if not hasattr(dataset, "data_vars"):
+        dataset = dataset.to_dataset(name=dataset.name or "data")
+
+    configured = settings()
+    compression = configured[0] if compression is None else compression
+    level = configured[1] if level is None else level
+    packing = configured[2] if packing is None else packing
+
+    # Start from a clean slate: encodings inherited from the source files, such as
+    # the download's per-month scale factor, must not leak into the outputs
+    dataset = dataset.copy()
+    for name in dataset.data_vars:
+        dataset[name].encoding = {}
+
+    encoding = {
+        name: variable_encoding(dataset[name], compression, level, packing)
+        for name in dataset.data_vars
+    }
+    dataset.to_netcdf(path, engine="netcdf4", encoding=encoding)
+
+
+def variable_encoding(variable, compression, level, packing):
+    """
+    Build the NetCDF encoding of one variable.
+
+    Parameters:
+        variable (xarray.DataArray): The variable.
+        compression (str): "zlib", "zstd" or "none".
+        level (int): Compression level.
+        packing (str): "float32", "int16" or "none".
+
+    Returns:
+        dict: The encoding, as accepted by `xarray.Dataset.to_netcdf`.
+    """
+    encoding = {}
+    if np.issubdtype(variable.dtype, np.floating):
+        if packing == "float32":
+            encoding["dtype"] = "float32"
+        elif packing == "int16":
+            encoding.update(int16_packing(variable))
+        elif packing != "none":
+            raise ValueError(f"Unknown packing: {packing}")
+
+    if variable.ndim == 0:
+        return encoding  # scalars cannot be chunked or compressed
+
+    if compression == "zlib":
+        encoding.update({"zlib": True, "complevel": level, "shuffle": True})
+    elif compression == "zstd":
+        encoding.update({"compression": "zstd", "complevel": level, "shuffle": True})
+    elif compression != "none":
+        raise ValueError(f"Unknown compression: {compression}")
+
+    if compression != "none":
+        encoding["chunksizes"] = chunk_shape(variable)
+    return encoding
+
+
+def int16_packing(variable):
+    """
+    Work out the scale factor and offset packing a variable into 16-bit integers.
+
+    The full range of the data is spread over -32767..32767, so the packing
+    error is at most half of (maximum - minimum) / 65534.
+
+    Parameters:
+        variable (xarray.DataArray): The variable.
+
+    Returns:
+        dict: The dtype, scale_factor, add_offset and _FillValue encoding, or
+            float32 when the variable holds no valid data.
+    """
+    minimum = float(variable.min(skipna=True))
+    maximum = float(variable.max(skipna=True))
+    if not np.isfinite(minimum) or not np.isfinite(maximum):
+        return {"dtype": "float32"}
+
+    scale_factor = (maximum - minimum) / 65534 or 1.0
+    add_offset = (maximum + minimum) / 2
+    return {"dtype": "int16", "scale_factor": scale_factor, "add_offset": add_offset, "_FillValue": INT16_FILL}
+
+
+def chunk_shape(variable):
+    """
+    Chunk shape matching how the pipeline reads a variable.
+
+    Maps are read whole, so every chunk holds one full latitude/longitude
+    plane: one map of a stack of periods, or one hour of hourly data, which
+    any number of time steps read at once lines up with.
+
+    Parameters:
+        variable (xarray.DataArray): The variable.
+
+    Returns:
+        tuple: Chunk size of each dimension.
+    """
+    chunks = []
+    for dim, size in zip(variable.dims, variable.shape):
+        chunks.append(max(1, size) if dim in SPATIAL_DIMS else 1)
+    return tuple(chunks)
@@ -0,0 +1,85 @@
+# Standard libraries
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+
+def run_tasks(function, tasks, workers=1, description="tasks", initializer=None, initargs=(), raise_on_error=False):
+    """
+    Run independent tasks, optionally spread over a pool of worker processes.
+
+    A task that raises does not stop the others. Its traceback is captured and
+    reported in the summary printed once every task has finished, after which
+    a RuntimeError is raised if `raise_on_error` is set.
+
+    Parameters:
+        function (callable): Module-level function, called as `function(*task)`.
+        tasks (list of tuple): Arguments of each task.
+        workers (int): Number of worker processes. 1 runs the tasks in this process.
+        description (str): Name of the stage, used in the summary.
+        initializer (callable, optional): Called once in each worker process
+            before it runs any task, e.g. to set up expensive per-process state.
+        initargs (tuple): Arguments of `initializer`.
+        raise_on_error (bool): Raise once every task has finished if any of them failed.
+
+    Returns:
+        list: One (task, result, error) tuple per task, in task order. `error`
+            is None for tasks that succeeded.
+    """
+    outcomes = [None] * len(tasks)
+
+    if workers <= 1:
+        if initializer is not None and tasks:
+            initializer(*initargs)
+        for index, task in enumerate(tasks):
+            outcomes[index] = run_task(function, task)
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs) as executor:
+            futures = {executor.submit(run_task, function, task): index for index, task in enumerate(tasks)}
+            for future in as_completed(futures):
+                outcomes[futures[future]] = future.result()
+
+    results = [(task, result, error) for task, (result, error) in zip(tasks, outcomes)]
+    summarize(results, description)
+
+    failed = sum(error is not None for _, _, error in results)
+    if raise_on_error and failed:
+        raise RuntimeError(f"{description}: {failed} of {len(results)} tasks failed.")
+    return results
+
+
+def run_task(function, task):
+    """
+    Run one task and capture its result or error.
+
+    Parameters:
+        function (callable): The function to call.
+        task (tuple): Arguments to call it with.
+
+    Returns:
+        tuple: (result, error), where error is a formatted traceback or None.
+    """
+    try:
+        return function(*task), None
+    except Exception:
+        return None, traceback.format_exc()
+
+
+def summarize(results, description="tasks"):
+    """
+    Print a summary of finished tasks.
+
+    Parameters:
+        results (list): (task, result, error) tuples as returned by `run_tasks`.
+        description (str): Name of the stage.
+
+    Returns:
+        None
+    """
+    if not results:
+        return
+
+    failures = [(task, error) for task, _, error in results if error is not None]
+    print(f"{description}: {len(results) - len(failures)} of {len(results)} tasks succeeded.")
+    for task, error in failures:
+        print(f"\tFailed task {task}:")
+        print("\t\t" + error.strip().replace("\n", "\n\t\t"))
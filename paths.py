@@ -0,0 +1,67 @@
+# Standard libraries
+import pathlib
+
+# Local Scripts
+import regions
+
+
+def variable_directory(variables, region=None):
+    """
+    Return the data directory of a set of variables.
+
+    Every region gets its own directory, so regional and global data never
+    share downloads, means or maps. The global directory keeps its historical name.
+
+    Parameters:
+        variables (list): List of variables.
+        region (str or tuple, optional): The region. See `regions.resolve`.
+
+    Returns:
+        pathlib.Path: e.g. ./era5_data/ssrd-t2m or ./era5_data/ssrd-t2m_europe
+    """
+    variable_list = '-'.join(map(str, variables))
+    name = regions.region_name(region)
+    if name is not None:
+        variable_list = f"{variable_list}_{name}"
+    return pathlib.Path(f'./era5_data/{variable_list}')
+
+
+def period_input_name(period, input_dir):
+    """
+    Return the file stem used for a period in an input directory.
+
+    Parameters:
+        period (str): The period.
+        input_dir (str): "monthly_means" or "monthly_anomalies".
+
+    Returns:
+        str: The file stem, e.g. "mean_20160101_to_20160131".
+    """
+    month = period[4:6]
+    if (month == "") or (input_dir == "monthly_means"):
+        input_path_suffix = f"{period}"
+    else:
+        input_path_suffix = f"month{month}_{period}"
+
+    if input_dir == "monthly_anomalies":
+        return f"anomaly_{input_path_suffix}"
+    return f"mean_{input_path_suffix}"
+
+
+def variable_stem(input_path_name, variable, variables):
+    """
+    Return the file stem of one variable's raster or image.
+
+    Single-variable runs keep the historical names, so existing outputs stay valid.
+
+    Parameters:
+        input_path_name (str): File stem of the period, e.g. "mean_20160101_to_20160131".
+        variable (str): The variable.
+        variables (list): All variables of the run.
+
+    Returns:
+        str: e.g. "mean_20160101_to_20160131" or "mean_20160101_to_20160131_t2m".
+    """
+    if len(variables) == 1:
+        return input_path_name
+    return f"{input_path_name}_{variable}"
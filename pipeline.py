@@ -0,0 +1,535 @@
+# Standard libraries
+import os
+import pathlib
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+# Local Scripts
+import anomaly_calc
+import artifact_cache
+import convert
+import download
+import headless_render
+import longterm_averaging
+import netcdf_encoding
+import parallel
+import paths
+import process
+import raster_pipeline
+import tiles
+
+STAGES = ("download", "average", "convert", "render", "longterm", "anomaly", "anomaly_convert", "anomaly_render", "tiles", "anomaly_tiles")
+
+
+def build_graph(variables, years, months, backend="qgis", pipeline="files", anomalies=False, average_mode="eager", resolution=0.018, region=None,
+                statistics=("mean",), export_tiles=False):
+    """
+    Build the task graph of a run.
+
+    Every task is keyed by (variable list, period, stage) and only depends on
+    the tasks whose outputs it reads, so the stages of one period can run while
+    other periods are still downloading.
+
+    Parameters:
+        variables (list): List of variables.
+        years (list): List of years.
+        months (list): List of months.
+        backend (str): "qgis" or "headless". See `headless_render.render_maps`.
+        pipeline (str): With the QGIS backend, "files" renders from the converted
+            GeoTIFFs and "fused" straight from the NetCDF files.
+        anomalies (bool): Also compute the long-term averages and the anomalies,
+            and convert and render the anomalies.
+        average_mode (str): "eager", "stream" or "dask". See `process.average_netcdfs`.
+        resolution (float): The target resolution of the rendered maps.
+        region (str or tuple, optional): Only download, process and draw this area.
+            See `regions.resolve`.
+        statistics (tuple of str): Statistics written with each monthly mean. See
+            `process.monthly_statistics`.
+        export_tiles (bool): Also export a COG and an XYZ tile pyramid of every
+            monthly mean, and of every anomaly with `anomalies`. See `tiles.export_tiles`.
+
+    Returns:
+        dict: Tasks keyed by (variable list, period, stage), in dependency order.
+            Each task is a dict with the function to call and its arguments, the
+            keys of the tasks it needs, the files it reads and writes, and the
+            pool it runs on.
+    """
+    variable_list = '-'.join(map(str, variables))
+    directory_path = paths.variable_directory(variables, region)
+    download_directory = directory_path / "downloads"
+    monthly_directory = directory_path / "monthly_means"
+    longterm_directory = directory_path / "long-term_averages"
+    anomaly_directory = directory_path / "monthly_anomalies"
+
+    graph = {}
+    periods_by_month = {}
+    for year in years:
+        for month in months:
+            period = download.month_period(year, month, download.monthdays(month, year))
+            periods_by_month.setdefault(month, []).append(period)
+
+            download_path = download_directory / f"download_{period}.nc"
+            request = download.build_request(variables, year, [month], download.monthdays(month, year), download.TIMES, region)
+            fingerprint = download.request_fingerprint(download.DATASET, request)
+            graph[(variable_list, period, "download")] = task(
+                download.download_months, (variables, year, (month,), 3, 60, region),
+                outputs=[download_path], pool="download",
+                check=(download.is_download_complete, (str(download_directory), download_path.name, fingerprint))
+            )
+
+            mean_path = monthly_directory / f"mean_{period}.nc"
+            graph[(variable_list, period, "average")] = task(
+                process.average_period, (download_path, mean_path, period, variables, average_mode, None, None, "netcdf", region,
+                                         tuple(statistics)),
+                needs=[(variable_list, period, "download")], inputs=[download_path], outputs=[mean_path], encoded=True
+            )
+            add_map_tasks(graph, variables, period, "monthly_means", (variable_list, period, "average"), backend, pipeline, resolution,
+                          region, export_tiles)
+
+    if not anomalies:
+        return graph
+
+    for month, month_periods in periods_by_month.items():
+        longterm_key = (variable_list, f"month{month}", "longterm")
+        longterm_path = longterm_directory / f"lt_average_{month}"
+        # The average covers every download of the month on disk, not only this run's years
+        download_paths = {download_directory / f"download_{period}.nc" for period in month_periods}
+        download_paths.update(map(pathlib.Path, longterm_averaging.download_paths(download_directory, month)))
+        graph[longterm_key] = task(
+            longterm_averaging.multi_average, (month, download_directory, longterm_directory, "lt_average", variables),
+            needs=[(variable_list, period, "download") for period in month_periods], inputs=sorted(download_paths),
+            outputs=[pathlib.Path(f"{longterm_path}.nc")],
+            scratch=[pathlib.Path(path) for path in longterm_averaging.geotiff_paths(str(longterm_path), variables)],
+            encoded=True
+        )
+
+        for period in month_periods:
+            anomaly_path = anomaly_directory / f"{paths.period_input_name(period, 'monthly_anomalies')}.nc"
+            graph[(variable_list, period, "anomaly")] = task(
+                anomaly_calc.batch_anomaly, ([period], longterm_directory, monthly_directory, anomaly_directory, False, variables),
+                needs=[longterm_key, (variable_list, period, "average")],
+                inputs=[pathlib.Path(f"{longterm_path}.nc"), monthly_directory / f"mean_{period}.nc"], outputs=[anomaly_path],
+                encoded=True
+            )
+            add_map_tasks(graph, variables, period, "monthly_anomalies", (variable_list, period, "anomaly"), backend, pipeline,
+                          resolution, region, export_tiles)
+
+    return graph
+
+
+def task(function, args, needs=(), inputs=(), outputs=(), scratch=(), pool="compute", check=None, encoded=False):
+    """
+    Describe one task of the graph.
+
+    Parameters:
+        function (callable): Module-level function, called as `function(*args)`.
+        args (tuple): Arguments of the function.
+        needs (list): Keys of the tasks that must finish first.
+        inputs (list of pathlib.Path): Files the task reads. Their contents decide
+            whether the task is up to date.
+        outputs (list of pathlib.Path): Files the task must write.
+        scratch (list of pathlib.Path): Other files the task may write, removed
+            with the outputs before the task is rerun.
+        pool (str): "download" (threads), "compute" or "qgis" (processes).
+        check (tuple, optional): (function, args) deciding on its own whether the
+            outputs are current, e.g. the download manifest. Such outputs are
+            only removed before a forced rebuild.
+        encoded (bool): The task writes NetCDF files with the configured encoding,
+            which then belongs to its fingerprint. See `netcdf_encoding.configure`.
+
+    Returns:
+        dict: The task.
+    """
+    return {
+        "function": function,
+        "args": args,
+        "needs": list(needs),
+        "inputs": list(inputs),
+        "outputs": list(outputs),
+        "scratch": list(scratch),
+        "pool": pool,
+        "check": check,
+        "encoded": encoded
+    }
+
+
+def add_map_tasks(graph, variables, period, input_dir, source_key, backend, pipeline, resolution, region=None, export_tiles=False):
+    """
+    Add the GeoTIFF conversion and rendering tasks of one period's NetCDF file.
+
+    Parameters:
+        graph (dict): The task graph to extend.
+        variables (list): List of variables.
+        period (str): The period.
+        input_dir (str): "monthly_means" or "monthly_anomalies".
+        source_key (tuple): Key of the task writing the NetCDF file.
+        backend (str): "qgis" or "headless".
+        pipeline (str): "files" or "fused".
+        resolution (float): The target resolution of the rendered maps.
+        region (str or tuple, optional): The region of the run.
+        export_tiles (bool): Also add the task exporting the COGs and tile pyramids.
+
+    Returns:
+        None
+    """
+    variable_list = source_key[0]
+    prefix = "anomaly_" if input_dir == "monthly_anomalies" else ""
+    directory_path = paths.variable_directory(variables, region) / input_dir
+    geotiff_directory = directory_path / "geotiffs"
+    png_directory = directory_path / "png"
+    input_path_name = paths.period_input_name(period, input_dir)
+    netcdf_path = directory_path / f"{input_path_name}.nc"
+    stems = [paths.variable_stem(input_path_name, variable, variables) for variable in variables]
+
+    convert_key = (variable_list, period, f"{prefix}convert")
+    geotiff_paths = [geotiff_directory / f"{stem}.tif" for stem in stems]
+    graph[convert_key] = task(
+        convert.convert_file, (netcdf_path, list(zip(variables, geotiff_paths)), region),
+        needs=[source_key], inputs=[netcdf_path], outputs=geotiff_paths
+    )
+
+    png_paths = [png_directory / f"{stem}_NULL_res.png" for stem in stems]
+    render_key = (variable_list, period, f"{prefix}render")
+    if backend == "headless":
+        graph[render_key] = task(
+            headless_render.render_netcdf, (netcdf_path, variables, geotiff_directory, png_directory, input_path_name, resolution,
+                                            (), None, "full", region),
+            needs=[source_key], inputs=[netcdf_path], outputs=png_paths
+        )
+    elif pipeline == "fused":
+        import qgis_transform  # only importable where QGIS is installed
+        graph[render_key] = task(
+            qgis_transform.transform_period, (variables, period, input_dir, "fused", (), None, "full", region),
+            needs=[source_key], inputs=[netcdf_path], outputs=png_paths, pool="qgis"
+        )
+    else:
+        import qgis_transform  # only importable where QGIS is installed
+        # The files pipeline leaves its intermediate rasters next to the GeoTIFFs
+        scratch = [
+            geotiff_directory / f"{stem}{suffix}"
+            for stem in stems
+            for suffix in ("_NULL.tif", "_NULL.vrt", "_NULL_res.tif", "_NULL_res.vrt", "_NULL_res_mask.tif")
+        ]
+        graph[render_key] = task(
+            qgis_transform.transform_period, (variables, period, input_dir, "files", (), None, "full", region),
+            needs=[convert_key], inputs=geotiff_paths, outputs=png_paths, scratch=scratch, pool="qgis"
+        )
+
+    if export_tiles:
+        # The pyramids are directories, so the COG written with each one stands for it
+        cog_paths = [directory_path / "cog" / f"{stem}.tif" for stem in stems]
+        shapefile_paths = [pathlib.Path(path) for path in raster_pipeline.shapefile_files(headless_render.SHAPEFILE_PATH)]
+        graph[(variable_list, period, f"{prefix}tiles")] = task(
+            tiles.export_tiles, (variables, [period], input_dir, "0-7", resolution, None, region),
+            needs=[source_key], inputs=[netcdf_path] + shapefile_paths, outputs=cog_paths
+        )
+
+
+def task_id(key):
+    """
+    Name of a task in messages.
+
+    Parameters:
+        key (tuple): (variable list, period, stage).
+
+    Returns:
+        str: e.g. "20160101_to_20160131/average".
+    """
+    return f"{key[1]}/{key[2]}"
+
+
+def task_fingerprint(task):
+    """
+    Identify the work a task would do: its function, arguments, input contents
+    and, for tasks writing NetCDF files, the configured encoding.
+
+    The fingerprint is an artifact key, and the outputs of a finished task are
+    recorded under it in the artifact store, so the stages and the graph share
+    one record of what every output was made from. Input hashes come from the
+    persistent memo of `artifact_cache`, which the download manifest seeds.
+
+    Parameters:
+        task (dict): The task.
+
+    Returns:
+        str: The artifact key, or None if an input is missing.
+    """
+    if not all(os.path.exists(path) for path in task["inputs"]):
+        return None
+    function = task["function"]
+    return artifact_cache.artifact_key(
+        f"task.{function.__module__}.{function.__name__}", task["inputs"],
+        args=task["args"], encoding=netcdf_encoding.settings() if task["encoded"] else None
+    )
+
+
+def is_up_to_date(task, fingerprint):
+    """
+    Check whether a task's outputs exist and were built from its current inputs.
+
+    Parameters:
+        task (dict): The task.
+        fingerprint (str): Current fingerprint of the task.
+
+    Returns:
+        bool: True if the task does not need to run.
+    """
+    if task["check"] is not None:
+        function, args = task["check"]
+        return function(*args)
+    if fingerprint is None:
+        return False
+    return all(artifact_cache.is_current(fingerprint, path) for path in task["outputs"])
+
+
+def select_tasks(graph, rebuild=(), from_stage="average"):
+    """
+    Restrict the graph to targeted periods and work out which tasks to force.
+
+    Parameters:
+        graph (dict): The task graph.
+        rebuild (list): Periods (or "monthMM" for long-term averages) to rebuild.
+            When empty, the whole graph is kept and nothing is forced.
+        from_stage (str): Stage of the targeted periods to rebuild from. Every
+            task of those periods depending on it is rebuilt as well.
+
+    Returns:
+        tuple: (graph, forced), the pruned graph and the set of forced task keys.
+    """
+    if not rebuild:
+        return graph, set()
+
+    # Keep the targeted tasks and everything they need
+    keep = set()
+    pending = [key for key in graph if key[1] in rebuild]
+    while pending:
+        key = pending.pop()
+        if key not in keep:
+            keep.add(key)
+            pending.extend(graph[key]["needs"])
+    pruned = {key: graph[key] for key in graph if key in keep}
+
+    # Force the starting stage and every targeted task downstream of it
+    forced = set()
+    for key, current in pruned.items():
+        if key[1] not in rebuild:
+            continue
+        if key[2].endswith(from_stage) or any(need in forced for need in current["needs"]):
+            forced.add(key)
+    return pruned, forced
+
+
+def plan(graph, forced=()):
+    """
+    Work out which tasks a run would execute, without running anything.
+
+    A task runs if it is forced, if a task it needs runs, or if it is not up
+    to date with its inputs.
+
+    Parameters:
+        graph (dict): The task graph, in dependency order.
+        forced (set): Keys of the tasks to run regardless.
+
+    Returns:
+        list: Keys of the tasks that would run, in dependency order.
+    """
+    with ThreadPoolExecutor() as executor:
+        fingerprints = dict(zip(graph, executor.map(task_fingerprint, graph.values())))
+
+    stale = set()
+    for key, current in graph.items():
+        if key in forced or any(need in stale for need in current["needs"]):
+            stale.add(key)
+        elif not is_up_to_date(current, fingerprints[key]):
+            stale.add(key)
+    return [key for key in graph if key in stale]
+
+
+def assess(task, key, forced):
+    """
+    Fingerprint a task and check whether it must run, off the scheduler thread.
+
+    Parameters:
+        task (dict): The task.
+        key (tuple): Key of the task.
+        forced (set): Keys of the tasks to run regardless.
+
+    Returns:
+        tuple: (fingerprint, up to date).
+    """
+    fingerprint = task_fingerprint(task)
+    return fingerprint, key not in forced and is_up_to_date(task, fingerprint)
+
+
+def run_graph(graph, jobs=1, max_in_flight=4, dry_run=False, rebuild=(), from_stage="average", memory_limit=None):
+    """
+    Run a task graph, starting every task as soon as the tasks it needs have finished.
+
+    Downloads run on a thread pool, everything else on pools of `jobs` worker
+    processes. Inputs are fingerprinted on a thread pool too, so the scheduler
+    keeps starting tasks meanwhile. Tasks that are up to date with their inputs
+    are skipped, and a failed task only stops the tasks that depend on it. A
+    worker process that dies, e.g. on a QGIS crash or its memory limit, breaks
+    its pool, which is started again. The tasks the pool was running are
+    retried once, since only one of them caused it, and fail the second time.
+
+    Parameters:
+        graph (dict): The task graph, as built by `build_graph`.
+        jobs (int): Number of worker processes per pool.
+        max_in_flight (int): Maximum number of CDS requests running at once.
+        dry_run (bool): Only print the tasks that would run.
+        rebuild (list): Periods to rebuild. See `select_tasks`.
+        from_stage (str): Stage of the targeted periods to rebuild from.
+        memory_limit (int, optional): Address-space limit of each QGIS worker, in bytes.
+
+    Returns:
+        int: Number of tasks that failed.
+    """
+    graph, forced = select_tasks(graph, rebuild, from_stage)
+    if rebuild and not graph:
+        print(f"No tasks match the periods {', '.join(rebuild)}.")
+        return 0
+
+    if dry_run:
+        stale = plan(graph, forced)
+        print(f"{len(stale)} of {len(graph)} tasks would run:")
+        for key in stale:
+            print(f"\t{task_id(key)}")
+        return 0
+
+    remaining = {key: set(current["needs"]) for key, current in graph.items()}
+    dependents = {key: [] for key in graph}
+    for key, current in graph.items():
+        for need in current["needs"]:
+            dependents[need].append(key)
+
+    # Worker processes are spawned, not forked, because download threads are already running
+    context = multiprocessing.get_context("spawn")
+    process_pools = {"compute": lambda: ProcessPoolExecutor(max_workers=jobs, mp_context=context)}
+    if any(current["pool"] == "qgis" for current in graph.values()):
+        import qgis_transform  # only importable where QGIS is installed
+        process_pools["qgis"] = lambda: ProcessPoolExecutor(max_workers=jobs, mp_context=context,
+                                                            initializer=qgis_transform.init_worker, initargs=(memory_limit,))
+    pools = {
+        "assess": ThreadPoolExecutor(max_workers=max(jobs, 2)),
+        "download": ThreadPoolExecutor(max_workers=max_in_flight)
+    }
+    pools.update({name: start_pool() for name, start_pool in process_pools.items()})
+
+    print(f"Running {len(graph)} tasks ({jobs} jobs, {max_in_flight} downloads in flight)...")
+    ready = deque(key for key, needs in remaining.items() if not needs)
+    assessing = {}
+    running = {}
+    crashed = set()
+    results = []
+    skipped = 0
+    try:
+        while ready or assessing or running:
+            while ready:
+                key = ready.popleft()
+                assessing[pools["assess"].submit(assess, graph[key], key, forced)] = key
+
+            finished, _ = wait(list(assessing) + list(running), return_when=FIRST_COMPLETED)
+            for future in finished:
+                if future in assessing:
+                    key = assessing.pop(future)
+                    current = graph[key]
+                    fingerprint, up_to_date = future.result()
+                    if up_to_date:
+                        print(f"\t{task_id(key)} is up to date.")
+                        ready.extend(release_dependents(key, remaining, dependents))
+                        continue
+
+                    # Clear the old outputs so the stage's own exists() checks do not skip the work
+                    if current["check"] is None or key in forced:
+                        for path in current["outputs"] + current["scratch"]:
+                            if os.path.exists(path):
+                                os.remove(path)
+                    for path in current["outputs"]:
+                        os.makedirs(path.parent, exist_ok=True)
+
+                    print(f"\tStarting {task_id(key)}...")
+                    pool = pools[current["pool"]]
+                    running[pool.submit(parallel.run_task, current["function"], current["args"])] = (key, fingerprint, pool)
+                    continue
+
+                key, fingerprint, pool = running.pop(future)
+                try:
+                    result, error = future.result()
+                except BrokenProcessPool as broken:
+                    name = graph[key]["pool"]
+                    if pools[name] is pool:  # the other tasks of the broken pool find it replaced
+                        pool.shutdown(wait=False)
+                        pools[name] = process_pools[name]()
+                    if key not in crashed:
+                        crashed.add(key)
+                        print(f"\tA worker died while {task_id(key)} was running. Retrying it...")
+                        current = graph[key]
+                        running[pools[name].submit(parallel.run_task, current["function"], current["args"])] = (key, fingerprint, pools[name])
+                        continue
+                    result, error = None, f"The worker process running the task died: {broken}"
+                missing = [str(path) for path in graph[key]["outputs"] if not os.path.exists(path)]
+                if error is None and missing:
+                    error = f"The task did not write {', '.join(missing)}"
+                results.append((key, result, error))
+
+                if error is not None:
+                    skipped += len(descendants(key, dependents))
+                    continue
+
+                # The inputs are fingerprinted again in case they changed while the task ran
+                if fingerprint is not None and fingerprint == task_fingerprint(graph[key]):
+                    for path in graph[key]["outputs"]:
+                        artifact_cache.record_output(fingerprint, path, key[2])
+                ready.extend(release_dependents(key, remaining, dependents))
+    finally:
+        for pool in pools.values():
+            pool.shutdown()
+
+    parallel.summarize([(task_id(key), result, error) for key, result, error in results], "Pipeline")
+    if skipped:
+        print(f"{skipped} tasks were skipped because a task they depend on failed.")
+    return sum(error is not None for _, _, error in results)
+
+
+def release_dependents(key, remaining, dependents):
+    """
+    Mark a task as finished and return the tasks it unblocks.
+
+    Parameters:
+        key (tuple): Key of the finished task.
+        remaining (dict): Unfinished needs of every task, updated in place.
+        dependents (dict): Keys of the tasks needing each task.
+
+    Returns:
+        list: Keys of the tasks whose needs are now all finished.
+    """
+    unblocked = []
+    for dependent in dependents[key]:
+        remaining[dependent].discard(key)
+        if not remaining[dependent]:
+            unblocked.append(dependent)
+    return unblocked
+
+
+def descendants(key, dependents):
+    """
+    Collect every task that depends, directly or not, on a task.
+
+    Parameters:
+        key (tuple): Key of the task.
+        dependents (dict): Keys of the tasks needing each task.
+
+    Returns:
+        set: Keys of the dependent tasks.
+    """
+    found = set()
+    pending = list(dependents[key])
+    while pending:
+        dependent = pending.pop()
+        if dependent not in found:
+            found.add(dependent)
+            pending.extend(dependents[dependent])
+    return found
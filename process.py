@@ -1,30 +1,66 @@
 import xarray as xr
+import numpy as np
 import re
+import math
 import pathlib
 import os
+import warnings
 
-def average_netcdfs(variables, periods):
+import artifact_cache
+import instrumentation
+import netcdf_encoding
+import parallel
+import paths
+import regions
+import zarr_store
+
+# Statistics `monthly_statistics` can compute in its single pass
+STATISTICS = ("mean", "std", "min", "max", "percentiles", "diurnal")
+DEFAULT_PERCENTILES = (10, 50, 90)
+
+# Hours kept per cell to estimate the percentiles of a month
+PERCENTILE_SAMPLES = 64
+
+def average_netcdfs(variables, periods, mode="eager", chunk_size=None, memory_limit=None, workers=1, source="netcdf", region=None,
+                    statistics=("mean",), percentiles=DEFAULT_PERCENTILES):
     """
     Calculate the monthly mean for specified variables in NetCDF files.
 
     Parameters:
         variables (list): List of variables to average.
+        periods (list): List of periods to process.
+        mode (str): "eager" loads each file whole, "stream" reduces it chunk by chunk
+            in NumPy and "dask" lets dask reduce it chunk by chunk.
+        chunk_size (int, optional): Number of time steps per chunk in the chunked modes.
+        memory_limit (int, optional): Bytes a single chunk may take up. Used to derive
+            the chunk size when `chunk_size` is not given.
+        workers (int): Number of worker processes. Every period is averaged independently.
+        source (str): "netcdf" reads each downloaded file, "zarr" first appends the
+            downloads to the per-variable Zarr stores and reads the periods from there.
+        region (str or tuple, optional): Only average the cells of this region. See `regions.resolve`.
+        statistics (tuple of str): Statistics to write, from STATISTICS. The mean is always
+            written, as the later stages read it; anything else is computed in the same
+            pass over each file. See `monthly_statistics`.
+        percentiles (tuple of float): Percentiles computed by the "percentiles" statistic.
 
     Returns:
         None
     """
 
     # Directory path
-    variable_list = '-'.join(map(str, variables))
-    directory_path = pathlib.Path(f'./era5_data/{variable_list}/')
-    input_directory = pathlib.Path(f'./era5_data/{variable_list}/downloads/')
-    output_directory = pathlib.Path(f'./era5_data/{variable_list}/monthly_means/')
+    directory_path = paths.variable_directory(variables, region)
+    input_directory = pathlib.Path(f'{directory_path}/downloads/')
+    output_directory = pathlib.Path(f'{directory_path}/monthly_means/')
+
+    if source == "zarr":
+        zarr_store.ingest(variables, periods, region)
 
-    # Loop through all files in the directory
-    for file in input_directory.iterdir():
+    # Loop through all downloaded files in the directory (skipping the manifest and partial downloads)
+    tasks = []
+    for file in sorted(input_directory.glob("download_*.nc")):
         if not file.is_file():  # Check if it is a file
             continue
-        
+
         in_path = input_directory / file.name
         in_path_stem = str(in_path.stem)
         in_path_stem_period = in_path_stem.split("download_")[1]
@@ -40,13 +76,442 @@ def average_netcdfs(variables, periods):
             output_path = output_directory / out_filename
             os.makedirs(output_directory, exist_ok=True)
 
-            # Check if output file exists
-            if output_path.exists():
+            # Check if the output was made from this download with these settings
+            if artifact_cache.is_current(average_key(in_path, variables, mode, source, region, statistics, percentiles), output_path):
                 print(f"Data for the period {period} has already been processed.")
+                instrumentation.skipped("average", "output current", variables=variables, period=period)
                 continue
 
-            # Open the downloaded NetCDF file
-            data = xr.open_dataset(in_path)
-            monthly_mean = data[variables].mean(dim="valid_time")
-            monthly_mean.to_netcdf(output_path)
-            print(f"Data for the period {period} has been averaged.")
\ No newline at end of file
+            tasks.append((in_path, output_path, period, variables, mode, chunk_size, memory_limit, source, region,
+                          statistics, percentiles))
+
+    parallel.run_tasks(average_period, tasks, workers, "Monthly averaging", raise_on_error=True)
+
+
+@instrumentation.stage("average")
+def average_period(in_path, output_path, period, variables, mode="eager", chunk_size=None, memory_limit=None, source="netcdf", region=None,
+                   statistics=("mean",), percentiles=DEFAULT_PERCENTILES):
+    """
+    Calculate and save the monthly mean of a single downloaded file.
+
+    Parameters:
+        in_path (pathlib.Path): Path to the downloaded NetCDF file.
+        output_path (pathlib.Path): Path of the monthly mean to write.
+        period (str): The period of the file.
+        variables (list): List of variables to average.
+        mode (str): "eager", "stream" or "dask". See `average_netcdfs`.
+        chunk_size (int, optional): Number of time steps per chunk in the chunked modes.
+        memory_limit (int, optional): Bytes a single chunk may take up.
+        source (str): "netcdf" reads `in_path`, "zarr" slices the period out of the Zarr stores.
+        region (str or tuple, optional): Only average the cells of this region.
+        statistics (tuple of str): Statistics to write. See `average_netcdfs`.
+        percentiles (tuple of float): Percentiles computed by the "percentiles" statistic.
+
+    Returns:
+        None
+    """
+    key = average_key(in_path, variables, mode, source, region, statistics, percentiles)
+    status = artifact_cache.lookup(key, output_path)
+    if status is not None:
+        print(f"Data for the period {period} has already been processed.")
+        instrumentation.mark("skipped" if status == "current" else "cached", f"output {status}")
+        return
+
+    if source == "zarr":
+        monthly_mean = monthly_mean_of_store(variables, period, mode, chunk_size, memory_limit, region, statistics, percentiles)
+    else:
+        # Open the downloaded NetCDF file
+        monthly_mean = monthly_mean_of_file(in_path, variables, mode, chunk_size, memory_limit, region, statistics, percentiles)
+    netcdf_encoding.write_netcdf(monthly_mean, output_path)
+    artifact_cache.store(key, output_path, "average")
+    print(f"Data for the period {period} has been averaged.")
+
+
+def average_key(in_path, variables, mode="eager", source="netcdf", region=None, statistics=("mean",), percentiles=DEFAULT_PERCENTILES):
+    """
+    Identify the monthly mean of a download by its contents and the averaging settings.
+
+    Parameters:
+        in_path (pathlib.Path): Path to the downloaded NetCDF file.
+        variables (list): List of variables to average.
+        mode (str): "eager", "stream" or "dask".
+        source (str): "netcdf" or "zarr".
+        region (str or tuple, optional): The region averaged.
+        statistics (tuple of str): Statistics written.
+        percentiles (tuple of float): Percentiles computed by the "percentiles" statistic.
+
+    Returns:
+        str: The artifact key.
+    """
+    parameters = {}
+    if set(statistics) - {"mean"}:  # plain means keep the keys they were cached under
+        parameters["statistics"] = list(statistics)
+        if "percentiles" in statistics:
+            parameters["percentiles"] = [float(percentile) for percentile in percentiles]
+    return artifact_cache.artifact_key(
+        "average", [in_path], variables=list(variables), mode=mode, source=source,
+        region=regions.resolve(region), encoding=netcdf_encoding.settings(), **parameters
+    )
+
+
+def monthly_mean_of_file(in_path, variables, mode="eager", chunk_size=None, memory_limit=None, region=None,
+                         statistics=("mean",), percentiles=DEFAULT_PERCENTILES):
+    """
+    Average the specified variables of a NetCDF file over time.
+
+    Parameters:
+        in_path (pathlib.Path): Path to the downloaded NetCDF file.
+        variables (list): List of variables to average.
+        mode (str): "eager", "stream" or "dask". See `average_netcdfs`.
+        chunk_size (int, optional): Number of time steps per chunk in the chunked modes.
+        memory_limit (int, optional): Bytes a single chunk may take up.
+        region (str or tuple, optional): Only average the cells of this region. Files
+            downloaded for the region already hold just its cells, which are kept as they are.
+        statistics (tuple of str): Statistics to compute. Anything beyond the mean is
+            computed by `monthly_statistics` in one chunked pass, whatever the mode.
+        percentiles (tuple of float): Percentiles computed by the "percentiles" statistic.
+
+    Returns:
+        xarray.Dataset: The time mean of every variable, with the number of time
+            steps averaged in its "hour_count" attribute.
+    """
+    # The region is selected before anything is read, so only its cells are loaded
+    if set(statistics) - {"mean"}:
+        with xr.open_dataset(in_path) as data:
+            monthly_mean = monthly_statistics(regions.subset(data, region), variables, statistics, percentiles,
+                                              chunk_size, memory_limit)
+            hour_count = data.sizes["valid_time"]
+    elif mode == "eager":
+        with xr.open_dataset(in_path) as data:
+            monthly_mean = regions.subset(data[variables], region).mean(dim="valid_time").load()
+            hour_count = data.sizes["valid_time"]
+    elif mode == "dask":
+        with xr.open_dataset(in_path) as data:
+            steps = time_chunk_size(regions.subset(data, region), variables, chunk_size, memory_limit)
+        with xr.open_dataset(in_path, chunks={"valid_time": steps}) as data:
+            # Computing the dataset at once reduces every variable in a single pass
+            monthly_mean = regions.subset(data[variables], region).mean(dim="valid_time").compute()
+            hour_count = data.sizes["valid_time"]
+    elif mode == "stream":
+        with xr.open_dataset(in_path) as data:
+            monthly_mean = streaming_mean(regions.subset(data, region), variables, chunk_size, memory_limit)
+            hour_count = data.sizes["valid_time"]
+    else:
+        raise ValueError(f"Unknown averaging mode: {mode}")
+
+    # Record how many hours went into the mean so means can be time-weighted later
+    monthly_mean.attrs["hour_count"] = int(hour_count)
+    return monthly_mean
+
+
+def monthly_mean_of_store(variables, period, mode="eager", chunk_size=None, memory_limit=None, region=None,
+                          statistics=("mean",), percentiles=DEFAULT_PERCENTILES):
+    """
+    Average the specified variables of one period of the Zarr stores over time.
+
+    Parameters:
+        variables (list): List of variables to average.
+        period (str): The period.
+        mode (str): "stream" reduces chunk by chunk in NumPy. The store is already
+            chunked, so "eager" and "dask" both let dask reduce its chunks.
+        chunk_size (int, optional): Number of time steps per chunk in stream mode.
+        memory_limit (int, optional): Bytes a single chunk may take up.
+        region (str or tuple, optional): The region of the run, whose stores are read.
+        statistics (tuple of str): Statistics to compute. See `monthly_mean_of_file`.
+        percentiles (tuple of float): Percentiles computed by the "percentiles" statistic.
+
+    Returns:
+        xarray.Dataset: The time mean of every variable, with the number of time
+            steps averaged in its "hour_count" attribute.
+    """
+    data = zarr_store.select_period(zarr_store.open_store(variables, region=region), period)
+    if set(statistics) - {"mean"}:
+        monthly_mean = monthly_statistics(data, variables, statistics, percentiles, chunk_size, memory_limit)
+    elif mode == "stream":
+        monthly_mean = streaming_mean(data, variables, chunk_size, memory_limit)
+    elif mode in ("eager", "dask"):
+        monthly_mean = data[variables].mean(dim="valid_time").compute()
+    else:
+        raise ValueError(f"Unknown averaging mode: {mode}")
+
+    monthly_mean.attrs["hour_count"] = int(data.sizes["valid_time"])
+    return monthly_mean
+
+
+def time_chunk_size(data, variables, chunk_size=None, memory_limit=None):
+    """
+    Work out how many time steps to read at once.
+
+    Parameters:
+        data (xarray.Dataset): The opened dataset.
+        variables (list): List of variables that are read together.
+        chunk_size (int, optional): Explicit number of time steps per chunk.
+        memory_limit (int, optional): Bytes a single chunk may take up.
+
+    Returns:
+        int: Number of time steps per chunk.
+    """
+    if chunk_size is not None:
+        return max(1, int(chunk_size))
+
+    n_steps = data.sizes["valid_time"]
+    if memory_limit is None:
+        return n_steps
+
+    step_bytes = sum(data[variable].nbytes // n_steps for variable in variables)
+    return max(1, min(n_steps, int(memory_limit // max(step_bytes, 1))))
+
+
+def iter_time_chunks(data, variables, steps):
+    """
+    Yield the specified variables a few time steps at a time.
+
+    Every variable is read for the same time slice, so a file is scanned once
+    no matter how many variables are requested.
+
+    Parameters:
+        data (xarray.Dataset): The opened dataset.
+        variables (list): List of variables to read.
+        steps (int): Number of time steps per chunk.
+
+    Yields:
+        xarray.Dataset: The loaded chunk.
+    """
+    n_steps = data.sizes["valid_time"]
+    for start in range(0, n_steps, steps):
+        yield data[variables].isel(valid_time=slice(start, start + steps)).load()
+
+
+def streaming_mean(data, variables, chunk_size=None, memory_limit=None):
+    """
+    Average the specified variables over time one chunk at a time.
+
+    Only one chunk plus a running sum and count per variable are held in
+    memory, so peak memory does not grow with the length of the file.
+
+    Parameters:
+        data (xarray.Dataset): The opened dataset.
+        variables (list): List of variables to average.
+        chunk_size (int, optional): Number of time steps per chunk.
+        memory_limit (int, optional): Bytes a single chunk may take up.
+
+    Returns:
+        xarray.Dataset: The time mean of every variable, ignoring missing values.
+    """
+    steps = time_chunk_size(data, variables, chunk_size, memory_limit)
+    sums = {}
+    counts = {}
+
+    for chunk in iter_time_chunks(data, variables, steps):
+        for variable in variables:
+            values = chunk[variable]
+            chunk_sum = values.sum(dim="valid_time", skipna=True, dtype="float64")
+            chunk_count = values.notnull().sum(dim="valid_time")
+            if variable in sums:
+                sums[variable] = sums[variable] + chunk_sum
+                counts[variable] = counts[variable] + chunk_count
+            else:
+                sums[variable] = chunk_sum
+                counts[variable] = chunk_count
+
+    means = {}
+    for variable in variables:
+        mean = sums[variable] / counts[variable].where(counts[variable] > 0)
+        means[variable] = mean.astype(data[variable].dtype)
+    return xr.Dataset(means)
+
+
+def monthly_statistics(data, variables, statistics=("mean",), percentiles=DEFAULT_PERCENTILES, chunk_size=None,
+                       memory_limit=None, percentile_samples=PERCENTILE_SAMPLES):
+    """
+    Compute several statistics of the specified variables in one pass over time.
+
+    Each chunk of time steps is read once and folded into running state per
+    variable, so asking for more statistics adds almost no I/O:
+
+    - "mean" and "std": running count, mean and sum of squared deviations,
+      merged chunk by chunk (Chan et al.). The standard deviation is the
+      population one (ddof=0).
+    - "min" and "max": running elementwise minimum and maximum.
+    - "percentiles": estimated from every n-th hour, about `percentile_samples`
+      per cell. The stride is kept coprime with 24 so the sample covers every
+      hour of the day.
+    - "diurnal": the mean of every hour of the day, along an "hour" dimension.
+
+    Missing values are ignored throughout. The mean is always returned, since
+    the later stages read it.
+
+    Parameters:
+        data (xarray.Dataset): The opened dataset.
+        variables (list): List of variables to reduce.
+        statistics (tuple of str): Statistics to compute, from STATISTICS.
+        percentiles (tuple of float): Percentiles between 0 and 100.
+        chunk_size (int, optional): Number of time steps per chunk.
+        memory_limit (int, optional): Bytes a single chunk may take up.
+        percentile_samples (int): Hours kept per cell for the percentiles.
+
+    Returns:
+        xarray.Dataset: One data variable per variable and statistic. The mean keeps
+            the variable's name, the others are named e.g. "t2m_std", "t2m_percentile"
+            (along a "percentile" dimension) and "t2m_diurnal" (along "hour").
+    """
+    unknown = [statistic for statistic in statistics if statistic not in STATISTICS]
+    if unknown:
+        raise ValueError(f"Unknown statistics: {', '.join(unknown)}. Choose from {', '.join(STATISTICS)}.")
+
+    steps = time_chunk_size(data, variables, chunk_size, memory_limit)
+    stride = sample_stride(data.sizes["valid_time"], percentile_samples)
+    states = {}
+
+    start = 0
+    for chunk in iter_time_chunks(data, variables, steps):
+        hours = chunk["valid_time"].dt.hour.values if "diurnal" in statistics else None
+        sampled = np.flatnonzero((start + np.arange(chunk.sizes["valid_time"])) % stride == 0)
+        for variable in variables:
+            values = chunk[variable].transpose("valid_time", ...).values
+            if variable not in states:
+                states[variable] = new_state(values.shape[1:], statistics)
+            update_state(states[variable], values, statistics, hours, sampled)
+        start += chunk.sizes["valid_time"]
+
+    results = {}
+    for variable in variables:
+        template = data[variable].isel(valid_time=0, drop=True)
+        spatial_dims = template.dims
+        spatial_coords = {dim: template[dim] for dim in spatial_dims if dim in template.coords}
+        dtype = data[variable].dtype
+        for name, (values, extra_dim, extra_coord) in finalize_state(states[variable], statistics, percentiles).items():
+            dims = ((extra_dim,) if extra_dim else ()) + spatial_dims
+            coords = dict(spatial_coords)
+            if extra_dim:
+                coords[extra_dim] = extra_coord
+            output_name = variable if name == "mean" else f"{variable}_{name}"
+            results[output_name] = xr.DataArray(values.astype(dtype), dims=dims, coords=coords, attrs={"statistic": name})
+            if name == "percentile":
+                results[output_name].attrs["sampling"] = f"every {stride} hours"
+    return xr.Dataset(results)
+
+
+def sample_stride(n_steps, samples):
+    """
+    Work out the stride of the hours kept for the percentiles.
+
+    Parameters:
+        n_steps (int): Number of time steps in the file.
+        samples (int): Number of hours to keep.
+
+    Returns:
+        int: Keep every n-th hour. Coprime with 24, unless every hour is kept.
+    """
+    stride = max(1, math.ceil(n_steps / max(1, samples)))
+    while stride > 1 and math.gcd(stride, 24) != 1:
+        stride += 1
+    return stride
+
+
+def new_state(shape, statistics):
+    """
+    Create the running state of one variable.
+
+    Parameters:
+        shape (tuple): Shape of one time step.
+        statistics (tuple of str): Statistics being computed.
+
+    Returns:
+        dict: The arrays the statistics are accumulated in.
+    """
+    state = {
+        "count": np.zeros(shape, dtype="int64"),
+        "mean": np.zeros(shape, dtype="float64")
+    }
+    if "std" in statistics:
+        state["m2"] = np.zeros(shape, dtype="float64")
+    if "min" in statistics:
+        state["min"] = np.full(shape, np.nan, dtype="float64")
+    if "max" in statistics:
+        state["max"] = np.full(shape, np.nan, dtype="float64")
+    if "percentiles" in statistics:
+        state["samples"] = []
+    if "diurnal" in statistics:
+        state["hour_sum"] = np.zeros((24,) + shape, dtype="float64")
+        state["hour_count"] = np.zeros((24,) + shape, dtype="int64")
+    return state
+
+
+def update_state(state, values, statistics, hours=None, sampled=None):
+    """
+    Fold a chunk of time steps into the running state of a variable.
+
+    Parameters:
+        state (dict): The state, as created by `new_state`.
+        values (numpy.ndarray): The chunk, time first.
+        statistics (tuple of str): Statistics being computed.
+        hours (numpy.ndarray, optional): Hour of day of every time step, for "diurnal".
+        sampled (numpy.ndarray, optional): Indices of the time steps kept for "percentiles".
+
+    Returns:
+        None
+    """
+    valid = ~np.isnan(values)
+    chunk_count = valid.sum(axis=0)
+    chunk_sum = np.where(valid, values, 0).sum(axis=0, dtype="float64")
+    chunk_mean = np.divide(chunk_sum, chunk_count, out=np.zeros_like(chunk_sum), where=chunk_count > 0)
+
+    # Merge the chunk's count, mean and squared deviations into the running ones
+    count = state["count"] + chunk_count
+    delta = chunk_mean - state["mean"]
+    weight = np.divide(chunk_count, count, out=np.zeros_like(chunk_mean), where=count > 0)
+    if "m2" in state:
+        chunk_m2 = np.where(valid, values - chunk_mean, 0) ** 2
+        state["m2"] += chunk_m2.sum(axis=0) + delta ** 2 * state["count"] * weight
+    state["mean"] += delta * weight
+    state["count"] = count
+
+    if "min" in state:
+        state["min"] = np.fmin(state["min"], np.fmin.reduce(values, axis=0))
+    if "max" in state:
+        state["max"] = np.fmax(state["max"], np.fmax.reduce(values, axis=0))
+    if "samples" in state and sampled is not None and sampled.size:
+        state["samples"].append(values[sampled].astype("float32"))
+    if "hour_sum" in state:
+        for hour in np.unique(hours):
+            in_hour = hours == hour
+            state["hour_sum"][hour] += np.where(valid[in_hour], values[in_hour], 0).sum(axis=0)
+            state["hour_count"][hour] += valid[in_hour].sum(axis=0)
+
+
+def finalize_state(state, statistics, percentiles=DEFAULT_PERCENTILES):
+    """
+    Turn the running state of a variable into its statistics.
+
+    Parameters:
+        state (dict): The state, as updated by `update_state`.
+        statistics (tuple of str): Statistics being computed. The mean is always included.
+        percentiles (tuple of float): Percentiles between 0 and 100.
+
+    Returns:
+        dict: (values, extra dimension, extra coordinate) keyed by statistic, where
+            the extra dimension is None for plain maps.
+    """
+    count = state["count"]
+    has_data = count > 0
+    results = {"mean": (np.where(has_data, state["mean"], np.nan), None, None)}
+    if "std" in statistics:
+        variance = np.divide(state["m2"], count, out=np.full_like(state["m2"], np.nan), where=has_data)
+        results["std"] = (np.sqrt(variance), None, None)
+    if "min" in statistics:
+        results["min"] = (state["min"], None, None)
+    if "max" in statistics:
+        results["max"] = (state["max"], None, None)
+    if "percentiles" in statistics:
+        samples = np.concatenate(state["samples"], axis=0)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)  # cells without data give NaN
+            values = np.nanpercentile(samples, list(percentiles), axis=0)
+        results["percentile"] = (values, "percentile", list(percentiles))
+    if "diurnal" in statistics:
+        hour_count = state["hour_count"]
+        hourly = np.divide(state["hour_sum"], hour_count, out=np.full_like(state["hour_sum"], np.nan),
+                           where=hour_count > 0)
+        results["diurnal"] = (hourly, "hour", list(range(24)))
+    return results
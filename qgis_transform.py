@@ -1,12 +1,22 @@
 # Standard libraries
 import os
+import atexit
 import pathlib
+import resource
 
 # Third-party libraries
 from osgeo import gdal
 
+# Local Scripts
+import artifact_cache
+import instrumentation
+import parallel
+import paths
+import raster_pipeline
+import regions
+import symbology
+
 # QGIS-specific libraries
-from qgis import processing
 from qgis.analysis import QgsRasterCalculator, QgsRasterCalculatorEntry, QgsNativeAlgorithms
 from qgis.core import (
     QgsApplication,
@@ -23,8 +33,14 @@ from qgis.core import (
 from PyQt5.QtGui import QImage, QPainter, QColor
 from PyQt5.QtCore import QSize, Qt
 
+# QGIS session of a render worker process, started once by `init_worker`
+_worker_qgs = None
+
+# Shapefile layers already loaded in this process, keyed by path
+_shapefile_layers = {}
 
-def init_qgis(variables, periods, input_dir):
+
+def init_qgis(variables, periods, input_dir, pipeline="files", keep=(), workers=1, memory_limit=None, value_range=None, resample="full", region=None):
     """
     Initialize the QGIS application.
 
@@ -32,88 +48,321 @@ def init_qgis(variables, periods, input_dir):
         variables (list): List of variables.
         periods (list): List of periods.
         input_dir (str): Input directory.
+        pipeline (str): "files" works from the converted GeoTIFFs and writes every
+            intermediate raster, "fused" goes straight from the NetCDF file to the
+            PNG and keeps the intermediate rasters in memory.
+        keep (tuple of str): Intermediate rasters to still write to disk. The fused
+            pipeline understands "null", "res" and "mask"; the files pipeline only
+            writes the `_NULL.tif` copy when "null" is given.
+        workers (int): Number of worker processes. Each worker starts QGIS once and
+            renders its share of the periods.
+        memory_limit (int, optional): Address-space limit of each worker, in bytes.
+        value_range (tuple, dict or str, optional): (minimum, maximum) of the color ramp
+            of every map, ranges keyed by variable, or "batch" to share the range of all
+            periods per variable so the maps are comparable. By default each map uses
+            its own range.
+        resample (str): "full" materializes the 0.018 degree raster. "vrt" keeps it and
+            its land mask as VRTs evaluated lazily when read ("files" pipeline). "canvas" resamples
+            straight onto the pixels of the output image ("fused" pipeline).
+        region (str or tuple, optional): The region of the run. Only its area is
+            resampled and drawn. See `regions.resolve`.
 
     Returns:
         None
     """
+    if value_range == "batch":
+        value_range = shared_value_range(variables, periods, input_dir, pipeline, region)
+        print(f"Using the color ramp ranges {value_range} for every map.")
+
+    if workers > 1:
+        tasks = [(variables, period, input_dir, pipeline, keep, value_range, resample, region) for period in periods]
+        print(f"Rendering {len(tasks)} periods on {workers} QGIS workers...")
+        parallel.run_tasks(transform_period, tasks, workers, "QGIS rendering", init_worker, (memory_limit,), raise_on_error=True)
+        return
+
     print("Initializing QGIS...")
     qgs = QgsApplication([], False)
     qgs.initQgis()
-    from processing.core.Processing import Processing
-    Processing.initialize()
 
     for period in periods:
-        print(f"Applying QGIS transformations to the data for period {period}")
+        transform_period(variables, period, input_dir, pipeline, keep, value_range, resample, region)
+
+    _shapefile_layers.clear()  # the layers belong to this QGIS session
+    qgs.exitQgis()
+
+
+def init_worker(memory_limit=None):
+    """
+    Prepare a render worker process: cap its memory and start QGIS once.
+
+    Parameters:
+        memory_limit (int, optional): Address-space limit of the process, in bytes.
+
+    Returns:
+        None
+    """
+    global _worker_qgs
+    if memory_limit is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    print(f"Initializing QGIS in worker {os.getpid()}...")
+    _worker_qgs = QgsApplication([], False)
+    _worker_qgs.initQgis()
+    atexit.register(_worker_qgs.exitQgis)
+
+
+@instrumentation.stage("qgis.transform")
+def transform_period(variables, period, input_dir, pipeline="files", keep=(), value_range=None, resample="full", region=None):
+    """
+    Apply the QGIS transformations to a single period. QGIS must already be running.
+
+    Every variable of the period gets its own map.
+
+    Parameters:
+        variables (list): List of variables.
+        period (str): The period.
+        input_dir (str): Input directory.
+        pipeline (str): "files" or "fused". See `init_qgis`.
+        keep (tuple of str): Intermediate rasters to write to disk. See `init_qgis`.
+        value_range (tuple or dict, optional): (minimum, maximum) of the color ramp, or
+            ranges keyed by variable. Computed from the native-resolution data when not given.
+        resample (str): "full", "vrt" or "canvas". See `init_qgis`.
+        region (str or tuple, optional): The region of the run. See `init_qgis`.
+
+    Returns:
+        None
+    """
+    print(f"Applying QGIS transformations to the data for period {period}")
+
+    # Load the raster
+    input_directory, png_directory, input_path_name, netcdf_path = period_paths(variables, period, input_dir, region)
+    bounds = regions.output_bounds(region)
 
-        # Load the raster
-        variable_list = '-'.join(map(str, variables))
-        directory_path = pathlib.Path(f'./era5_data/{variable_list}')
-        input_directory = pathlib.Path(f'{directory_path}/{input_dir}/geotiffs/')
-        png_directory = pathlib.Path(f'{directory_path}/{input_dir}/png/')
+    if pipeline == "fused":
+        fused_transform(netcdf_path, variables, input_directory, png_directory, input_path_name, 0.018, keep, value_range, resample, bounds)
+        return
+
+    for variable in variables:
+        stem = paths.variable_stem(input_path_name, variable, variables)
+        variable_range = raster_pipeline.range_for(value_range, variable)
+        if variable_range is None:
+            variable_range = native_value_range(input_directory / f"{stem}.tif")
+        null_raster = set_null_in_raster(input_directory, stem, keep_null=("null" in keep))
+        res_tiff = resample_raster(input_directory, f"{stem}_NULL", 0.018, lazy=(resample == "vrt"), source_path=null_raster, bounds=bounds)
+        create_raster_image(res_tiff, png_directory, stem, variable_range, variable)
+
+
+def period_paths(variables, period, input_dir, region=None):
+    """
+    Work out the directories and names used for a period.
+
+    Parameters:
+        variables (list): List of variables.
+        period (str): The period.
+        input_dir (str): Input directory.
+        region (str or tuple, optional): The region of the run.
+
+    Returns:
+        tuple: (GeoTIFF directory, PNG directory, input path name, NetCDF path).
+            The GeoTIFF of each variable is named after `paths.variable_stem`.
+    """
+    directory_path = paths.variable_directory(variables, region)
+    input_directory = pathlib.Path(f'{directory_path}/{input_dir}/geotiffs/')
+    png_directory = pathlib.Path(f'{directory_path}/{input_dir}/png/')
+    input_path_name = paths.period_input_name(period, input_dir)
+    netcdf_path = pathlib.Path(f'{directory_path}/{input_dir}/{input_path_name}.nc')
+    return input_directory, png_directory, input_path_name, netcdf_path
+
+
+def native_value_range(geotiff_path):
+    """
+    Minimum and maximum over land of a converted GeoTIFF at native resolution.
+
+    Parameters:
+        geotiff_path (pathlib.Path): The GeoTIFF written by `convert.netcdf_to_geotiff`.
+
+    Returns:
+        tuple: (minimum, maximum), or None if there is no valid data.
+    """
+    shapefile_path = pathlib.Path(f"./shpfiles/world_map/ne_10m_land.shp")
+    values, geotransform = raster_pipeline.load_raster_array(geotiff_path)
+    return raster_pipeline.value_range(values, geotransform, shapefile_path)
+
+
+def shared_value_range(variables, periods, input_dir, pipeline="files", region=None):
+    """
+    Color ramp range of each variable covering every period of a batch.
+
+    Parameters:
+        variables (list): List of variables.
+        periods (list): List of periods.
+        input_dir (str): Input directory.
+        pipeline (str): "files" reads the converted GeoTIFFs, "fused" the NetCDF files.
+        region (str or tuple, optional): The region of the run.
 
-        month = period[4:6]
-        if (month == "") or (input_dir == "monthly_means"):
-            input_path_suffix = f"{period}"
+    Returns:
+        dict: (minimum, maximum) keyed by variable, None where there is no valid data.
+    """
+    shapefile_path = pathlib.Path(f"./shpfiles/world_map/ne_10m_land.shp")
+    ranges = {variable: [] for variable in variables}
+    for period in periods:
+        input_directory, _, input_path_name, netcdf_path = period_paths(variables, period, input_dir, region)
+        if pipeline == "fused":
+            arrays, geotransform = raster_pipeline.load_period_arrays(netcdf_path, variables)
+            for variable, values in arrays.items():
+                ranges[variable].append(raster_pipeline.value_range(values, geotransform, shapefile_path))
         else:
-            input_path_suffix = f"month{month}_{period}"
+            for variable in variables:
+                stem = paths.variable_stem(input_path_name, variable, variables)
+                ranges[variable].append(native_value_range(input_directory / f"{stem}.tif"))
+    return {variable: raster_pipeline.combine_ranges(variable_ranges) for variable, variable_ranges in ranges.items()}
 
-        # Anomaly Check
-        if input_dir == "monthly_anomalies":
-            input_path_name = f"anomaly_{input_path_suffix}"
-        elif input_dir == "monthly_means":
-            input_path_name = f"mean_{input_path_suffix}"
 
-        null_tiff = set_null_in_raster(input_directory, input_path_name)
-        res_tiff = resample_raster(input_directory, f"{input_path_name}_NULL", 0.018)
-        create_raster_image(res_tiff, png_directory, input_path_name)
+@instrumentation.stage("qgis.fused", fields=("input_path_name",))
+def fused_transform(netcdf_path, variables, geotiff_directory, png_directory, input_path_name, resolution, keep=(), value_range=None, resample="full", bounds=None):
+    """
+    Turn a NetCDF file into one PNG per variable without writing the intermediate rasters.
 
-    qgs.exitQgis()
+    The longitude shift, NoData assignment, resampling and land masking all
+    happen on in-memory rasters (GDAL /vsimem/), so only the PNGs and any
+    rasters named in `keep` touch the disk. The file is decoded once for all
+    variables.
 
+    Parameters:
+        netcdf_path (pathlib.Path): Path to the NetCDF file.
+        variables (list): List of variables.
+        geotiff_directory (pathlib.Path): Directory for intermediate rasters that are kept.
+        png_directory (pathlib.Path): Directory to save the output images.
+        input_path_name (str): Input path name.
+        resolution (float): The target resolution for resampling.
+        keep (tuple of str): Intermediate rasters to write to disk: "null", "res" and/or "mask".
+        value_range (tuple or dict, optional): (minimum, maximum) of the color ramp, or
+            ranges keyed by variable. Computed from the native-resolution data when not given.
+        resample (str): "full" resamples the whole grid to `resolution`, "canvas"
+            resamples straight onto the pixels of the output image.
+        bounds (tuple, optional): (xmin, ymin, xmax, ymax) of the region to draw.
 
-def set_null_in_raster(in_dir, in_filename):
+    Returns:
+        None
+    """
+    shapefile_path = pathlib.Path(f"./shpfiles/world_map/ne_10m_land.shp")
+    stems = {variable: paths.variable_stem(input_path_name, variable, variables) for variable in variables}
+    inputs = [netcdf_path] + raster_pipeline.shapefile_files(shapefile_path)
+    keys = {
+        variable: artifact_cache.artifact_key(
+            "image.qgis_fused", inputs, variable=variable, resolution=resolution, resample=resample, bounds=bounds,
+            ramp=symbology.ramp_signature(input_path_name, raster_pipeline.range_for(value_range, variable), variable),
+            size=raster_pipeline.RENDER_SIZE
+        )
+        for variable in variables
+    }
+    statuses = {
+        variable: artifact_cache.lookup(keys[variable], os.path.join(png_directory, f"{stems[variable]}_NULL_res.png"))
+        for variable in variables
+    }
+    pending = [variable for variable in variables if statuses[variable] is None]
+    if not pending:
+        print(f"\t\tData for the period has already been imaged.")
+        instrumentation.mark("cached" if "cached" in statuses.values() else "skipped", "outputs current or cached")
+        return
+
+    print("\tRunning the in-memory raster pipeline...")
+    arrays, geotransform = raster_pipeline.load_period_arrays(netcdf_path, pending)
+    shapefile_layer = load_shapefile_layer(shapefile_path)
+
+    for variable in pending:
+        stem = stems[variable]
+        output_png_path = os.path.join(png_directory, f"{stem}_NULL_res.png")
+        null_path = raster_pipeline.output_path(geotiff_directory, f"{stem}_NULL.tif", "null" in keep)
+        res_path = raster_pipeline.output_path(geotiff_directory, f"{stem}_NULL_res.tif", "res" in keep)
+        masked_path = raster_pipeline.output_path(geotiff_directory, f"{stem}_NULL_res_mask.tif", "mask" in keep)
+
+        values = arrays[variable]
+        variable_range = raster_pipeline.range_for(value_range, variable)
+        if variable_range is None:
+            variable_range = raster_pipeline.value_range(values, geotransform, shapefile_path)
+        masked_dataset = raster_pipeline.masked_raster(
+            values, geotransform, shapefile_path, resolution, (null_path, res_path, masked_path), resample,
+            bounds=bounds
+        )
+        masked_dataset = None  # flush the masked raster before QGIS reads it
+
+        masked_layer = QgsRasterLayer(masked_path, "Masked Raster")
+        if shapefile_layer is not None and masked_layer.isValid():
+            os.makedirs(png_directory, exist_ok=True)
+            render_png(masked_layer, shapefile_layer, output_png_path, stem, variable_range, variable)
+            artifact_cache.store(keys[variable], output_png_path, "image.qgis_fused")
+            print(f"\t\tData for the period has been imaged ({variable}).")
+        else:
+            print("\t\tFailed to load the masked raster.")
+
+        masked_layer = None
+        raster_pipeline.release([null_path, res_path, masked_path])
+
+
+@instrumentation.stage("qgis.set_null", fields=("in_filename",))
+def set_null_in_raster(in_dir, in_filename, keep_null=False):
     """
     Set missing values in a raster to NULL.
 
+    The source raster is never modified. If it already declares -9999 as its
+    NoData value (as rasters written by `convert.netcdf_to_geotiff` do), it is
+    used as is. Otherwise the NoData value is set on a small VRT wrapper, or on
+    a full `_NULL.tif` copy when `keep_null` is set. The copy is reused only if
+    it was made from the same raster.
+
     Parameters:
         in_dir (str): The input directory containing the raster file.
         in_filename (str): The input filename of the raster file.
+        keep_null (bool): Write the `_NULL.tif` copy instead of a VRT wrapper.
 
     Returns:
-        str: Path to the new raster file with NULL values set.
+        str: Path to a raster with NULL values set.
     """
     print("\tSetting missing values to NULL...")
 
     input_tiff = os.path.join(in_dir, f"{in_filename}.tif")
     null_tiff = os.path.join(in_dir, f"{in_filename}_NULL.tif")
+    null_vrt = os.path.join(in_dir, f"{in_filename}_NULL.vrt")
 
-    # Check if the output file already exists
-    if os.path.exists(null_tiff):
-        print(f"\t\tData for the period has already been set to NULL. Skipping setting NULL values.")
-        return null_tiff
+    key = None
+    if keep_null:
+        key = artifact_cache.artifact_key("null", raster_pipeline.source_files(input_tiff), nodata=-9999)
+        status = artifact_cache.lookup(key, null_tiff)
+        if status is not None:
+            print(f"\t\tData for the period has already been set to NULL. Skipping setting NULL values.")
+            instrumentation.mark("skipped" if status == "current" else "cached", f"output {status}")
+            return null_tiff
 
     print("\t\tLoading raster...")
-    dataset = gdal.Open(input_tiff, gdal.GA_Update)  # Open the raster file in update mode
+    dataset = gdal.Open(input_tiff)  # Read-only, the source raster is left untouched
 
     if dataset is None:
         print("\t\tFailed to open the raster file.")
         exit()
 
-    # Get the single raster band
-    band = dataset.GetRasterBand(1)  # Band index is 1 for the first (and only) band
-    band.SetNoDataValue(-9999) # set the NoData value for the band
-    print("\t\tNoData value set to -9999 for the single band.")
-
-    # Flush changes and close the dataset
-    dataset.FlushCache()
+    nodata = dataset.GetRasterBand(1).GetNoDataValue()
     dataset = None
 
-    # Save the raster to a new file to ensure changes are saved
-    gdal.Translate(null_tiff, input_tiff)
+    if nodata == -9999 and not keep_null:
+        print("\t\tNoData value is already set to -9999.")
+        instrumentation.mark("skipped", "NoData already set")
+        return input_tiff
+
+    if keep_null:
+        gdal.Translate(null_tiff, input_tiff, noData=-9999)
+        artifact_cache.store(key, null_tiff, "null")
+        print("\t\tNoData value set to -9999 in a copy of the raster.")
+        return null_tiff
 
-    return null_tiff
+    gdal.Translate(null_vrt, input_tiff, format="VRT", noData=-9999)
+    print("\t\tNoData value set to -9999 in a VRT wrapper.")
+    return null_vrt
 
 
-def resample_raster(in_dir, in_filename, resolution):
+@instrumentation.stage("qgis.resample", fields=("in_filename", "resolution", "lazy"))
+def resample_raster(in_dir, in_filename, resolution, lazy=False, source_path=None, bounds=None):
     """
     Resample a raster to a higher resolution.
 
@@ -121,44 +370,62 @@ def resample_raster(in_dir, in_filename, resolution):
         in_dir (str): The input directory containing the raster file.
         in_filename (str): The input filename of the raster file.
         resolution (float): The target resolution for resampling.
+        lazy (bool): Write a VRT that is only evaluated when read instead of
+            materializing the resampled GeoTIFF.
+        source_path (str, optional): Raster to resample. Defaults to `<in_filename>.tif`.
+        bounds (tuple, optional): (xmin, ymin, xmax, ymax) of the region to resample.
+            Defaults to the extent of the raster.
 
     Returns:
         str: Path to the resampled raster file.
     """
     print("\tResampling raster to higher resolution...")
 
-    res_tiff = os.path.join(in_dir, f"{in_filename}_res.tif")
-
-    # Check if the output file already exists
-    if os.path.exists(res_tiff):
+    extension = "vrt" if lazy else "tif"
+    res_tiff = os.path.join(in_dir, f"{in_filename}_res.{extension}")
+    if source_path is None:
+        source_path = os.path.join(in_dir, f"{in_filename}.tif")
+
+    # The resampled raster, or the VRT holding the grid and algorithm to resample with,
+    # is reused only if it was made from the same data with the same settings
+    key = artifact_cache.artifact_key("resample", raster_pipeline.source_files(source_path),
+                                      resolution=resolution, bounds=bounds, resample_alg="bilinear",
+                                      **({"format": "VRT"} if lazy else {}))  # resampled GeoTIFFs keep their keys
+    status = artifact_cache.lookup(key, res_tiff)
+    if status is not None:
         print(f"\t\tData for the period has already been resampled. Skipping resampling.")
+        instrumentation.mark("skipped" if status == "current" else "cached", f"output {status}")
         return res_tiff
 
     # Set input and output paths
     print("\t\tSetting up resampling inputs...")
-    res_tiff = os.path.join(in_dir, f"{in_filename}_res.tif")
 
     # Open the input dataset
-    input_raster = gdal.Open(os.path.join(in_dir, f"{in_filename}.tif"))
+    input_raster = gdal.Open(str(source_path))
 
     # Define the target resolution
     x_res = resolution  # X resolution in degrees
     y_res = resolution  # Y resolution in degrees
 
     # Perform the resampling
-    gdal.Warp(
+    output_raster = gdal.Warp(
         res_tiff,
         input_raster,
+        format="VRT" if lazy else "GTiff",
+        outputBounds=bounds,  # only the region is resampled, not the globe
         xRes=x_res,
         yRes=y_res,
         resampleAlg='bilinear'  # Resampling method (e.g., 'nearest', 'bilinear', 'cubic')
     )
+    output_raster = None  # flush the raster before it is stored
 
+    artifact_cache.store(key, res_tiff, "resample")
     print("\t\tResampled raster created successfully!")
     return res_tiff
 
 
-def create_raster_image(raster_path, image_directory, input_path_name):
+@instrumentation.stage("qgis.image", fields=("input_path_name",))
+def create_raster_image(raster_path, image_directory, input_path_name, value_range=None, variable=None):
     """
     Create a raster image.
 
@@ -166,26 +433,40 @@ def create_raster_image(raster_path, image_directory, input_path_name):
         raster_path (str): Path to the raster file.
         image_directory (str): Directory to save the output image.
         input_path_name (str): Input path name.
+        value_range (tuple, optional): (minimum, maximum) of the color ramp.
+        variable (str, optional): Variable shown, which selects the ramp colors.
 
     Returns:
         None
     """
     shapefile_path = pathlib.Path(f"./shpfiles/world_map/ne_10m_land.shp")
     output_png_path = os.path.join(image_directory, f"{input_path_name}_NULL_res.png")
-    if pathlib.Path(output_png_path).exists():
+    key = artifact_cache.artifact_key(
+        "image.qgis", raster_pipeline.source_files(raster_path) + raster_pipeline.shapefile_files(shapefile_path),
+        ramp=symbology.ramp_signature(input_path_name, value_range, variable), size=raster_pipeline.RENDER_SIZE
+    )
+    status = artifact_cache.lookup(key, output_png_path)
+    if status is not None:
         print(f"\t\tData for the period has already been imaged.")
+        instrumentation.mark("skipped" if status == "current" else "cached", f"output {status}")
     else:
         os.makedirs(image_directory, exist_ok=True)
-        apply_symbology_and_export_png(raster_path, shapefile_path, output_png_path, input_path_name)
+        apply_symbology_and_export_png(raster_path, shapefile_path, output_png_path, input_path_name, value_range, variable)
+        if os.path.exists(output_png_path):
+            artifact_cache.store(key, output_png_path, "image.qgis")
         print(f"\t\tData for the period has been imaged.")
 
 
-def create_color_ramp_renderer(raster_layer, input_path_name):
+def create_color_ramp_renderer(raster_layer, input_path_name, value_range=None, variable=None):
     """
     Create a color ramp renderer for the raster layer.
 
     Parameters:
         raster_layer (QgsRasterLayer): The raster layer to apply the color ramp to.
+        input_path_name (str): Input path name.
+        value_range (tuple, optional): (minimum, maximum) of the color ramp. When not
+            given, only the minimum and maximum are computed from the layer.
+        variable (str, optional): Variable shown, which selects the ramp colors.
 
     Returns:
         QgsSingleBandPseudoColorRenderer: The renderer with the color ramp applied.
@@ -193,45 +474,27 @@ def create_color_ramp_renderer(raster_layer, input_path_name):
     # Calculate Color Ramp Cutoffs
     data_provider = raster_layer.dataProvider()
     band = 1  # Single band raster
-    stats = data_provider.bandStatistics(band, QgsRasterBandStats.All, raster_layer.extent(), 0)
-    min_value = stats.minimumValue
-    max_value = stats.maximumValue
+    if value_range is None:
+        stats = data_provider.bandStatistics(band, QgsRasterBandStats.Min | QgsRasterBandStats.Max, raster_layer.extent(), 0)
+        min_value = stats.minimumValue
+        max_value = stats.maximumValue
+    else:
+        min_value, max_value = value_range
     # cutoffs = [min_value,
     #            min_value + 0.33 * (max_value - min_value),
     #            min_value + 0.66 * (max_value - min_value),
     #            max_value]
 
-    if (input_path_name).startswith("anomaly"):
-        cutoffs = [-20, -10, 0, 10, 20]
-    elif (input_path_name).startswith("mean"):
-        cutoffs = [min_value,
-                   min_value + 0.25 * (max_value - min_value),
-                   min_value + 0.5 * (max_value - min_value),
-                   min_value + 0.75 * (max_value - min_value),
-                   max_value]
+    cutoffs = symbology.color_ramp_cutoffs(input_path_name, min_value, max_value)
 
     # Create and Apply Color Ramp Shader
     raster_shader = QgsRasterShader()
     color_ramp_shader = QgsColorRampShader()
     color_ramp_shader.setColorRampType(QgsColorRampShader.Interpolated)
 
-    # evan notes --- do the green/blue from the default pseudocolor + use the orange from the new suggestion
-    # evan orange-red: (249, 88, 8)
-    # evan yellow: (255, 192, 13)
-    # evan pink: (253, 130, 247)
-    # evan blue: (76, 157, 249)
-    # default red: (215, 25, 28)
-    # default orange: (253, 174, 97)
-    # default yellow: (255, 255, 191)
-    # default light green: (171, 221, 164)
-    # default blue: (43, 131, 186)
-
     color_ramp = [
-        QgsColorRampShader.ColorRampItem(cutoffs[0], QColor(43, 131, 186), f'{cutoffs[0]:.2f}'),  # Default Blue: 43, 131, 186
-        QgsColorRampShader.ColorRampItem(cutoffs[1], QColor(171, 221, 164), f'{cutoffs[1]:.2f}'),  # Default Light Green: 171, 221, 164
-        QgsColorRampShader.ColorRampItem(cutoffs[2], QColor(255, 255, 191), f'{cutoffs[2]:.2f}'),  # Default Yellow: 255, 255, 191
-        QgsColorRampShader.ColorRampItem(cutoffs[3], QColor(253, 174, 97), f'{cutoffs[3]:.2f}'),  # Default Orange: 253, 174, 97
-        QgsColorRampShader.ColorRampItem(cutoffs[4], QColor(249, 88, 8), f'{cutoffs[4]:.2f}')  # Evan Orange-Red: 249, 88, 8
+        QgsColorRampShader.ColorRampItem(cutoff, QColor(*color), f'{cutoff:.2f}')
+        for cutoff, color in zip(cutoffs, symbology.ramp_colors(variable))
     ]
 
     color_ramp_shader.setColorRampItemList(color_ramp)
@@ -244,7 +507,7 @@ def create_color_ramp_renderer(raster_layer, input_path_name):
     return renderer
 
 
-def apply_symbology_and_export_png(raster_path, shapefile_path, output_png_path, input_path_name):
+def apply_symbology_and_export_png(raster_path, shapefile_path, output_png_path, input_path_name, value_range=None, variable=None):
     """
     Apply single pseudocolor symbology to the raster and mask it with a shapefile before exporting as PNG.
 
@@ -253,6 +516,8 @@ def apply_symbology_and_export_png(raster_path, shapefile_path, output_png_path,
         shapefile_path (str): Path to the shapefile for masking.
         output_png_path (str): Path to save the output PNG file.
         input_path_name (str): Input path name.
+        value_range (tuple, optional): (minimum, maximum) of the color ramp.
+        variable (str, optional): Variable shown, which selects the ramp colors.
 
     Returns:
         None
@@ -266,25 +531,64 @@ def apply_symbology_and_export_png(raster_path, shapefile_path, output_png_path,
         return
 
     # Load the shapefile layer
+    shapefile_layer = load_shapefile_layer(shapefile_path)
+    if shapefile_layer is None:
+        return
+
+    # Mask the raster with the cached land mask of its grid. A lazily resampled
+    # raster is masked lazily too, so the 0.018 degree raster is never materialized
+    raster_dir = os.path.dirname(raster_path)
+    if str(raster_path).endswith(".vrt"):
+        masked_path = os.path.join(raster_dir, f"{input_path_name}_NULL_res_mask.vrt")
+        raster_pipeline.mask_raster_virtual(raster_path, shapefile_path, masked_path)
+    else:
+        masked_path = os.path.join(raster_dir, f"{input_path_name}_NULL_res_mask.tif")
+        raster_pipeline.mask_raster_file(raster_path, shapefile_path, masked_path)
+
+    masked_layer = QgsRasterLayer(masked_path, "Masked Raster")
+    render_png(masked_layer, shapefile_layer, output_png_path, input_path_name, value_range, variable)
+
+
+def load_shapefile_layer(shapefile_path):
+    """
+    Load the land shapefile as a transparent vector layer, once per process.
+
+    Parameters:
+        shapefile_path (str): Path to the shapefile.
+
+    Returns:
+        QgsVectorLayer: The layer, or None if it could not be loaded.
+    """
+    if str(shapefile_path) in _shapefile_layers:
+        return _shapefile_layers[str(shapefile_path)]
+
     shapefile_layer = QgsVectorLayer(str(shapefile_path), "Mask Layer", "ogr")
     if not shapefile_layer.isValid():
         print("\t\tFailed to load the shapefile layer.")
-        return
+        return None
 
     # Set fill color to transparent for the shapefile layer
     shapefile_layer.renderer().symbol().setColor(QColor(0, 0, 0, 0))
+    _shapefile_layers[str(shapefile_path)] = shapefile_layer
+    return shapefile_layer
 
-    # Mask the raster with the shapefile
-    raster_dir = os.path.dirname(raster_path)
-    masked_path = os.path.join(raster_dir, f"{input_path_name}_NULL_res_mask.tif")
-    processing.run(
-        "gdal:cliprasterbymasklayer",
-        {'INPUT': raster_layer, 'MASK': shapefile_layer, 'OUTPUT': masked_path}
-    )
 
-    masked_layer = QgsRasterLayer(masked_path, "Masked Raster")
+def render_png(masked_layer, shapefile_layer, output_png_path, input_path_name, value_range=None, variable=None):
+    """
+    Apply the color ramp to a masked raster and export it with the shapefile outline as PNG.
 
-    renderer = create_color_ramp_renderer(masked_layer, input_path_name)
+    Parameters:
+        masked_layer (QgsRasterLayer): The masked raster layer.
+        shapefile_layer (QgsVectorLayer): The shapefile layer drawn on top.
+        output_png_path (str): Path to save the output PNG file.
+        input_path_name (str): Input path name.
+        value_range (tuple, optional): (minimum, maximum) of the color ramp.
+        variable (str, optional): Variable shown, which selects the ramp colors.
+
+    Returns:
+        None
+    """
+    renderer = create_color_ramp_renderer(masked_layer, input_path_name, value_range, variable)
     masked_layer.setRenderer(renderer)
     masked_layer.triggerRepaint()
 
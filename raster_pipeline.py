@@ -0,0 +1,643 @@
+# Standard libraries
+import os
+import json
+import hashlib
+
+# Third-party libraries
+import numpy as np
+import xarray as xr
+from osgeo import gdal, ogr, osr
+
+# Local Scripts
+import artifact_cache
+
+NODATA = -9999
+LANDMASK_DIRECTORY = os.path.join('.', 'era5_data', 'landmasks')
+RENDER_SIZE = (8000, 6000)
+
+# Land masks already loaded in this process, keyed like the on-disk cache
+_land_masks = {}
+
+
+def load_period_arrays(netcdf_path, variables):
+    """
+    Load variables of a NetCDF file as north-up arrays on a -180..180 grid.
+
+    The file is opened and its coordinates decoded once for all variables.
+
+    Parameters:
+        netcdf_path (str): Path to the NetCDF file.
+        variables (list): Variables to load.
+
+    Returns:
+        tuple: (arrays, geotransform), where arrays maps each variable to a
+            float32 array with missing values set to NODATA and geotransform
+            is the GDAL geotransform shared by all of them.
+    """
+    with xr.open_dataset(netcdf_path) as data:
+        # Shift the longitude values
+        data.coords['longitude'] = (data.coords['longitude'] + 180) % 360 - 180
+        data = data.sortby(data.longitude)
+        data = data.sortby(data.latitude, ascending=False)  # north-up
+
+        arrays = {variable: data[variable].squeeze().values.astype("float32") for variable in variables}
+        longitude = data.longitude.values
+        latitude = data.latitude.values
+
+    for values in arrays.values():
+        values[np.isnan(values)] = NODATA
+
+    res_x = float(longitude[1] - longitude[0])
+    res_y = float(latitude[1] - latitude[0])
+    geotransform = (
+        float(longitude[0]) - res_x / 2, res_x, 0.0,
+        float(latitude[0]) - res_y / 2, 0.0, res_y
+    )
+    return arrays, geotransform
+
+
+def load_period_array(netcdf_path, variable):
+    """
+    Load one variable of a NetCDF file as a north-up array on a -180..180 grid.
+
+    Parameters:
+        netcdf_path (str): Path to the NetCDF file.
+        variable (str): Variable to load.
+
+    Returns:
+        tuple: (values, geotransform). See `load_period_arrays`.
+    """
+    arrays, geotransform = load_period_arrays(netcdf_path, [variable])
+    return arrays[variable], geotransform
+
+
+def load_raster_array(raster_path):
+    """
+    Load the first band of a raster file.
+
+    Parameters:
+        raster_path (str): Path to the raster.
+
+    Returns:
+        tuple: (values, geotransform), with the band's NoData cells set to NODATA.
+    """
+    dataset = gdal.Open(str(raster_path))
+    band = dataset.GetRasterBand(1)
+    values = band.ReadAsArray().astype("float32")
+    nodata = band.GetNoDataValue()
+    if nodata is not None:
+        values[values == nodata] = NODATA
+    values[np.isnan(values)] = NODATA
+    geotransform = dataset.GetGeoTransform()
+    dataset = None
+    return values, geotransform
+
+
+def value_range(values, geotransform, shapefile_path=None):
+    """
+    Minimum and maximum of the valid cells of an array, over land only if a shapefile is given.
+
+    Bilinear resampling never leaves the range of its source cells, but a fine
+    land pixel at the coast blends in the coarse cells around it, ocean cells
+    included. The mask therefore takes every native cell a polygon touches,
+    so small islands and thin peninsulas count too, and is grown by one cell.
+    The range then covers every value of the resampled and masked raster the
+    maps are drawn from, while being computed on the native grid at a fraction
+    of the cost. It can be slightly wider than the values actually drawn.
+
+    Parameters:
+        values (numpy.ndarray): 2-D array with missing cells set to NODATA.
+        geotransform (tuple): GDAL geotransform of the array.
+        shapefile_path (str, optional): Shapefile limiting the cells considered.
+
+    Returns:
+        tuple: (minimum, maximum), or None if there are no valid cells.
+    """
+    valid = (values != NODATA) & ~np.isnan(values)
+    if shapefile_path is not None:
+        mask, _ = land_mask(shapefile_path, geotransform, values.shape, all_touched=True)
+        valid &= dilate(mask)
+    if not valid.any():
+        return None
+    return float(values[valid].min()), float(values[valid].max())
+
+
+def dilate(mask):
+    """
+    Grow a boolean mask by one cell in every direction, diagonals included.
+
+    Parameters:
+        mask (numpy.ndarray): 2-D boolean array.
+
+    Returns:
+        numpy.ndarray: The grown mask.
+    """
+    padded = np.pad(mask, 1)
+    rows, columns = mask.shape
+    grown = np.zeros_like(mask)
+    for row_offset in range(3):
+        for column_offset in range(3):
+            grown |= padded[row_offset:row_offset + rows, column_offset:column_offset + columns]
+    return grown
+
+
+def range_for(value_range, variable):
+    """
+    Pick the color ramp range of a variable.
+
+    Parameters:
+        value_range (tuple or dict, optional): One range for every variable, or
+            ranges keyed by variable.
+        variable (str): The variable.
+
+    Returns:
+        tuple: (minimum, maximum), or None if no range is set.
+    """
+    if isinstance(value_range, dict):
+        return value_range.get(variable)
+    return value_range
+
+
+def combine_ranges(ranges):
+    """
+    Combine value ranges into one range covering all of them.
+
+    Parameters:
+        ranges (list): (minimum, maximum) tuples. None entries are ignored.
+
+    Returns:
+        tuple: (minimum, maximum), or None if no range is given.
+    """
+    ranges = [item for item in ranges if item is not None]
+    if not ranges:
+        return None
+    return min(low for low, _ in ranges), max(high for _, high in ranges)
+
+
+def array_to_dataset(values, geotransform, path="", driver="MEM"):
+    """
+    Create a single-band WGS84 raster from an array, with NODATA already set.
+
+    Parameters:
+        values (numpy.ndarray): 2-D float32 array.
+        geotransform (tuple): GDAL geotransform of the array.
+        path (str): Output path. Ignored by the MEM driver.
+        driver (str): GDAL driver name, e.g. "MEM" or "GTiff".
+
+    Returns:
+        gdal.Dataset: The created dataset.
+    """
+    rows, cols = values.shape
+    options = ["COMPRESS=DEFLATE"] if driver == "GTiff" else []
+    dataset = gdal.GetDriverByName(driver).Create(path, cols, rows, 1, gdal.GDT_Float32, options=options)
+    dataset.SetGeoTransform(geotransform)
+
+    spatial_reference = osr.SpatialReference()
+    spatial_reference.ImportFromEPSG(4326)
+    dataset.SetProjection(spatial_reference.ExportToWkt())
+
+    band = dataset.GetRasterBand(1)
+    band.SetNoDataValue(NODATA)
+    band.WriteArray(values)
+    band.FlushCache()
+    return dataset
+
+
+def output_path(directory, filename, keep):
+    """
+    Pick where an intermediate raster goes.
+
+    Parameters:
+        directory (str): Directory for kept rasters.
+        filename (str): Filename of the raster.
+        keep (bool): Whether the raster should be written to disk.
+
+    Returns:
+        str: A path in `directory` if kept, otherwise a /vsimem/ path.
+    """
+    if keep:
+        os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, filename)
+    return f"/vsimem/{filename}"
+
+
+def resample_dataset(dataset, resolution, path, resample_alg="bilinear", bounds=None):
+    """
+    Resample a raster to a new resolution.
+
+    Parameters:
+        dataset (gdal.Dataset): The source raster.
+        resolution (float): Target resolution in degrees.
+        path (str): Output path, on disk or in /vsimem/.
+        resample_alg (str): GDAL resampling method.
+        bounds (tuple, optional): (xmin, ymin, xmax, ymax) to resample. Defaults to the
+            extent of the source.
+
+    Returns:
+        gdal.Dataset: The resampled raster.
+    """
+    return gdal.Warp(
+        path,
+        dataset,
+        format="GTiff",
+        outputBounds=bounds,
+        xRes=resolution,
+        yRes=resolution,
+        resampleAlg=resample_alg,
+        srcNodata=NODATA,
+        dstNodata=NODATA
+    )
+
+
+def warp_to_grid(dataset, geotransform, shape, path, resample_alg="bilinear"):
+    """
+    Resample a raster directly onto a given grid, e.g. the pixels of the output image.
+
+    Parameters:
+        dataset (gdal.Dataset): The source raster.
+        geotransform (tuple): GDAL geotransform of the target grid.
+        shape (tuple): (rows, columns) of the target grid.
+        path (str): Output path, on disk or in /vsimem/.
+        resample_alg (str): GDAL resampling method.
+
+    Returns:
+        gdal.Dataset: The resampled raster.
+    """
+    rows, cols = shape
+    bounds = (
+        geotransform[0], geotransform[3] + geotransform[5] * rows,
+        geotransform[0] + geotransform[1] * cols, geotransform[3]
+    )
+    return gdal.Warp(
+        path,
+        dataset,
+        format="GTiff",
+        outputBounds=bounds,
+        width=cols,
+        height=rows,
+        resampleAlg=resample_alg,
+        srcNodata=NODATA,
+        dstNodata=NODATA
+    )
+
+
+def canvas_grid(shapefile_path, size=RENDER_SIZE, bounds=None):
+    """
+    The grid of the output image: the land extent grown to the image aspect ratio.
+
+    Parameters:
+        shapefile_path (str): Path to the land shapefile.
+        size (tuple): (width, height) of the image in pixels.
+        bounds (tuple, optional): (xmin, ymin, xmax, ymax) of a region. The land
+            extent is cut to it, so a regional map fills the image.
+
+    Returns:
+        tuple: (geotransform, (rows, columns)) of the grid.
+    """
+    source = ogr.Open(str(shapefile_path))
+    xmin, xmax, ymin, ymax = source.GetLayer().GetExtent()
+    source = None
+    if bounds is not None:
+        xmin, ymin = max(xmin, bounds[0]), max(ymin, bounds[1])
+        xmax, ymax = min(xmax, bounds[2]), min(ymax, bounds[3])
+
+    width, height = size
+    xmin, ymin, xmax, ymax = map_extent((xmin, ymin, xmax, ymax), size)
+    geotransform = (xmin, (xmax - xmin) / width, 0.0, ymax, 0.0, -(ymax - ymin) / height)
+    return geotransform, (height, width)
+
+
+def dataset_bounds(dataset):
+    """
+    Return the bounds of a raster.
+
+    Parameters:
+        dataset (gdal.Dataset): The raster.
+
+    Returns:
+        tuple: (xmin, ymin, xmax, ymax).
+    """
+    geotransform = dataset.GetGeoTransform()
+    xmin = geotransform[0]
+    ymax = geotransform[3]
+    xmax = xmin + geotransform[1] * dataset.RasterXSize
+    ymin = ymax + geotransform[5] * dataset.RasterYSize
+    return xmin, ymin, xmax, ymax
+
+
+def map_extent(bounds, size):
+    """
+    Grow bounds to the aspect ratio of the image, keeping them centered.
+
+    QgsMapSettings does the same when the extent and output size disagree.
+
+    Parameters:
+        bounds (tuple): (xmin, ymin, xmax, ymax) of the layer.
+        size (tuple): (width, height) of the image in pixels.
+
+    Returns:
+        tuple: (xmin, ymin, xmax, ymax) of the map.
+    """
+    xmin, ymin, xmax, ymax = bounds
+    width, height = size
+    units_per_pixel = max((xmax - xmin) / width, (ymax - ymin) / height)
+    center_x = (xmin + xmax) / 2
+    center_y = (ymin + ymax) / 2
+    half_width = units_per_pixel * width / 2
+    half_height = units_per_pixel * height / 2
+    return (center_x - half_width, center_y - half_height, center_x + half_width, center_y + half_height)
+
+
+def masked_raster(values, geotransform, shapefile_path, resolution, paths, resample="full", size=RENDER_SIZE, bounds=None):
+    """
+    Build the masked raster a map is drawn from.
+
+    With resample="full" the data is resampled to `resolution` over the whole
+    grid and then masked and cropped to the land extent. With resample="canvas"
+    it is resampled straight onto the pixels of the output image, so the
+    high-resolution grid is never built.
+
+    Parameters:
+        values (numpy.ndarray): Native-resolution array with missing cells set to NODATA.
+        geotransform (tuple): GDAL geotransform of the array.
+        shapefile_path (str): Path to the land shapefile.
+        resolution (float): Target resolution for resample="full".
+        paths (tuple): (null, res, masked) paths, on disk or in /vsimem/.
+        resample (str): "full" or "canvas".
+        size (tuple): (width, height) of the output image for resample="canvas".
+        bounds (tuple, optional): (xmin, ymin, xmax, ymax) of the region to draw.
+            Defaults to the whole grid.
+
+    Returns:
+        gdal.Dataset: The masked raster.
+    """
+    null_path, res_path, masked_path = paths
+    null_dataset = array_to_dataset(values, geotransform, null_path, "GTiff")
+    if resample == "canvas":
+        grid_geotransform, shape = canvas_grid(shapefile_path, size, bounds)
+        res_dataset = warp_to_grid(null_dataset, grid_geotransform, shape, res_path)
+    else:
+        res_dataset = resample_dataset(null_dataset, resolution, res_path, bounds=bounds)
+    null_dataset = None
+
+    # The canvas already has the map extent, so it is not cropped further
+    masked_dataset = mask_dataset(res_dataset, shapefile_path, masked_path, crop=(resample != "canvas"))
+    res_dataset = None
+    return masked_dataset
+
+
+def mask_dataset(dataset, shapefile_path, path, crop=True):
+    """
+    Mask a raster to the polygons of a shapefile and crop it to their extent.
+
+    This gives the same result as gdal:cliprasterbymasklayer with its default
+    options, but uses a cached land mask instead of rasterizing the shapefile
+    again for every map.
+
+    Parameters:
+        dataset (gdal.Dataset): The source raster.
+        shapefile_path (str): Path to the mask shapefile.
+        path (str): Output path, on disk or in /vsimem/.
+        crop (bool): Whether to crop the result to the extent of the mask.
+
+    Returns:
+        gdal.Dataset: The masked raster.
+    """
+    values = dataset.GetRasterBand(1).ReadAsArray().astype("float32")
+    masked, geotransform = mask_array(values, dataset.GetGeoTransform(), shapefile_path, crop)
+    return array_to_dataset(masked, geotransform, path, "GTiff")
+
+
+def mask_raster_file(raster_path, shapefile_path, masked_path):
+    """
+    Mask a raster file to the polygons of a shapefile using the cached land mask.
+
+    Parameters:
+        raster_path (str): Path to the source raster.
+        shapefile_path (str): Path to the mask shapefile.
+        masked_path (str): Path of the masked raster to write.
+
+    Returns:
+        str: Path to the masked raster.
+    """
+    dataset = gdal.Open(str(raster_path))
+    masked_dataset = mask_dataset(dataset, shapefile_path, str(masked_path))
+    masked_dataset = None
+    dataset = None
+    return masked_path
+
+
+def mask_raster_virtual(raster_path, shapefile_path, masked_path):
+    """
+    Mask a raster to the polygons of a shapefile as a VRT evaluated when read.
+
+    The shapefile is applied as a warp cutline, as gdal:cliprasterbymasklayer
+    does, so no masked copy of the raster is held in memory or written to disk.
+    The result is cropped to the land extent on the grid of the source raster,
+    like `mask_dataset`.
+
+    Parameters:
+        raster_path (str): Path to the source raster, typically a resampled VRT.
+        shapefile_path (str): Path to the mask shapefile.
+        masked_path (str): Path of the VRT to write.
+
+    Returns:
+        str: Path to the masked VRT.
+    """
+    dataset = gdal.Open(str(raster_path))
+    geotransform = dataset.GetGeoTransform()
+    xmin, ymin, xmax, ymax = dataset_bounds(dataset)
+
+    source = ogr.Open(str(shapefile_path))
+    land_xmin, land_xmax, land_ymin, land_ymax = source.GetLayer().GetExtent()
+    source = None
+
+    # Snap the land extent outwards to the source grid, so no cell is resampled again
+    x_res, y_res = geotransform[1], -geotransform[5]
+    xmin = xmin + max(0, np.floor((land_xmin - xmin) / x_res)) * x_res
+    xmax = xmax - max(0, np.floor((xmax - land_xmax) / x_res)) * x_res
+    ymin = ymin + max(0, np.floor((land_ymin - ymin) / y_res)) * y_res
+    ymax = ymax - max(0, np.floor((ymax - land_ymax) / y_res)) * y_res
+
+    gdal.Warp(
+        str(masked_path),
+        dataset,
+        format="VRT",
+        outputBounds=(xmin, ymin, xmax, ymax),
+        xRes=x_res,
+        yRes=y_res,
+        cutlineDSName=str(shapefile_path),
+        srcNodata=NODATA,
+        dstNodata=NODATA
+    )
+    dataset = None
+    return masked_path
+
+
+def mask_array(values, geotransform, shapefile_path, crop=True):
+    """
+    Set cells outside the shapefile polygons to NODATA.
+
+    Parameters:
+        values (numpy.ndarray): 2-D array on the grid described by `geotransform`.
+        geotransform (tuple): GDAL geotransform of the array.
+        shapefile_path (str): Path to the mask shapefile.
+        crop (bool): Whether to crop the result to the extent of the mask.
+
+    Returns:
+        tuple: (masked values, geotransform of the masked values).
+    """
+    mask, window = land_mask(shapefile_path, geotransform, values.shape)
+    masked = np.where(mask, values, NODATA).astype("float32")
+    if not crop or window is None:
+        return masked, geotransform
+
+    row_start, row_stop, col_start, col_stop = window
+    masked = masked[row_start:row_stop, col_start:col_stop]
+    geotransform = (
+        geotransform[0] + col_start * geotransform[1], geotransform[1], 0.0,
+        geotransform[3] + row_start * geotransform[5], 0.0, geotransform[5]
+    )
+    return masked, geotransform
+
+
+def land_mask(shapefile_path, geotransform, shape, cache_directory=LANDMASK_DIRECTORY, all_touched=False):
+    """
+    Return the land mask of a grid, rasterizing the shapefile only once per grid.
+
+    Masks are cached in memory and on disk, keyed by the grid geometry and
+    the contents of the shapefile, so a changed shapefile or grid gets a new mask.
+
+    Parameters:
+        shapefile_path (str): Path to the mask shapefile.
+        geotransform (tuple): GDAL geotransform of the grid.
+        shape (tuple): (rows, columns) of the grid.
+        cache_directory (str): Directory of the on-disk cache.
+        all_touched (bool): Count every cell a polygon touches, not only the cells whose center is inside.
+
+    Returns:
+        tuple: (mask, window), where mask is a boolean array that is True over
+            land and window is (row_start, row_stop, col_start, col_stop) of
+            the land extent, or None if there is no land on the grid.
+    """
+    key_source = json.dumps({
+        "geotransform": [round(value, 10) for value in geotransform],
+        "shape": list(shape),
+        "shapefile": shapefile_digest(str(shapefile_path)),
+        "all_touched": all_touched
+    }, sort_keys=True)
+    key = hashlib.sha256(key_source.encode("utf-8")).hexdigest()[:16]
+    if key in _land_masks:
+        return _land_masks[key]
+
+    cache_path = os.path.join(cache_directory, f"landmask_{key}.npz")
+    if os.path.exists(cache_path):
+        with np.load(cache_path) as cached:
+            mask = np.unpackbits(cached["bits"], count=shape[0] * shape[1]).reshape(shape).astype(bool)
+            window = tuple(int(value) for value in cached["window"]) if cached["window"].size else None
+    else:
+        print("\t\tRasterizing the land mask for this grid...")
+        mask = rasterize_mask(shapefile_path, geotransform, shape, all_touched)
+        rows = np.flatnonzero(mask.any(axis=1))
+        cols = np.flatnonzero(mask.any(axis=0))
+        window = (int(rows[0]), int(rows[-1]) + 1, int(cols[0]), int(cols[-1]) + 1) if rows.size else None
+
+        os.makedirs(cache_directory, exist_ok=True)
+        temp_path = f"{cache_path}.tmp.npz"
+        np.savez(temp_path, bits=np.packbits(mask), window=np.array(window if window else [], dtype="int64"))
+        os.replace(temp_path, cache_path)
+
+    _land_masks[key] = (mask, window)
+    return mask, window
+
+
+def rasterize_mask(shapefile_path, geotransform, shape, all_touched=False):
+    """
+    Rasterize the polygons of a shapefile onto a grid.
+
+    Like gdalwarp cutlines, a cell counts as inside when its center is inside
+    a polygon, unless `all_touched` is set.
+
+    Parameters:
+        shapefile_path (str): Path to the mask shapefile.
+        geotransform (tuple): GDAL geotransform of the grid.
+        shape (tuple): (rows, columns) of the grid.
+        all_touched (bool): Count every cell a polygon touches.
+
+    Returns:
+        numpy.ndarray: Boolean array that is True inside the polygons.
+    """
+    rows, cols = shape
+    target = gdal.GetDriverByName("MEM").Create("", cols, rows, 1, gdal.GDT_Byte)
+    target.SetGeoTransform(geotransform)
+    spatial_reference = osr.SpatialReference()
+    spatial_reference.ImportFromEPSG(4326)
+    target.SetProjection(spatial_reference.ExportToWkt())
+
+    gdal.Rasterize(target, str(shapefile_path), burnValues=[1], allTouched=all_touched)
+    mask = target.GetRasterBand(1).ReadAsArray().astype(bool)
+    target = None
+    return mask
+
+
+def shapefile_digest(shapefile_path):
+    """
+    Hash the geometry files of a shapefile.
+
+    Parameters:
+        shapefile_path (str): Path to the .shp file.
+
+    Returns:
+        str: Hex digest of the .shp and .shx files.
+    """
+    digest = hashlib.sha256()
+    for part_path in shapefile_files(shapefile_path):
+        digest.update(artifact_cache.file_fingerprint(part_path).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def shapefile_files(shapefile_path):
+    """
+    List the geometry files of a shapefile.
+
+    Parameters:
+        shapefile_path (str): Path to the .shp file.
+
+    Returns:
+        list: Paths of the .shp and .shx files that exist.
+    """
+    stem = os.path.splitext(str(shapefile_path))[0]
+    return [stem + extension for extension in (".shp", ".shx") if os.path.exists(stem + extension)]
+
+
+def source_files(raster_path):
+    """
+    List the files a raster is read from, following VRTs to their sources.
+
+    Parameters:
+        raster_path (str): Path to the raster.
+
+    Returns:
+        list: Paths of the data files, the raster itself first.
+    """
+    dataset = gdal.Open(str(raster_path))
+    files = dataset.GetFileList() if dataset is not None else None
+    dataset = None
+    # .aux.xml sidecars only hold statistics, which QGIS writes when it reads the raster
+    files = [path for path in files or [] if not path.endswith(".aux.xml")]
+    return files or [str(raster_path)]
+
+
+def release(paths):
+    """
+    Free in-memory rasters.
+
+    Parameters:
+        paths (list of str): Paths of rasters. Only /vsimem/ paths are removed.
+
+    Returns:
+        None
+    """
+    for path in paths:
+        if path.startswith("/vsimem/"):
+            gdal.Unlink(path)
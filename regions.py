@@ -0,0 +1,123 @@
+# Third-party libraries
+import numpy as np
+
+# Named areas of interest as (north, west, south, east) in degrees, longitudes in -180..180
+REGIONS = {
+    "global": None,
+    "europe": (72, -25, 34, 45),
+    "africa": (38, -20, -35, 55),
+    "north_america": (72, -170, 7, -50),
+    "south_america": (13, -82, -56, -34),
+    "asia": (78, 25, -11, 180),
+    "oceania": (0, 110, -48, 180)
+}
+
+
+def resolve(region):
+    """
+    Return the bounding box of a region.
+
+    Parameters:
+        region (str or tuple, optional): A name from REGIONS, a "north,west,south,east"
+            string or a (north, west, south, east) tuple. None is the whole globe.
+
+    Returns:
+        tuple: (north, west, south, east) in degrees, or None for the whole globe.
+    """
+    if region is None:
+        return None
+    if isinstance(region, str):
+        if region in REGIONS:
+            return REGIONS[region]
+        try:
+            region = [float(value) for value in region.split(",")]
+        except ValueError:
+            raise ValueError(f"Unknown region: {region}. Use one of {', '.join(REGIONS)} or north,west,south,east.") from None
+
+    if len(region) != 4:
+        raise ValueError(f"A region needs north, west, south and east bounds, got {region}.")
+    north, west, south, east = (float(value) for value in region)
+    if not (-90 <= south < north <= 90):
+        raise ValueError(f"The region's south bound must be below its north bound, got {south} and {north}.")
+    if not (-180 <= west < east <= 180):
+        # Boxes crossing the antimeridian would need two requests; split them into two regions
+        raise ValueError(f"The region's west bound must be west of its east bound within -180..180, got {west} and {east}.")
+    return north, west, south, east
+
+
+def region_name(region):
+    """
+    Return the name a region is stored under.
+
+    Parameters:
+        region (str or tuple, optional): The region. See `resolve`.
+
+    Returns:
+        str: The preset name, or e.g. "n72_w-25_s34_e45" for a custom box. None for the whole globe.
+    """
+    box = resolve(region)
+    if box is None:
+        return None
+    if isinstance(region, str) and region in REGIONS:
+        return region
+    north, west, south, east = box
+    return f"n{north:g}_w{west:g}_s{south:g}_e{east:g}"
+
+
+def cds_area(region):
+    """
+    Return the region as a CDS "area" request parameter.
+
+    Parameters:
+        region (str or tuple, optional): The region. See `resolve`.
+
+    Returns:
+        list: [north, west, south, east], or None for the whole globe.
+    """
+    box = resolve(region)
+    return None if box is None else list(box)
+
+
+def output_bounds(region):
+    """
+    Return the region as GDAL output bounds.
+
+    Parameters:
+        region (str or tuple, optional): The region. See `resolve`.
+
+    Returns:
+        tuple: (xmin, ymin, xmax, ymax), or None for the whole globe.
+    """
+    box = resolve(region)
+    if box is None:
+        return None
+    north, west, south, east = box
+    return west, south, east, north
+
+
+def subset(data, region):
+    """
+    Select the grid cells of a dataset that fall in a region.
+
+    Works on 0..360 and -180..180 longitudes alike and keeps the order of the
+    coordinates, so it can be applied to a file that is already cut to the
+    region (a CDS "area" download) at no cost.
+
+    Parameters:
+        data (xarray.Dataset): Dataset with latitude and longitude coordinates.
+        region (str or tuple, optional): The region. See `resolve`.
+
+    Returns:
+        xarray.Dataset: The cells of the region, or `data` itself for the whole globe.
+    """
+    box = resolve(region)
+    if box is None:
+        return data
+    north, west, south, east = box
+    longitude = (data["longitude"].values + 180) % 360 - 180
+    latitude = data["latitude"].values
+    rows = np.flatnonzero((latitude >= south) & (latitude <= north))
+    columns = np.flatnonzero((longitude >= west) & (longitude <= east))
+    if rows.size == latitude.size and columns.size == longitude.size:
+        return data
+    return data.isel(latitude=rows, longitude=columns)
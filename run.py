@@ -1,28 +1,94 @@
+# Standard libraries
+import os
+import sys
+import argparse
+import tempfile
+
 # Local Scripts
-import download
+import artifact_cache
+import instrumentation
+import netcdf_encoding
+import pipeline
 import process
-import convert
-import qgis_transform
-import longterm_averaging
-import anomaly_calc
-
-# Define parameters for the API request
-years = ["2016"]
-#months = ["01"]
-months = ["01", "02", "03", "04", "05", "06", "07", "08", "09", "10", "11", "12"]
-variables = ["ssrd"]
-
-# download, process, and convert data to GeoTIFF for the specified variables and time periods
-periods = download.batch_download(variables,years,months)
-
-# monthly averaging
-process.average_netcdfs(variables, periods)
-convert.netcdf_to_geotiff(variables, periods, "monthly_means")
-qgis_transform.init_qgis(variables, periods, "monthly_means")
-
-# longterm averaging
-# longterm_averaging.create_longterm_average(variables, months)
-# anomaly_calc.calculate_anomaly(variables, periods, months)
-# convert.netcdf_to_geotiff(variables, periods, "monthly_anomalies")
-# qgis_transform.init_qgis(variables, periods, "monthly_anomalies")
+import regions
+
+# Default parameters for the API request
+YEARS = ["2016"]
+MONTHS = ["01", "02", "03", "04", "05", "06", "07", "08", "09", "10", "11", "12"]
+VARIABLES = ["ssrd"]
+
+
+def main(argv=None):
+    """
+    Download, average, convert and render ERA5 data as a dependency-aware task graph.
+
+    Each period moves on to averaging, conversion and rendering as soon as its
+    own download has finished, and tasks that are up to date with their inputs
+    are skipped. For example:
+
+        python run.py --years 2016 --months 01 02 --jobs 4
+        python run.py --dry-run
+        python run.py --rebuild 20160101_to_20160131 --from-stage render
+        python run.py --region europe
+        python run.py --statistics mean std max diurnal
+        python run.py --anomalies --tiles
+
+    Parameters:
+        argv (list, optional): Command-line arguments. Defaults to sys.argv.
+
+    Returns:
+        None
+    """
+    parser = argparse.ArgumentParser(description="Download, average, convert and render ERA5 data.")
+    parser.add_argument("--variables", nargs="+", default=VARIABLES, help="ERA5 variables, e.g. ssrd t2m")
+    parser.add_argument("--years", nargs="+", default=YEARS, help="years to process")
+    parser.add_argument("--months", nargs="+", default=MONTHS, help="months to process, e.g. 01 02")
+    parser.add_argument("--region", help=f"area to process: {', '.join(regions.REGIONS)} or north,west,south,east "
+                                         "(default: the whole globe)")
+    parser.add_argument("--statistics", nargs="+", choices=process.STATISTICS, default=["mean"],
+                        help="statistics of each month, computed in one pass over its download")
+    parser.add_argument("--backend", choices=["qgis", "headless"], default="qgis",
+                        help="render through QGIS or with NumPy/GDAL only")
+    parser.add_argument("--pipeline", choices=["files", "fused"], default="files",
+                        help="QGIS pipeline: from the GeoTIFFs or straight from the NetCDF files")
+    parser.add_argument("--anomalies", action="store_true",
+                        help="also compute, convert and render the long-term averages and anomalies")
+    parser.add_argument("--tiles", action="store_true",
+                        help="also export a Cloud-Optimized GeoTIFF and an XYZ tile pyramid of every map")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="worker processes per pool")
+    parser.add_argument("--max-in-flight", type=int, default=4, help="CDS requests running at once")
+    parser.add_argument("-n", "--dry-run", action="store_true", help="only list the tasks that would run")
+    parser.add_argument("--rebuild", nargs="+", default=[], metavar="PERIOD",
+                        help="rebuild these periods (or monthMM long-term averages) only")
+    parser.add_argument("--from-stage", choices=pipeline.STAGES, default="average",
+                        help="stage of the rebuilt periods to start from")
+    parser.add_argument("--compression", choices=["zlib", "zstd", "none"], help="compression of the NetCDF outputs")
+    parser.add_argument("--packing", choices=["float32", "int16", "none"], help="data type of the NetCDF outputs")
+    parser.add_argument("--cache-size", type=float, metavar="GB",
+                        help="size of the artifact cache, least recently used artifacts are evicted beyond it "
+                             "(default: 20, 0 keeps no copies)")
+    parser.add_argument("--events", metavar="PATH", help="append a JSON line per stage call to this file")
+    parser.add_argument("--summary", action="store_true", help="print where the run spent its time at the end")
+    args = parser.parse_args(argv)
+
+    regions.resolve(args.region)  # reject an unknown region before anything runs
+    netcdf_encoding.configure(compression=args.compression, packing=args.packing)
+    if args.cache_size is not None:
+        artifact_cache.configure(max_bytes=args.cache_size * 2 ** 30)
+    events_path = args.events
+    if args.summary and events_path is None:
+        events_path = os.path.join(tempfile.mkdtemp(), "events.jsonl")
+    run_id = instrumentation.configure(events_path) if events_path else None
+
+    graph = pipeline.build_graph(args.variables, args.years, args.months, args.backend, args.pipeline, args.anomalies,
+                                 region=args.region, statistics=args.statistics, export_tiles=args.tiles)
+    failed = pipeline.run_graph(graph, args.jobs, args.max_in_flight, args.dry_run, args.rebuild, args.from_stage)
+
+    if args.summary:
+        instrumentation.summary_table(instrumentation.load_events(events_path, run_id))
+    if failed:
+        sys.exit(1)
+
 
+if __name__ == "__main__":
+    main()
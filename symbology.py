@@ -0,0 +1,108 @@
+# Third-party libraries
+import numpy as np
+
+# evan notes --- do the green/blue from the default pseudocolor + use the orange from the new suggestion
+# evan orange-red: (249, 88, 8)
+# evan yellow: (255, 192, 13)
+# evan pink: (253, 130, 247)
+# evan blue: (76, 157, 249)
+# default red: (215, 25, 28)
+# default orange: (253, 174, 97)
+# default yellow: (255, 255, 191)
+# default light green: (171, 221, 164)
+# default blue: (43, 131, 186)
+RAMP_COLORS = [
+    (43, 131, 186),  # Default Blue
+    (171, 221, 164),  # Default Light Green
+    (255, 255, 191),  # Default Yellow
+    (253, 174, 97),  # Default Orange
+    (249, 88, 8)  # Evan Orange-Red
+]
+
+# Ramps of variables that should not use the default one, low to high
+VARIABLE_RAMP_COLORS = {
+    "t2m": [(43, 131, 186), (171, 221, 164), (255, 255, 191), (253, 174, 97), (215, 25, 28)],
+    "tp": [(255, 255, 204), (161, 218, 180), (65, 182, 196), (44, 127, 184), (37, 52, 148)]
+}
+
+ANOMALY_CUTOFFS = [-20, -10, 0, 10, 20]
+
+
+def ramp_colors(variable=None):
+    """
+    Return the ramp colors of a variable.
+
+    Parameters:
+        variable (str, optional): The variable.
+
+    Returns:
+        list: Five RGB tuples, from the lowest to the highest stop.
+    """
+    return VARIABLE_RAMP_COLORS.get(variable, RAMP_COLORS)
+
+
+def color_ramp_cutoffs(input_path_name, min_value, max_value):
+    """
+    Calculate the values of the color ramp stops.
+
+    Parameters:
+        input_path_name (str): Input path name. Anomalies use fixed percentage
+            stops, means are spread evenly between the minimum and maximum.
+        min_value (float): Minimum value of the raster.
+        max_value (float): Maximum value of the raster.
+
+    Returns:
+        list: One value per color in RAMP_COLORS.
+    """
+    if (input_path_name).startswith("anomaly"):
+        return list(ANOMALY_CUTOFFS)
+    return [min_value,
+            min_value + 0.25 * (max_value - min_value),
+            min_value + 0.5 * (max_value - min_value),
+            min_value + 0.75 * (max_value - min_value),
+            max_value]
+
+
+def ramp_signature(input_path_name, value_range=None, variable=None):
+    """
+    Describe everything that decides how a map is colored, for cache keys.
+
+    Parameters:
+        input_path_name (str): Input path name, which tells anomalies from means.
+        value_range (tuple, optional): (minimum, maximum) of the color ramp. Without
+            it the cutoffs of a mean come from the raster itself.
+        variable (str, optional): Variable shown.
+
+    Returns:
+        dict: The ramp cutoffs (None when taken from the raster) and colors.
+    """
+    if value_range is None and not input_path_name.startswith("anomaly"):
+        cutoffs = None
+    else:
+        cutoffs = [float(cutoff) for cutoff in color_ramp_cutoffs(input_path_name, *(value_range or (0, 0)))]
+    return {"cutoffs": cutoffs, "colors": [list(color) for color in ramp_colors(variable)]}
+
+
+def apply_color_ramp(values, cutoffs, nodata, colors=RAMP_COLORS):
+    """
+    Color an array with the interpolated ramp, like QgsColorRampShader.Interpolated.
+
+    Values outside the ramp take the color of the nearest stop. NoData and NaN
+    cells are fully transparent.
+
+    Parameters:
+        values (numpy.ndarray): 2-D array of values.
+        cutoffs (list): Value of each ramp stop, in increasing order.
+        nodata (float): NoData value of the array.
+        colors (list): RGB tuple of each ramp stop.
+
+    Returns:
+        numpy.ndarray: RGBA uint8 array of shape (rows, columns, 4).
+    """
+    rgba = np.zeros(values.shape + (4,), dtype=np.uint8)
+    valid = (values != nodata) & ~np.isnan(values)
+    colors = np.array(colors, dtype="float32")
+    for channel in range(3):
+        rgba[..., channel][valid] = np.rint(np.interp(values[valid], cutoffs, colors[:, channel])).astype(np.uint8)
+    rgba[..., 3][valid] = 255
+    return rgba
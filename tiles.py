@@ -0,0 +1,202 @@
+# Standard libraries
+import os
+import shutil
+import pathlib
+
+# Third-party libraries
+from osgeo import gdal
+from osgeo_utils import gdal2tiles
+
+# Local Scripts
+import artifact_cache
+import raster_pipeline
+import symbology
+import paths
+import regions
+from headless_render import SHAPEFILE_PATH
+
+
+def export_tiles(variables, periods, input_dir, zoom="0-7", resolution=0.018, value_range=None, region=None):
+    """
+    Export Cloud-Optimized GeoTIFFs and XYZ tile pyramids for the given periods.
+
+    For each period the masked data raster is written as a COG with internal
+    overviews and colored with the same ramp as the PNG maps into an XYZ tile
+    pyramid. The artifact store records what every pyramid was built from, so
+    only periods whose data or settings changed are regenerated, into an empty
+    directory, and each NetCDF file is opened once for all of its variables
+    that need new tiles.
+
+    Parameters:
+        variables (list): List of variables.
+        periods (list): List of periods.
+        input_dir (str): Input directory.
+        zoom (str): Zoom levels of the tile pyramid, e.g. "0-7".
+        resolution (float): Resolution in degrees of the raster the tiles are cut from.
+        value_range (tuple or dict, optional): (minimum, maximum) of the color ramp
+            shared by every period, or ranges keyed by variable. By default each
+            period uses its own range.
+        region (str or tuple, optional): The region of the run. Only its area is
+            resampled and tiled. See `regions.resolve`.
+
+    Returns:
+        None
+    """
+    directory_path = pathlib.Path(f'{paths.variable_directory(variables, region)}/{input_dir}')
+    cog_directory = directory_path / "cog"
+    tiles_directory = directory_path / "tiles"
+    os.makedirs(cog_directory, exist_ok=True)
+    os.makedirs(tiles_directory, exist_ok=True)
+
+    bounds = regions.output_bounds(region)
+
+    print("Exporting COGs and tile pyramids...")
+    for period in periods:
+        input_path_name = paths.period_input_name(period, input_dir)
+        netcdf_path = directory_path / f"{input_path_name}.nc"
+        stale = {}
+        for variable in variables:
+            stem = paths.variable_stem(input_path_name, variable, variables)
+            key = tiles_key(netcdf_path, variable, zoom, resolution, raster_pipeline.range_for(value_range, variable), bounds)
+            # The pyramid is a directory, so the record is kept on the COG written with it
+            if artifact_cache.is_current(key, cog_directory / f"{stem}.tif") and (tiles_directory / stem).exists():
+                print(f"\tTiles for {stem} are up to date.")
+            else:
+                stale[variable] = (stem, key)
+        if not stale:
+            continue
+
+        arrays, geotransform = raster_pipeline.load_period_arrays(netcdf_path, list(stale))
+        for variable, (stem, key) in stale.items():
+            print(f"\tBuilding tiles for {stem}...")
+            cog_path = cog_directory / f"{stem}.tif"
+            if not export_period(arrays.pop(variable), geotransform, variable, cog_path, tiles_directory / stem,
+                                 input_path_name, zoom, resolution, raster_pipeline.range_for(value_range, variable), bounds):
+                continue
+
+            # Record after every pyramid so an interrupted run keeps its progress
+            artifact_cache.record_output(key, cog_path, "tiles")
+
+
+def tiles_key(netcdf_path, variable, zoom, resolution, value_range, bounds=None):
+    """
+    Identify the inputs and settings a tile pyramid is built from.
+
+    Parameters:
+        netcdf_path (pathlib.Path): Path to the NetCDF file.
+        variable (str): Variable the tiles show.
+        zoom (str): Zoom levels of the tile pyramid.
+        resolution (float): Resolution of the raster the tiles are cut from.
+        value_range (tuple, optional): Shared color ramp range.
+        bounds (tuple, optional): (xmin, ymin, xmax, ymax) of the region exported.
+
+    Returns:
+        str: The artifact key. See `artifact_cache.artifact_key`.
+    """
+    return artifact_cache.artifact_key(
+        "tiles", [netcdf_path] + raster_pipeline.shapefile_files(SHAPEFILE_PATH),
+        variable=variable, zoom=zoom, resolution=resolution, value_range=value_range, bounds=bounds,
+        colors=symbology.ramp_colors(variable)
+    )
+
+
+def export_period(values, geotransform, variable, cog_path, tile_directory, input_path_name, zoom, resolution, value_range=None, bounds=None):
+    """
+    Write the COG and tile pyramid of one variable of a period.
+
+    Nothing is written when the color ramp range cannot be derived because no
+    land cell is valid, e.g. for a region over the ocean only.
+
+    Parameters:
+        values (numpy.ndarray): The variable on the native grid, as returned by
+            `raster_pipeline.load_period_arrays`.
+        geotransform (tuple): GDAL geotransform of `values`.
+        variable (str): Variable to export.
+        cog_path (pathlib.Path): Path of the COG to write.
+        tile_directory (pathlib.Path): Directory of the tile pyramid.
+        input_path_name (str): Input path name.
+        zoom (str): Zoom levels of the tile pyramid.
+        resolution (float): Resolution of the raster the tiles are cut from.
+        value_range (tuple, optional): (minimum, maximum) of the color ramp.
+        bounds (tuple, optional): (xmin, ymin, xmax, ymax) of the region to export.
+
+    Returns:
+        bool: True if the COG and tile pyramid were written.
+    """
+    if value_range is None:
+        value_range = raster_pipeline.value_range(values, geotransform, SHAPEFILE_PATH)
+    if value_range is None:
+        print(f"\t\tThe raster of {cog_path.stem} has no valid values over land. Skipping its tiles.")
+        return False
+
+    stem = cog_path.stem
+    null_path = f"/vsimem/{stem}_NULL.tif"
+    res_path = f"/vsimem/{stem}_NULL_res.tif"
+    masked_path = f"/vsimem/{stem}_NULL_res_mask.tif"
+    masked_dataset = raster_pipeline.masked_raster(values, geotransform, SHAPEFILE_PATH, resolution, (null_path, res_path, masked_path),
+                                                   bounds=bounds)
+
+    export_cog(masked_dataset, cog_path)
+
+    # gdal2tiles reads its input by path from worker processes, so the colored raster goes to disk
+    rgba_path = tile_directory.parent / f"{stem}_rgba.tif"
+    cutoffs = symbology.color_ramp_cutoffs(input_path_name, *value_range)
+    colorize_dataset(masked_dataset, cutoffs, rgba_path, symbology.ramp_colors(variable))
+    masked_dataset = None
+    raster_pipeline.release([null_path, res_path, masked_path])
+
+    # gdal2tiles leaves existing tiles in place, so those of an earlier build, e.g. at other zoom levels, would remain
+    shutil.rmtree(tile_directory, ignore_errors=True)
+    gdal2tiles.generate_tiles(str(rgba_path), str(tile_directory), zoom=zoom, xyz=True, webviewer="none", resampling="near")
+    os.remove(rgba_path)
+    print(f"\t\tTiles written to {tile_directory}")
+    return True
+
+
+def export_cog(dataset, cog_path):
+    """
+    Write a raster as a Cloud-Optimized GeoTIFF with internal overviews.
+
+    Parameters:
+        dataset (gdal.Dataset): The raster.
+        cog_path (pathlib.Path): Path of the COG to write.
+
+    Returns:
+        None
+    """
+    gdal.Translate(
+        str(cog_path),
+        dataset,
+        format="COG",
+        creationOptions=["COMPRESS=DEFLATE", "PREDICTOR=YES", "OVERVIEWS=AUTO", "OVERVIEW_RESAMPLING=AVERAGE"]
+    )
+    print(f"\t\tCOG written to {cog_path}")
+
+
+def colorize_dataset(dataset, cutoffs, rgba_path, colors=symbology.RAMP_COLORS):
+    """
+    Apply the color ramp to a raster and write it as a 4-band RGBA GeoTIFF.
+
+    Parameters:
+        dataset (gdal.Dataset): The masked data raster.
+        cutoffs (list): Value of each ramp stop.
+        rgba_path (pathlib.Path): Path of the RGBA raster to write.
+        colors (list): RGB color of each ramp stop.
+
+    Returns:
+        None
+    """
+    values = dataset.GetRasterBand(1).ReadAsArray()
+    rgba = symbology.apply_color_ramp(values, cutoffs, raster_pipeline.NODATA, colors)
+
+    rows, cols = values.shape
+    output = gdal.GetDriverByName("GTiff").Create(str(rgba_path), cols, rows, 4, gdal.GDT_Byte, options=["COMPRESS=DEFLATE"])
+    output.SetGeoTransform(dataset.GetGeoTransform())
+    output.SetProjection(dataset.GetProjection())
+    interpretations = [gdal.GCI_RedBand, gdal.GCI_GreenBand, gdal.GCI_BlueBand, gdal.GCI_AlphaBand]
+    for index, interpretation in enumerate(interpretations):
+        band = output.GetRasterBand(index + 1)
+        band.SetColorInterpretation(interpretation)
+        band.WriteArray(rgba[..., index])
+    output.FlushCache()
+    output = None
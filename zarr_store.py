@@ -0,0 +1,237 @@
+# Standard libraries
+import os
+
+# Third-party libraries
+import xarray as xr
+
+try:
+    import zarr
+except ImportError:  # Zarr is optional, the stages read the NetCDF files without it
+    zarr = None
+
+# Local Scripts
+import paths
+import regions
+
+# 31 days by 48 x 48 cells, about 7 MB of float32 per chunk. A month's map
+# reads at most two time chunks per tile, up to twice the month's own values.
+# A per-pixel time series reads one tile column, about 12 chunks (80 MB) per
+# year, instead of one chunk per day. Months are shorter than most time chunks,
+# so appending a month completes the last, partial chunk of the store.
+CHUNKS = {"valid_time": 744, "latitude": 48, "longitude": 48}
+
+
+def store_path(variables, variable, region=None):
+    """
+    Return the path of a variable's Zarr store.
+
+    Parameters:
+        variables (list): List of variables of the run, which locate the data directory.
+        variable (str): The variable stored.
+        region (str or tuple, optional): The region of the run. See `regions.resolve`.
+
+    Returns:
+        pathlib.Path: e.g. ./era5_data/ssrd-t2m/zarr/t2m.zarr
+    """
+    return paths.variable_directory(variables, region) / "zarr" / f"{variable}.zarr"
+
+
+def require_zarr():
+    """
+    Fail early with a clear message when the Zarr store is used without zarr installed.
+
+    Returns:
+        None
+    """
+    if zarr is None:
+        raise ImportError("The Zarr store needs the zarr package: pip install zarr")
+
+
+def stored_periods(path):
+    """
+    List the periods already appended to a store.
+
+    Parameters:
+        path (pathlib.Path): Path to the store.
+
+    Returns:
+        list: The periods, in the order they were appended. Empty if the store does not exist.
+    """
+    if not path.exists():
+        return []
+    periods = zarr.open_group(str(path), mode="r").attrs.get("periods", "")
+    return [period for period in periods.split(",") if period]
+
+
+def ingest(variables, periods, region=None):
+    """
+    Append the downloaded months of the given periods to the per-variable stores.
+
+    Periods already in a store are skipped, so this can be called after every
+    download. Appending is not safe from several processes at once.
+
+    Parameters:
+        variables (list): List of variables.
+        periods (list): List of periods.
+        region (str or tuple, optional): The region of the run. See `regions.resolve`.
+
+    Returns:
+        None
+    """
+    require_zarr()
+    input_directory = paths.variable_directory(variables, region) / "downloads"
+    print("Appending downloads to the Zarr stores...")
+    for period in sorted(periods):
+        in_path = input_directory / f"download_{period}.nc"
+        if not in_path.exists():
+            print(f"\tNo download for the period {period}.")
+            continue
+        append_period(variables, period, in_path, region)
+
+
+def append_period(variables, period, in_path, region=None):
+    """
+    Append one downloaded month to the store of each variable.
+
+    The file is opened once for all variables.
+
+    Parameters:
+        variables (list): List of variables.
+        period (str): The period of the file.
+        in_path (pathlib.Path): Path to the downloaded NetCDF file.
+        region (str or tuple, optional): The region of the run. Only its cells are stored.
+
+    Returns:
+        None
+    """
+    with xr.open_dataset(in_path) as data:
+        data = regions.subset(data, region)
+        for variable in variables:
+            path = store_path(variables, variable, region)
+            periods = stored_periods(path)
+            if period in periods:
+                print(f"\tData for the period {period} is already in the {variable} store.")
+                continue
+
+            month = data[[variable]].load()
+            # Keep the grid coordinates only; per-file extras such as expver do not append cleanly
+            month = month.drop_vars([name for name in month.coords if name not in month.dims])
+            # Drop the file's packing, whose scale factor differs from month to month
+            for name in month.variables:
+                month[name].encoding = {}
+
+            if path.exists():
+                # An interrupted append may have written the month before its period was
+                # recorded, so only the hours after the last stored one are appended
+                last = last_stored_time(path)
+                if last is not None:
+                    month = month.sel(valid_time=month["valid_time"] > last)
+                if month.sizes["valid_time"]:
+                    month.to_zarr(path, append_dim="valid_time", consolidated=True)
+            else:
+                os.makedirs(path.parent, exist_ok=True)
+                # Time chunks may be longer than the first month; only the grid is clamped
+                chunks = tuple(
+                    CHUNKS[dim] if dim == "valid_time" else min(CHUNKS.get(dim, size), size)
+                    for dim, size in zip(month[variable].dims, month[variable].shape)
+                )
+                month.to_zarr(path, mode="w", encoding={variable: {"chunks": chunks}}, consolidated=True)
+
+            # Record the period last, so an interrupted append is completed on the next call
+            group = zarr.open_group(str(path), mode="a")
+            group.attrs["periods"] = ",".join(periods + [period])
+            zarr.consolidate_metadata(str(path))
+            print(f"\tData for the period {period} has been appended to the {variable} store.")
+
+
+def last_stored_time(path):
+    """
+    Return the last time step written to a store.
+
+    The metadata is read directly rather than from the consolidated copy, which
+    an interrupted append leaves out of date.
+
+    Parameters:
+        path (pathlib.Path): Path to the store.
+
+    Returns:
+        numpy.datetime64: The last time step, or None if the store has none.
+    """
+    with xr.open_zarr(str(path), consolidated=False) as stored:
+        times = stored["valid_time"].values
+    return times[-1] if times.size else None
+
+
+def open_store(variables, names=None, region=None):
+    """
+    Open the stores of several variables as one lazily loaded dataset.
+
+    Only the consolidated metadata is read; values are loaded chunk by chunk
+    when they are used.
+
+    Parameters:
+        variables (list): List of variables of the run.
+        names (list, optional): Variables to open. Defaults to `variables`.
+        region (str or tuple, optional): The region of the run. See `regions.resolve`.
+
+    Returns:
+        xarray.Dataset: The hourly data of every variable, in time order.
+    """
+    require_zarr()
+    names = list(names) if names else list(variables)
+    datasets = [xr.open_zarr(store_path(variables, name, region), consolidated=True) for name in names]
+    data = datasets[0] if len(datasets) == 1 else xr.merge(datasets, join="exact")
+    if not data.indexes["valid_time"].is_monotonic_increasing:
+        data = data.sortby("valid_time")  # months appended out of order
+    return data
+
+
+def select_period(data, period):
+    """
+    Slice a period out of the store.
+
+    Parameters:
+        data (xarray.Dataset): The opened store.
+        period (str): The period, e.g. "20160101_to_20160131".
+
+    Returns:
+        xarray.Dataset: The hourly data of the period.
+    """
+    start, end = period.split("_to_")
+    return data.sel(valid_time=slice(f"{start[:4]}-{start[4:6]}-{start[6:]}", f"{end[:4]}-{end[4:6]}-{end[6:]}"))
+
+
+def select_month(data, month):
+    """
+    Select one calendar month of every year in the store.
+
+    Parameters:
+        data (xarray.Dataset): The opened store.
+        month (str): The month, e.g. "01". An empty string selects everything.
+
+    Returns:
+        xarray.Dataset: The hourly data of that month.
+    """
+    if month == "":
+        return data
+    return data.sel(valid_time=data.valid_time.dt.month == int(month))
+
+
+def stack_period_means(variables, periods, names=None, region=None):
+    """
+    Compute the monthly means of several periods stacked along a "period" axis.
+
+    All periods are sliced out of the same open store and reduced together.
+
+    Parameters:
+        variables (list): List of variables of the run.
+        periods (list): List of periods.
+        names (list, optional): Variables to average. Defaults to `variables`.
+        region (str or tuple, optional): The region of the run. See `regions.resolve`.
+
+    Returns:
+        xarray.Dataset: The monthly means with a leading "period" dimension.
+    """
+    data = open_store(variables, names, region)
+    means = [select_period(data, period).mean(dim="valid_time") for period in periods]
+    return xr.concat(means, dim="period").assign_coords(period=periods).compute()